@@ -19,6 +19,7 @@ from poster.streaminghttp import get_handlers
 
 from nxdrive.client.common import BaseClient, FILE_BUFFER_SIZE, safe_filename
 from nxdrive.engine.activity import Action, FileAction
+from nxdrive.engine.tracing import traced, tracer
 from nxdrive.logging_config import get_logger
 from nxdrive.options import Options
 from nxdrive.utils import TOKEN_PERMISSION, force_decode, get_device, \
@@ -325,10 +326,12 @@ class BaseAutomationClient(BaseClient):
         self.is_event_log_id = 'lowerBound' in [
                         param['name'] for param in change_summary_op['params']]
 
+    @traced('remote')
     def execute(self, command, url=None, op_input=None, timeout=-1,
                 check_params=False, void_op=False, extra_headers=None,
                 enrichers=None, file_out=None, **params):
         """Execute an Automation operation"""
+        tracer.annotate(command=command)
         if check_params:
             self._check_params(command, params)
 
@@ -502,6 +505,7 @@ class BaseAutomationClient(BaseClient):
                 return True
         return False
 
+    @traced('transfer')
     def upload(self, batch_id, file_path, filename=None, file_index=0,
                mime_type=None):
         """Upload a file through an Automation batch
@@ -811,6 +815,7 @@ class BaseAutomationClient(BaseClient):
                 current_action.progress += buffer_size
             yield r
 
+    @traced('transfer')
     def do_get(self, url, file_out=None, digest=None, digest_algorithm=None):
         log.trace('Downloading file from %r to %r with digest=%s, digest_algorithm=%s', url, file_out, digest,
                   digest_algorithm)
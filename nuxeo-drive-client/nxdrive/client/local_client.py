@@ -20,6 +20,7 @@ from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_PREFIX, \
 from nxdrive.client.common import BaseClient, DuplicationDisabledError, \
     DuplicationError, FILE_BUFFER_SIZE, NotFound, UNACCESSIBLE_HASH, \
     safe_filename
+from nxdrive.engine.tracing import traced
 from nxdrive.logging_config import get_logger
 from nxdrive.options import Options
 from nxdrive.utils import guess_digest_algorithm, normalized_path, \
@@ -86,6 +87,7 @@ class FileInfo(object):
     def __unicode__(self):
         return u'FileInfo[%s, remote_ref=%s]' % (self.filepath, self.remote_ref)
 
+    @traced('digest')
     def get_digest(self, digest_func=None):
         # type: (Optional[callable]) -> Union[Text, None]
         """ Lazy computation of the digest. """
@@ -168,12 +170,14 @@ class LocalClient(BaseClient):
         return (filename.startswith(DOWNLOAD_TMP_FILE_PREFIX) and
                 filename.endswith(DOWNLOAD_TMP_FILE_SUFFIX))
 
+    @traced('local')
     def set_readonly(self, ref):
         # type: (Text) -> None
 
         path = self.abspath(ref)
         self.set_path_readonly(path)
 
+    @traced('local')
     def unset_readonly(self, ref):
         # type: (Text) -> None
 
@@ -390,6 +394,7 @@ FolderType=Generic
         except:
             log.exception('Impossible to set the folder icon')
 
+    @traced('local')
     def set_remote_id(self, ref, remote_id, name='ndrive'):
         # type: (Text, Text, Text) -> None
 
@@ -458,6 +463,7 @@ FolderType=Generic
         except:
             return None
 
+    @traced('local')
     def get_info(self, ref, raise_if_missing=True):
         # type: (Text, bool) -> Union[FileInfo, None]
 
@@ -618,6 +624,7 @@ FolderType=Generic
         path = ref if is_abs else self.abspath(ref)
         return self.lock_path(path, locker)
 
+    @traced('local')
     def make_folder(self, parent, name):
         # type: (Text, Text) -> Text
 
@@ -690,6 +697,7 @@ FolderType=Generic
             path = parent + u"/" + name
         return path, os_path, name
 
+    @traced('local')
     def update_content(self, ref, content, xattr_names=('ndrive',)):
         # type: (Text, bytes, Tuple[Text]) -> None
 
@@ -703,6 +711,7 @@ FolderType=Generic
             if value is not None:
                 self.set_remote_id(ref, value, name=name)
 
+    @traced('local')
     def delete(self, ref):
         # type: (Text) -> None
 
@@ -730,6 +739,7 @@ FolderType=Generic
             # Don't want to unlock the current deleted
             self.lock_ref(os_path, locker & 2, is_abs=True)
 
+    @traced('local')
     def delete_final(self, ref):
         # type: (Text) -> None
 
@@ -759,6 +769,7 @@ FolderType=Generic
 
         return os.access(self.abspath(ref), os.W_OK)
 
+    @traced('local')
     def rename(self, ref, to_name):
         # type: (Text, Text) -> FileInfo
         """ Rename a local file or folder. """
@@ -795,6 +806,7 @@ FolderType=Generic
         finally:
             self.lock_ref(source_os_path, locker & 2, is_abs=True)
 
+    @traced('local')
     def move(self, ref, new_parent_ref, name=None):
         # type: (Text, Text, Optional[Text]) -> FileInfo
         """ Move a local file or folder into another folder. """
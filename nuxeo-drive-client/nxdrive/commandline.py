@@ -257,6 +257,17 @@ class CliHandler(object):
             "--remote-repo", default=Options.remote_repo,
             help="Name of the remote repository.")
 
+        # Check the consistency of the synchronization metrics
+        check_counters_parser = subparsers.add_parser(
+            'check-counters',
+            help='Check the synchronization counters against the database.',
+            parents=[common_parser],
+        )
+        check_counters_parser.set_defaults(command='check_counters')
+        check_counters_parser.add_argument(
+            "--rebuild", default=False, action="store_true",
+            help="Rebuild the counters if they are inconsistent.")
+
         uninstall_parser = subparsers.add_parser(
             'uninstall', help='Remove app data',
             parents=[common_parser],
@@ -548,6 +559,16 @@ class CliHandler(object):
         self.log.error('No engine registered for local folder %s', options.local_folder)
         return 1
 
+    def check_counters(self, options):
+        status = 0
+        for engine in self.manager.get_engines().values():
+            if not engine.get_dao().check_counters(rebuild=options.rebuild):
+                self.log.warning('Inconsistent counters for local folder %s',
+                                 engine.local_folder)
+                if not options.rebuild:
+                    status = 1
+        return status
+
     def _install_faulthandler(self):
         """ Utility to help debug segfaults. """
 
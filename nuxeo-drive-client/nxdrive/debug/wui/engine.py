@@ -3,6 +3,7 @@ import time
 
 from PyQt4 import QtCore
 
+from nxdrive.engine.tracing import tracer
 from nxdrive.logging_config import MAX_LOG_DISPLAYED, get_handler, get_logger
 from nxdrive.wui.dialog import WebDialog, WebDriveApi
 
@@ -34,6 +35,9 @@ class DebugDriveApi(WebDriveApi):
                         engine.get_queue_manager().get_local_folder_queue(), engine.get_dao())
         result["queue"]["local_file"] = self._get_full_queue(
                         engine.get_queue_manager().get_local_file_queue(), engine.get_dao())
+        result["database"] = engine.get_dao().get_metrics()
+        result["profile"] = engine.get_dao().get_profile()
+        result["tracing"] = tracer.get_metrics()
         result["local_watcher"] = self._export_worker(engine._local_watcher)
         result["remote_watcher"] = self._export_worker(engine._remote_watcher)
         try:
@@ -184,6 +188,21 @@ class DebugDriveApi(WebDriveApi):
             elif queue == 'remote_file_queue':
                 engine.get_queue_manager().enable_remote_file_queue(value=False)
 
+    @QtCore.pyqtSlot(bool)
+    def set_tracing(self, enabled):
+        if enabled:
+            tracer.enable()
+        else:
+            tracer.disable()
+
+    @QtCore.pyqtSlot(result=str)
+    def get_traces(self):
+        return self._json(tracer.get_traces())
+
+    @QtCore.pyqtSlot(result=str)
+    def get_chrome_trace(self):
+        return self._json(tracer.export_chrome())
+
     @QtCore.pyqtSlot(str, str)
     def get_queue(self, uid, queue):
         engine = self._get_engine(str(uid))
@@ -3,9 +3,8 @@ import os
 import shutil
 import sys
 from Queue import Empty, Queue
-from time import sleep
 
-from PyQt4.QtCore import pyqtSignal, pyqtSlot
+from PyQt4.QtCore import Qt, pyqtSignal, pyqtSlot
 
 from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_PREFIX, \
     DOWNLOAD_TMP_FILE_SUFFIX
@@ -17,8 +16,8 @@ from nxdrive.engine.watcher.local_watcher import DriveFSEventHandler
 from nxdrive.engine.workers import ThreadInterrupt, Worker
 from nxdrive.logging_config import get_logger
 from nxdrive.osi import parse_protocol_url
-from nxdrive.utils import current_milli_time, guess_digest_algorithm, \
-    normalize_event_filename
+from nxdrive.utils import copy_file, current_milli_time, \
+    guess_digest_algorithm, normalize_event_filename
 from nxdrive.wui.application import SimpleApplication
 from nxdrive.wui.modal import WebModal
 
@@ -54,6 +53,7 @@ class DirectEdit(Worker):
         self._error_queue = BlacklistQueue()
         self._stop = False
         self._manager.get_autolock_service().orphanLocks.connect(self._autolock_orphans)
+        self._manager.get_autolock_service().orphanLocks.connect(self.wake, Qt.DirectConnection)
         self._last_action_timing = -1
 
     @pyqtSlot(object)
@@ -71,10 +71,12 @@ class DirectEdit(Worker):
     def autolock_lock(self, src_path):
         ref = self._local_client.get_path(src_path)
         self._lock_queue.put((ref, 'lock'))
+        self.wake()
 
     def autolock_unlock(self, src_path):
         ref = self._local_client.get_path(src_path)
         self._lock_queue.put((ref, 'unlock'))
+        self.wake()
 
     def start(self):
         self._stop = False
@@ -192,13 +194,11 @@ class DirectEdit(Worker):
         file_out = os.path.join(file_dir, DOWNLOAD_TMP_FILE_PREFIX + file_name
                                 + DOWNLOAD_TMP_FILE_SUFFIX)
         # Close to processor method - should try to refactor ?
-        pair = engine.get_dao().get_valid_duplicate_file(info.digest)
-        if pair:
-            local_client = engine.get_local_client()
-            existing_file_path = local_client.abspath(pair.local_path)
+        existing_file_path = engine.get_valid_duplicate_file(info.digest)
+        if existing_file_path:
             log.debug('Local file matches remote digest %r, copying it from %r', info.digest, existing_file_path)
-            shutil.copy(existing_file_path, file_out)
-            if pair.is_readonly():
+            copy_file(existing_file_path, file_out)
+            if not os.access(file_out, os.W_OK):
                 log.debug('Unsetting readonly flag on copied file %r', file_out)
                 BaseClient.unset_path_readonly(file_out)
         else:
@@ -337,6 +337,7 @@ class DirectEdit(Worker):
         dir_path = os.path.dirname(ref)
         self._local_client.set_remote_id(dir_path, unicode(digest), "nxdirecteditdigest")
         self._upload_queue.put(ref)
+        self.wake()
 
     def _handle_queues(self):
         uploaded = False
@@ -448,6 +449,13 @@ class DirectEdit(Worker):
             evt = self._watchdog_queue.get()
             self.handle_watchdog_event(evt)
 
+    def _get_wait_timeout(self):
+        if not (self._upload_queue.empty() and self._lock_queue.empty()
+                and self._watchdog_queue.empty()):
+            return 0
+        # Until the next retry of the uploads in error
+        return self._error_queue.get_next_wait()
+
     def _execute(self):
         try:
             self._watchdog_queue = Queue()
@@ -477,7 +485,7 @@ class DirectEdit(Worker):
                     raise
                 except Exception as ex:
                     log.debug(ex)
-                sleep(0.01)
+                self._block(self._get_wait_timeout())
         except ThreadInterrupt:
             raise
         finally:
@@ -1,17 +1,61 @@
 # coding: utf-8
 import time
+from itertools import count
 from threading import Lock
 
+from nxdrive.engine.scheduler import IndexedHeap
+
+
+def constant_backoff(count, interval):
+    return interval
+
+
+def linear_backoff(count, interval):
+    return count * interval
+
+
+def exponential_backoff(count, interval):
+    return interval * 2 ** (max(count, 1) - 1)
+
+
+# Values of Options.error_backoff
+BACKOFF_POLICIES = {
+    'constant': constant_backoff,
+    'exponential': exponential_backoff,
+    'linear': linear_backoff,
+}
+
+# Upper bounds, in seconds, of the retry waits histogram buckets
+WAIT_BUCKETS = (1, 10, 60, 300, 1800, 3600)
+
+
+def get_backoffs(values):
+    """
+    Parse the error_backoff option, a sequence of 'ERROR:policy'.
+    Return a dict of error type -> backoff function.
+    """
+    backoffs = dict()
+    for value in values or ():
+        error, _, policy = value.rpartition(':')
+        if error and policy in BACKOFF_POLICIES:
+            backoffs[error] = BACKOFF_POLICIES[policy]
+    return backoffs
+
 
 class BlacklistItem(object):
 
-    def __init__(self, item_id, item, next_try=30):
-        self._count = 1
+    def __init__(self, item_id, item, next_try=30, backoff=linear_backoff,
+                 error=None, count=1, wait=None):
+        self._count = max(count, 1)
         self._next_try = None
         self._item = item
         self._item_id = item_id
         self._interval = next_try
-        self._next_try = next_try + int(time.time())
+        self._backoff = backoff
+        self._error = error
+        if wait is None:
+            wait = backoff(self._count, next_try)
+        self._next_try = wait + int(time.time())
 
     def check(self, cur_time=None):
         if cur_time is None:
@@ -24,29 +68,51 @@ class BlacklistItem(object):
     def get(self):
         return self._item
 
+    def get_error(self):
+        return self._error
+
+    def get_next_try(self):
+        return self._next_try
+
     def increase(self, next_try=None):
         cur_time = int(time.time())
         self._count = self._count + 1
-        if next_try is not None:
-            self._next_try = next_try + cur_time
-        else:
-            self._next_try = self._count * self._interval + cur_time
+        if next_try is None:
+            next_try = self._backoff(self._count, self._interval)
+        self._next_try = next_try + cur_time
 
 
 class BlacklistQueue(object):
+    """
+    Items waiting for a retry, ordered by their next try.
+    A min-heap with an index by id: getting the next item to retry, adding,
+    updating or removing one are in O(log n).
+    The backoff between the retries of an item depends on its error type.
+    """
 
-    def __init__(self, delay=30):
-        self._queue = dict()
+    def __init__(self, delay=30, backoff=linear_backoff, backoffs=None):
         self._lock = Lock()
         self._delay = delay
+        self._backoff = backoff
+        # Error type -> backoff function
+        self._backoffs = backoffs or dict()
+        self._sequence = count()
+        self._heap = IndexedHeap()
+        # Error type -> {bucket: count} of the scheduled retry waits
+        self._waits = dict()
 
-    def push(self, id_obj, obj):
-        item = BlacklistItem(item_id=id_obj, item=obj, next_try=self._delay)
-        self._lock.acquire()
-        try:
-            self._queue[item.get_id()] = item
-        finally:
-            self._lock.release()
+    def push(self, id_obj, obj, next_try=None, count=1, error=None):
+        """
+        Blacklist obj for next_try seconds, replacing any pending item of
+        the same id.  Without next_try, wait as long as the backoff of the
+        error type gives for the count-th error.
+        Return the BlacklistItem.
+        """
+        item = BlacklistItem(item_id=id_obj, item=obj, next_try=self._delay,
+                             backoff=self._backoffs.get(error, self._backoff),
+                             error=error, count=count, wait=next_try)
+        self._put(item)
+        return item
 
     def repush(self, item, increase_wait=True):
         if not isinstance(item, BlacklistItem):
@@ -55,19 +121,70 @@ class BlacklistQueue(object):
             item.increase()
         else:
             item.increase(next_try=self._delay)
-        self._lock.acquire()
-        try:
-            self._queue[item.get_id()] = item
-        finally:
-            self._lock.release()
+        self._put(item)
+
+    def _put(self, item):
+        with self._lock:
+            self._heap.push(item.get_id(), item.get_next_try(),
+                            next(self._sequence), item)
+            self._record_wait(item)
+
+    def _record_wait(self, item):
+        wait = item.get_next_try() - int(time.time())
+        bucket = 'more'
+        for bound in WAIT_BUCKETS:
+            if wait <= bound:
+                bucket = '%ds' % bound
+                break
+        waits = self._waits.setdefault(item.get_error() or 'default', dict())
+        waits[bucket] = waits.get(bucket, 0) + 1
+
+    def remove(self, id_obj):
+        """ Return True if the item was blacklisted. """
+        with self._lock:
+            return self._heap.discard(id_obj)
 
     def get(self):
+        """ Return the next item whose retry time has come, or None. """
         cur_time = int(time.time())
-        self._lock.acquire()
-        try:
-            for item in self._queue.values():
-                if item.check(cur_time=cur_time):
-                    del self._queue[item.get_id()]
-                    return item
-        finally:
-            self._lock.release()
+        with self._lock:
+            entry = self._heap.peek()
+            if entry is None or not entry[2].check(cur_time):
+                return None
+            return self._heap.pop()
+
+    def get_next_wait(self):
+        """ Return the seconds until the next item can be retried, or None. """
+        with self._lock:
+            entry = self._heap.peek()
+            if entry is None:
+                return None
+            # An item is retried once its next try second is over
+            return max(0, entry[0] + 1 - time.time())
+
+    def retry_all(self):
+        """ Make all the items ready to be retried. """
+
+        def reset(item):
+            item._next_try = 0
+            return 0
+
+        with self._lock:
+            self._heap.rekey(reset)
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'size': len(self._heap),
+                'retry_waits': dict((error, dict(waits)) for error, waits
+                                    in self._waits.iteritems()),
+            }
+
+    def empty(self):
+        return not self._heap
+
+    def __contains__(self, id_obj):
+        return id_obj in self._heap
+
+    def __len__(self):
+        return len(self._heap)
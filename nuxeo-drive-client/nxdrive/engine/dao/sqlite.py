@@ -1,19 +1,30 @@
 # coding: utf-8
 import inspect
 import os
+import re
 import sqlite3
 import sys
 from datetime import datetime
-from threading import RLock, current_thread, local
+from random import uniform
+from threading import Condition, Lock, RLock, Thread, current_thread, local
+from time import sleep, time
 
 from PyQt4.QtCore import QObject, pyqtSignal
 
+from nxdrive.engine.tracing import traced
 from nxdrive.logging_config import get_logger
+from nxdrive.utils import PathTrie, path_join
 
 log = get_logger(__name__)
 
 SCHEMA_VERSION = "schema_version"
 
+# Per connection, the DAO has more distinct queries than the default 100
+CACHED_STATEMENTS = 256
+
+# Rows pushed at once to the QueueManager when rebuilding its queue
+QUEUE_PAGE_SIZE = 1000
+
 # Summary status from last known pair of states
 # (local_state, remote_state)
 PAIR_STATES = {
@@ -56,31 +67,294 @@ PAIR_STATES = {
 }
 
 
+def is_lock_error(error):
+    """ Tell if an OperationalError is due to another connection's lock. """
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+class LockWaitStats(object):
+    """
+    Time spent waiting on database locks, on top of the connection
+    busy timeout: each statement that failed on a lock counts as one wait,
+    lasting until it succeeded or was given up.
+    """
+
+    # Upper bounds of the histogram buckets, in seconds
+    BUCKETS = (0.01, 0.1, 1, 10)
+
+    def __init__(self):
+        self._lock = Lock()
+        self.waits = 0
+        self.retries = 0
+        self.failures = 0
+        self.wait_time = 0
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+
+    def record(self, duration, retries, failed=False):
+        bucket = len(self.BUCKETS)
+        for i, bound in enumerate(self.BUCKETS):
+            if duration <= bound:
+                bucket = i
+                break
+        with self._lock:
+            self.waits += 1
+            self.retries += retries
+            self.failures += failed
+            self.wait_time += duration
+            self.histogram[bucket] += 1
+
+    def get_metrics(self):
+        labels = ['<=%gs' % bound for bound in self.BUCKETS]
+        labels.append('>%gs' % self.BUCKETS[-1])
+        with self._lock:
+            return {
+                'lock_waits': self.waits,
+                'lock_retries': self.retries,
+                'lock_failures': self.failures,
+                'lock_wait_time': self.wait_time,
+                'lock_wait_histogram': dict(zip(labels, self.histogram)),
+            }
+
+
 class AutoRetryCursor(sqlite3.Cursor):
+    """
+    Cursor retrying the statements that failed on a database lock, once
+    the connection busy timeout expired, with a jittered exponential backoff.
+    Other operational errors are raised right away.
+    """
+
+    retries = 5
+    backoff = 0.05
+    max_backoff = 2
+
     def execute(self, *args, **kwargs):
+        return self._retry(super(AutoRetryCursor, self).execute,
+                           *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._retry(super(AutoRetryCursor, self).executemany,
+                           *args, **kwargs)
+
+    def _retry(self, method, *args, **kwargs):
         count = 0
+        start = None
         while True:
-            count += 1
+            if start is None:
+                started = time()
             try:
-                obj = super(AutoRetryCursor, self).execute(*args, **kwargs)
-                if count > 1:
-                    log.trace('Result returned from try #%d', count)
-                return obj
+                obj = method(*args, **kwargs)
             except sqlite3.OperationalError as e:
-                log.trace('Retry locked database #%d', count)
-                if count > 5:
-                    raise e
+                if not is_lock_error(e):
+                    raise
+                if start is None:
+                    start = started
+                if count >= self.retries:
+                    self._record_wait(time() - start, count, failed=True)
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2 ** count)
+                count += 1
+                log.trace('Retry locked database #%d in %.3fs', count, delay)
+                sleep(uniform(delay / 2, delay))
+                continue
+            if start is not None:
+                log.trace('Result returned from try #%d', count + 1)
+                self._record_wait(time() - start, count)
+            return obj
+
+    def _record_wait(self, duration, retries, failed=False):
+        stats = getattr(self.connection, 'lock_stats', None)
+        if stats is not None:
+            stats.record(duration, retries, failed=failed)
+
+
+class ProfiledCursor(AutoRetryCursor):
+    """
+    Cursor timing its statements, from execute() to the last fetched row,
+    for the QueryProfiler of its connection.
+    """
+
+    _query = None
+    _time = 0
+    _rows = 0
+
+    def _retry(self, method, *args, **kwargs):
+        self._record()
+        start = time()
+        obj = super(ProfiledCursor, self)._retry(method, *args, **kwargs)
+        self._query = args[0]
+        self._time = time() - start
+        self._rows = 0
+        if self.description is None:
+            # Not a query, nothing to fetch
+            self._rows = max(self.rowcount, 0)
+            self._record()
+        return obj
+
+    def _fetched(self, start, rows, done):
+        self._time += time() - start
+        self._rows += rows
+        if done:
+            self._record()
+
+    def _record(self):
+        if self._query is None:
+            return
+        self.connection.profiler.record(self._query, self._time, self._rows)
+        self._query = None
+
+    def fetchone(self):
+        start = time()
+        row = super(ProfiledCursor, self).fetchone()
+        self._fetched(start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        start = time()
+        rows = super(ProfiledCursor, self).fetchmany(size)
+        self._fetched(start, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        start = time()
+        rows = super(ProfiledCursor, self).fetchall()
+        self._fetched(start, len(rows), True)
+        return rows
+
+    def next(self):
+        start = time()
+        try:
+            row = super(ProfiledCursor, self).next()
+        except StopIteration:
+            self._fetched(start, 0, True)
+            raise
+        self._fetched(start, 1, False)
+        return row
+
+    def close(self):
+        self._record()
+        super(ProfiledCursor, self).close()
+
+    def __del__(self):
+        self._record()
 
 
 class AutoRetryConnection(sqlite3.Connection):
+
+    lock_stats = None
+    profiler = None
+
     def cursor(self):
+        if self.profiler is not None:
+            return super(AutoRetryConnection, self).cursor(ProfiledCursor)
         return super(AutoRetryConnection, self).cursor(AutoRetryCursor)
 
 
-class StateRow(sqlite3.Row):
+class GroupCommitConnection(AutoRetryConnection):
+    """
+    Write connection whose commits are delegated to a GroupCommitter:
+    commit() only registers the pending statement and returns, the real
+    commit is done by the committer thread for the whole group.
+    """
+
+    committer = None
+
+    def commit(self):
+        if self.committer is None:
+            return self.force_commit()
+        self.committer.notify()
+
+    def force_commit(self):
+        super(GroupCommitConnection, self).commit()
+
+
+class GroupCommitter(Thread):
+    """
+    Dedicated writer thread committing the statements of all the workers
+    in one transaction, every `delay` seconds or as soon as `size`
+    statements are pending.
+    """
+
+    def __init__(self, dao, delay=0.01, size=500):
+        super(GroupCommitter, self).__init__(name='GroupCommitter')
+        self.daemon = True
+        self._dao = dao
+        self._delay = delay
+        self._size = size
+        self._pending = 0
+        # Time of the first statement of the pending group
+        self._started = 0
+        self._stopped = False
+        self._condition = Condition()
+        self.commits = 0
+        self.statements = 0
+
+    def notify(self):
+        """ Called with the DAO lock held, once a statement is executed. """
+        with self._condition:
+            if not self._pending:
+                self._started = time()
+            self._pending += 1
+            if self._pending == 1 or self._pending >= self._size:
+                self._condition.notify()
+
+    def run(self):
+        while 'Committing':
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    break
+                # Let other statements join the group, the window starts
+                # with its first statement even if flushed meanwhile
+                while self._pending < self._size and not self._stopped:
+                    remaining = self._started + self._delay - time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # Statements stay in the transaction for the next commit
+                log.exception('Group commit failed')
+        self.flush()
+
+    def flush(self):
+        """ Commit the pending statements, return when they are durable. """
+        if not self._pending:
+            return
+        self._dao.acquire_lock()
+        try:
+            with self._condition:
+                pending, self._pending = self._pending, 0
+            con = self._dao._conn
+            if pending and con is not None:
+                con.force_commit()
+                self.commits += 1
+                self.statements += pending
+        finally:
+            self._dao.release_lock()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self.join()
+
+    def get_metrics(self):
+        return {
+            'group_commits': self.commits,
+            'group_statements': self.statements,
+            'group_pending': self._pending,
+        }
+
+
+class BaseStateRow(object):
+    """ Behavior shared by the state row types. """
 
-    def __init__(self, arg1, arg2):
-        super(StateRow, self).__init__(arg1, arg2)
+    __slots__ = ()
 
     def __repr__(self):
         return ('<{name}[{cls.id!r}]'
@@ -92,12 +366,13 @@ class StateRow(sqlite3.Row):
                 '>'
                 ).format(name=type(self).__name__, cls=self)
 
-    def __getattr__(self, name):
-        try:
-            return self[name]
-        except IndexError:
-            raise AttributeError(
-                '%s object has not attribute %r' % (type(self).__name__, name))
+    def get_expected_local_path(self):
+        """ Return the local path, even if not created yet. """
+        if self.local_path:
+            return self.local_path
+        if self.local_parent_path is None or not self.remote_name:
+            return None
+        return path_join(self.local_parent_path, self.remote_name)
 
     def is_readonly(self):
         if self.folderish:
@@ -112,6 +387,96 @@ class StateRow(sqlite3.Row):
             self.remote_state = remote_state
 
 
+class StateRow(BaseStateRow, sqlite3.Row):
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except IndexError:
+            raise AttributeError(
+                '%s object has not attribute %r' % (type(self).__name__, name))
+
+
+STATE_COLUMNS = (
+    'id', 'last_local_updated', 'last_remote_updated', 'local_digest',
+    'remote_digest', 'local_path', 'remote_ref', 'local_parent_path',
+    'remote_parent_ref', 'remote_parent_path', 'local_name', 'remote_name',
+    'size', 'folderish', 'local_state', 'remote_state', 'pair_state',
+    'remote_can_rename', 'remote_can_delete', 'remote_can_update',
+    'remote_can_create_child', 'last_remote_modifier', 'last_sync_date',
+    'error_count', 'last_sync_error_date', 'last_error', 'last_error_details',
+    'version', 'processor', 'last_transfer',
+)
+
+
+class SlottedStateRow(BaseStateRow):
+    """
+    Compact state row: the values are copied once into slots, making the
+    attribute access much cheaper than with StateRow.
+    Rows of queries not on the States columns are still created as StateRow.
+    """
+
+    # error_next_try is set by the QueueManager on the rows in error
+    __slots__ = STATE_COLUMNS + ('error_next_try', '_columns')
+
+    _known_columns = frozenset(STATE_COLUMNS)
+    # Setters by columns, and the last cursor description seen with its setter
+    _setters = dict()
+    _description = (None, None)
+
+    def __new__(cls, cursor=None, row=None):
+        self = super(SlottedStateRow, cls).__new__(cls)
+        if cursor is None:
+            # Used by copy and pickle
+            return self
+        setter = cls._get_setter(cursor.description)
+        if setter is None:
+            return StateRow(cursor, row)
+        setter(self, row)
+        return self
+
+    @classmethod
+    def _get_setter(cls, description):
+        # The description is the same object for all the rows of a query
+        last_description, setter = cls._description
+        if description is not last_description:
+            columns = tuple(column[0] for column in description)
+            setter = cls._setters.get(columns)
+            if setter is None and cls._known_columns.issuperset(columns):
+                setter = cls._setters[columns] = cls._create_setter(columns)
+            cls._description = (description, setter)
+        return setter
+
+    @staticmethod
+    def _create_setter(columns):
+        """
+        Compile the assignment of a row to the slots, at once, as calling
+        setattr() for each column would cost more than the sqlite3.Row.
+        """
+        targets = ''.join('self.' + name + ', ' for name in columns)
+        namespace = dict(columns=columns)
+        exec ('def setter(self, row):\n'
+              '    self._columns = columns\n'
+              '    ' + targets + '= row\n') in namespace
+        return namespace['setter']
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            if key not in self._columns:
+                raise IndexError('No item with that key')
+            return getattr(self, key)
+        return getattr(self, self._columns[key])
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def keys(self):
+        return list(self._columns)
+
+
 class LogLock(object):
     def __init__(self):
         self._lock = RLock()
@@ -126,6 +491,183 @@ class LogLock(object):
         self._lock.release()
 
 
+class ProfiledLock(object):
+    """ DAO lock recording how long each DAO method waited for it. """
+
+    def __init__(self, profiler):
+        self._lock = RLock()
+        self._profiler = profiler
+
+    def acquire(self):
+        if self._lock.acquire(False):
+            return
+        start = time()
+        self._lock.acquire()
+        self._profiler.record_lock_wait(sys._getframe(1).f_code.co_name,
+                                        time() - start)
+
+    def release(self):
+        self._lock.release()
+
+
+class Timings(object):
+    """ Count, total and percentiles of the last durations recorded. """
+
+    SAMPLES = 1000
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self._samples = []
+
+    def add(self, duration):
+        if self.count < self.SAMPLES:
+            self._samples.append(duration)
+        else:
+            self._samples[self.count % self.SAMPLES] = duration
+        self.count += 1
+        self.total += duration
+
+    def get_metrics(self):
+        samples = sorted(self._samples)
+        return {
+            'count': self.count,
+            'total': self.total,
+            'p50': samples[len(samples) // 2],
+            'p99': samples[len(samples) * 99 // 100],
+        }
+
+
+class QueryProfiler(object):
+    """
+    Per statement template timings and rows of the DAO connections, and
+    time spent waiting for the DAO lock per method.
+    Literals are replaced by ? in the templates.
+    """
+
+    LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+    def __init__(self):
+        self._lock = Lock()
+        self._queries = dict()
+        self._rows = dict()
+        self._lock_waits = dict()
+
+    def record(self, query, duration, rows):
+        template = ' '.join(self.LITERALS.sub('?', query).split())
+        with self._lock:
+            timings = self._queries.get(template)
+            if timings is None:
+                timings = self._queries[template] = Timings()
+                self._rows[template] = 0
+            timings.add(duration)
+            self._rows[template] += rows
+
+    def record_lock_wait(self, name, duration):
+        with self._lock:
+            timings = self._lock_waits.get(name)
+            if timings is None:
+                timings = self._lock_waits[name] = Timings()
+            timings.add(duration)
+
+    def get_profile(self):
+        with self._lock:
+            queries = dict()
+            for template, timings in self._queries.iteritems():
+                queries[template] = timings.get_metrics()
+                queries[template]['rows'] = self._rows[template]
+            lock_waits = dict((name, timings.get_metrics())
+                              for name, timings in self._lock_waits.iteritems())
+        return {'queries': queries, 'lock_waits': lock_waits}
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of read connections.  A thread checks out a connection for
+    its first read and checks it in when it is disposed, so the connection
+    and its statements cache are reused by the next thread.
+    When the pool is exhausted, a thread waits up to `timeout` seconds, then
+    gets an extra connection closed on checkin.
+    """
+
+    def __init__(self, connect, size=10, timeout=2):
+        self._connect = connect
+        self._size = size
+        self._timeout = timeout
+        self._idle = []
+        # Connections checked out, and the thread owning them
+        self._owners = dict()
+        self._condition = Condition()
+        self.created = 0
+        self.waits = 0
+        self.wait_time = 0
+        self.overflows = 0
+
+    def checkout(self):
+        with self._condition:
+            if not self._idle and len(self._owners) >= self._size:
+                self._reclaim()
+            if not self._idle and len(self._owners) >= self._size:
+                self.waits += 1
+                start = time()
+                deadline = start + self._timeout
+                while not self._idle and len(self._owners) >= self._size:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                self.wait_time += time() - start
+            if self._idle:
+                con = self._idle.pop()
+                self._owners[con] = current_thread()
+                return con
+            if len(self._owners) >= self._size:
+                log.debug('Connection pool exhausted, opening an extra connection')
+                self.overflows += 1
+            self.created += 1
+        con = self._connect()
+        with self._condition:
+            self._owners[con] = current_thread()
+        return con
+
+    def checkin(self, con):
+        with self._condition:
+            if self._owners.pop(con, None) is None:
+                return
+            if len(self._owners) + len(self._idle) < self._size:
+                self._idle.append(con)
+                self._condition.notify()
+                return
+        con.close()
+
+    def _reclaim(self):
+        # Threads that ended without being disposed
+        for con, thread in self._owners.items():
+            if not thread.is_alive():
+                del self._owners[con]
+                self._idle.append(con)
+
+    def close(self):
+        with self._condition:
+            connections = self._idle + list(self._owners)
+            self._idle = []
+            self._owners.clear()
+        for con in connections:
+            con.close()
+
+    def get_metrics(self):
+        with self._condition:
+            return {
+                'pool_size': self._size,
+                'pool_idle': len(self._idle),
+                'pool_used': len(self._owners),
+                'pool_created': self.created,
+                'pool_waits': self.waits,
+                'pool_wait_time': self.wait_time,
+                'pool_overflows': self.overflows,
+            }
+
+
 class FakeLock(object):
     def acquire(self):
         pass
@@ -136,11 +678,27 @@ class FakeLock(object):
 
 class ConfigurationDAO(QObject):
 
-    def __init__(self, db):
+    def __init__(self, db, group_commit=False, pool_size=10, cache_size=None,
+                 mmap_size=None, busy_timeout=5, profile=False):
         super(ConfigurationDAO, self).__init__()
         log.debug('Create DAO on %r', db)
         self._db = db
         migrate = os.path.exists(self._db)
+        # WAL journal and commits grouped by a dedicated writer thread
+        self._group_commit = group_commit
+        self._committer = None
+        # Page cache (in pages, or in KiB if negative) and memory-mapped I/O
+        # sizes of each connection, SQLite defaults if None
+        self._cache_size = cache_size
+        self._mmap_size = mmap_size
+        # Seconds a statement waits on a lock before being retried
+        self._busy_timeout = busy_timeout
+        self._lock_stats = LockWaitStats()
+        # Statements and lock waits profiling, no overhead if disabled
+        self._profiler = QueryProfiler() if profile else None
+        # Write-through copy of the Configuration table, loaded on first use
+        self._config = None
+        self._pool = ConnectionPool(self._connect, size=pool_size)
         # For testing purpose only should always be True
         self.share_connection = True
         self.auto_commit = True
@@ -148,7 +706,9 @@ class ConfigurationDAO(QObject):
         self.in_tx = None
         self._tx_lock = RLock()
         # If we dont share connection no need to lock
-        if self.share_connection:
+        if self.share_connection and self._profiler is not None:
+            self._lock = ProfiledLock(self._profiler)
+        elif self.share_connection:
             self._lock = RLock()
         else:
             self._lock = FakeLock()
@@ -170,6 +730,10 @@ class ConfigurationDAO(QObject):
             c.execute("INSERT INTO Configuration(name,value) VALUES(?,?)", (SCHEMA_VERSION, self.schema_version))
         self._conn.commit()
         self._conns = local()
+        if self._group_commit:
+            self._committer = GroupCommitter(self)
+            self._conn.committer = self._committer
+            self._committer.start()
         # FOR PYTHON 3.3...
         # if log.getEffectiveLevel() < 6:
         #    self._conn.set_trace_callback(self._log_trace)
@@ -214,8 +778,12 @@ class ConfigurationDAO(QObject):
             self.update_config(SCHEMA_VERSION, 1)
 
     def _init_db(self, cursor):
-        # http://www.stevemcarthur.co.uk/blog/post/some-kind-of-disk-io-error-occurred-sqlite
-        cursor.execute("PRAGMA journal_mode = MEMORY")
+        if self._group_commit:
+            # Readers do not block the writer, nor the writer the readers
+            cursor.execute("PRAGMA journal_mode = WAL")
+        else:
+            # http://www.stevemcarthur.co.uk/blog/post/some-kind-of-disk-io-error-occurred-sqlite
+            cursor.execute("PRAGMA journal_mode = MEMORY")
         self._create_configuration_table(cursor)
 
     def _create_configuration_table(self, cursor):
@@ -224,26 +792,150 @@ class ConfigurationDAO(QObject):
     def _create_main_conn(self):
         log.debug('Create main connexion on %r (dir_exists=%r, file_exists=%r)',
                   self._db, os.path.exists(os.path.dirname(self._db)), os.path.exists(self._db))
-        self._conn = AutoRetryConnection(self._db, check_same_thread=False)
+        if self._group_commit:
+            self._conn = self._connect(GroupCommitConnection)
+            self._conn.committer = self._committer
+            # In WAL mode, only checkpoints need to be synced to disk
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+        else:
+            self._conn = self._connect()
         self._connections.append(self._conn)
 
+    def _connect(self, factory=AutoRetryConnection):
+        # Dont check same thread for closing purpose
+        con = factory(self._db, check_same_thread=False,
+                      timeout=self._busy_timeout,
+                      cached_statements=CACHED_STATEMENTS)
+        con.lock_stats = self._lock_stats
+        con.profiler = self._profiler
+        if self._cache_size is not None:
+            con.execute("PRAGMA cache_size = %d" % self._cache_size)
+        if self._mmap_size is not None:
+            con.execute("PRAGMA mmap_size = %d" % self._mmap_size)
+        return con
+
     def _log_trace(self, query):
         log.trace(query)
 
     def dispose(self):
         log.debug('Disposing SQLite database %r', self.get_db())
+        if self._committer is not None:
+            self._committer.stop()
+            self._committer = None
         for con in self._connections:
             con.close()
         self._connections = []
+        self._pool.close()
         self._conn = None
 
     def dispose_thread(self):
-        if not hasattr(self._conns, '_conn'):
+        if getattr(self._conns, '_conn', None) is None:
             return
-        if self._conns._conn in self._connections:
-            self._connections.remove(self._conns._conn)
+        self._pool.checkin(self._conns._conn)
         self._conns._conn = None
 
+    def get_metrics(self):
+        metrics = self._pool.get_metrics()
+        metrics.update(self._lock_stats.get_metrics())
+        metrics['reclaimable_size'] = self.get_reclaimable_size()
+        if self._committer is not None:
+            metrics.update(self._committer.get_metrics())
+        return metrics
+
+    def get_profile(self):
+        """
+        Return the statements and lock waits profile, None if profiling is
+        disabled.  Durations are in seconds.
+        """
+        if self._profiler is None:
+            return None
+        return self._profiler.get_profile()
+
+    def snapshot(self, path, rows=1000):
+        """
+        Copy the database to path without blocking the other threads.
+        In WAL mode the copy is done in one read transaction, which does not
+        block the writers.  Otherwise the DAO lock is only held to read each
+        slice of rows, and the copy is restarted holding the lock for all
+        the slices if something was written meanwhile.
+        Python 2 sqlite3 has no binding for the online backup API.
+        """
+        self.flush()
+        source = sqlite3.connect(self._db, isolation_level=None,
+                                 timeout=self._busy_timeout)
+        target = sqlite3.connect(path)
+        try:
+            if self._group_commit:
+                source.execute("BEGIN")
+            schema = source.execute(
+                "SELECT type, name, sql FROM sqlite_master"
+                " WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'"
+            ).fetchall()
+            tables = [name for type_, name, _ in schema if type_ == 'table']
+            for type_, _, sql in schema:
+                if type_ == 'table':
+                    target.execute(sql)
+            if not self._copy_tables(source, target, tables, rows):
+                log.debug('Database %r changed during its snapshot,'
+                          ' copy it again holding the lock', self._db)
+                for name in tables:
+                    target.execute('DELETE FROM "%s"' % name)
+                self._lock.acquire()
+                try:
+                    self._copy_tables(source, target, tables, rows)
+                finally:
+                    self._lock.release()
+            # Indexes and triggers once the rows are copied
+            for type_, _, sql in schema:
+                if type_ != 'table':
+                    target.execute(sql)
+            target.commit()
+        finally:
+            source.close()
+            target.close()
+
+    def _copy_tables(self, source, target, tables, rows):
+        """
+        Copy the rows of the tables by slices, return False as soon as a
+        write is committed between two slices, as the copy is inconsistent.
+        """
+        version = None
+        for name in tables:
+            columns = [column[1] for column in
+                       source.execute('PRAGMA table_info("%s")' % name)]
+            select = ('SELECT rowid, * FROM "%s" WHERE rowid > ?'
+                      ' ORDER BY rowid LIMIT %d' % (name, rows))
+            insert = 'INSERT INTO "%s"(%s) VALUES(%s)' % (
+                name, ', '.join('"%s"' % column for column in columns),
+                ', '.join('?' * len(columns)))
+            last = -2 ** 63
+            while True:
+                if not self._group_commit:
+                    self._lock.acquire()
+                try:
+                    batch = source.execute(select, (last,)).fetchall()
+                    # Changed by the commits of the other connections
+                    current = source.execute(
+                        'PRAGMA data_version').fetchone()[0]
+                finally:
+                    if not self._group_commit:
+                        self._lock.release()
+                if version is None:
+                    version = current
+                elif current != version:
+                    return False
+                if not batch:
+                    break
+                target.executemany(insert, (row[1:] for row in batch))
+                last = batch[-1][0]
+        return True
+
+    def get_reclaimable_size(self):
+        """ Size of the free pages, that a vacuum gives back to the disk. """
+        c = self._get_read_connection().cursor()
+        pages = c.execute('PRAGMA freelist_count').fetchone()[0]
+        return pages * c.execute('PRAGMA page_size').fetchone()[0]
+
     def _get_write_connection(self, factory=StateRow):
         if self.share_connection or self.in_tx:
             if self._conn is None:
@@ -264,9 +956,7 @@ class ConfigurationDAO(QObject):
                 # Return the write connection
                 return self._conn
         if not hasattr(self._conns, '_conn') or self._conns._conn is None:
-            # Dont check same thread for closing purpose
-            self._conns._conn = AutoRetryConnection(self._db, check_same_thread=False)
-            self._connections.append(self._conns._conn)
+            self._conns._conn = self._pool.checkout()
         self._conns._conn.row_factory = factory
             # Python3.3 feature
             #if log.getEffectiveLevel() < 6:
@@ -283,6 +973,7 @@ class ConfigurationDAO(QObject):
         self._lock.acquire()
         self._get_write_connection().commit()
         self._lock.release()
+        self.flush()
         self._tx_lock.release()
         self.in_tx = None
 
@@ -295,8 +986,18 @@ class ConfigurationDAO(QObject):
         finally:
             self._lock.release()
 
+    def flush(self):
+        """
+        Return once the writes done so far are committed.
+        Only needed with group commit, else every write is already committed.
+        """
+        if self._committer is not None:
+            self._committer.flush()
+
     def _delete_config(self, cursor, name):
         cursor.execute("DELETE FROM Configuration WHERE name=?", (name,))
+        if self._config is not None:
+            self._config.pop(name, None)
 
     def delete_config(self, name):
         self._lock.acquire()
@@ -310,26 +1011,69 @@ class ConfigurationDAO(QObject):
             self._lock.release()
 
     def update_config(self, name, value):
+        self.update_configs({name: value})
+
+    def update_configs(self, values):
+        """
+        Update several keys in one transaction, a None value deletes the key.
+        """
+        updates = [(name, value) for name, value in values.iteritems()
+                   if value is not None]
+        deletes = [(name,) for name, value in values.iteritems()
+                   if value is None]
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            if value is not None:
-                c.execute("UPDATE OR IGNORE Configuration SET value=? WHERE name=?", (value,name))
-                c.execute("INSERT OR IGNORE INTO Configuration(value,name) VALUES(?,?)", (value,name))
-            else:
-                c.execute("DELETE FROM Configuration WHERE name=?", (name,))
+            if updates:
+                c.executemany("INSERT OR REPLACE INTO Configuration(name, value)"
+                              " VALUES(?, ?)", updates)
+            if deletes:
+                c.executemany("DELETE FROM Configuration WHERE name=?", deletes)
             if self.auto_commit:
                 con.commit()
+            for name, value in values.iteritems():
+                if self._config is None:
+                    # Not loaded yet, or dropped by a value it cannot cache
+                    break
+                self._cache_config(name, value)
         finally:
             self._lock.release()
 
+    def _cache_config(self, name, value):
+        # Cache the value as it is read back from the database: the value
+        # column has a text affinity
+        adapter = sqlite3.adapters.get((type(value), sqlite3.PrepareProtocol))
+        if adapter is not None:
+            value = adapter(value)
+        if value is None:
+            self._config.pop(name, None)
+        elif isinstance(value, (bool, int, long)):
+            self._config[name] = unicode(int(value))
+        elif isinstance(value, str):
+            self._config[name] = value.decode('utf-8')
+        elif isinstance(value, unicode):
+            self._config[name] = value
+        else:
+            # Let SQLite do the conversion, the key is read on next use
+            self._config = None
+
+    def _get_config_cache(self):
+        config = self._config
+        if config is None:
+            self._lock.acquire()
+            try:
+                if self._config is None:
+                    c = self._get_read_connection().cursor()
+                    self._config = dict(tuple(row) for row in c.execute(
+                        "SELECT name, value FROM Configuration"))
+                config = self._config
+            finally:
+                self._lock.release()
+        return config
+
     def get_config(self, name, default=None):
-        c = self._get_read_connection().cursor()
-        obj = c.execute("SELECT value FROM Configuration WHERE name=?",(name,)).fetchone()
-        if obj is None:
-            return default
-        return obj.value
+        return self._get_config_cache().get(name, default)
 
 
 class ManagerDAO(ConfigurationDAO):
@@ -499,18 +1243,30 @@ class ManagerDAO(ConfigurationDAO):
 class EngineDAO(ConfigurationDAO):
     newConflict = pyqtSignal(object)
 
-    def __init__(self, db, state_factory=StateRow):
+    # Scanned paths are written to RemoteScan by this count or delay
+    SCANNED_CHECKPOINT_SIZE = 500
+    SCANNED_CHECKPOINT_DELAY = 10
+
+    def __init__(self, db, state_factory=StateRow, **kwargs):
         self._filters = None
         self._queue_manager = None
-        super(EngineDAO, self).__init__(db)
+        self._queue_seek = None
+        # Rows being processed: row id -> thread id, and the reverse
+        self._claims = dict()
+        self._claimed = dict()
+        self._claims_lock = Lock()
+        # Remote paths scanned, loaded from RemoteScan on first use, and
+        # the ones not checkpointed yet
+        self._scanned = None
+        self._scanned_pending = []
+        self._scanned_checkpoint = time()
+        super(EngineDAO, self).__init__(db, **kwargs)
         self._state_factory = state_factory
-        self._filters = self.get_filters()
-        self._items_count = None
-        self._items_count = self.get_syncing_count()
+        self._filters = self._get_filters_trie()
         self.reinit_processors()
 
     def get_schema_version(self):
-        return 3
+        return 7
 
     def _migrate_state(self, cursor):
         try:
@@ -519,6 +1275,9 @@ class EngineDAO(ConfigurationDAO):
             # If we cannot smoothly migrate harder migration
             cursor.execute("DROP TABLE if exists StatesMigration")
             self._reinit_states(cursor)
+        # Indexes followed the renamed table and were dropped with it
+        self._create_state_indexes(cursor)
+        self._create_state_counters(cursor)
 
     def _migrate_db(self, cursor, version):
         if version < 1:
@@ -532,6 +1291,24 @@ class EngineDAO(ConfigurationDAO):
         if version < 3:
             self._migrate_state(cursor)
             self.update_config(SCHEMA_VERSION, 3)
+        if version < 4:
+            self._create_state_indexes(cursor)
+            self.update_config(SCHEMA_VERSION, 4)
+        if version < 5:
+            self._rebuild_counters(cursor)
+            self.update_config(SCHEMA_VERSION, 5)
+        if version < 6:
+            self._create_state_indexes(cursor)
+            self.update_config(SCHEMA_VERSION, 6)
+        if version < 7:
+            # Changing the vacuum mode of a database requires a full VACUUM,
+            # which cannot run inside a transaction
+            cursor.connection.commit()
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            log.trace('Vacuum SQLite')
+            cursor.execute("VACUUM")
+            log.trace('Vacuum SQLite finished')
+            self.update_config(SCHEMA_VERSION, 7)
 
     def _reinit_database(self):
         self.reinit_states()
@@ -557,8 +1334,100 @@ class EngineDAO(ConfigurationDAO):
           + "remote_can_create_child INTEGER, last_remote_modifier VARCHAR,"
           + "last_sync_date TIMESTAMP, error_count INTEGER DEFAULT (0), last_sync_error_date TIMESTAMP, last_error VARCHAR, last_error_details TEXT, version INTEGER DEFAULT (0), processor INTEGER DEFAULT (0), last_transfer VARCHAR, PRIMARY KEY (id),"
           +  "UNIQUE(remote_ref, remote_parent_ref), UNIQUE(remote_ref, local_path));")
+        EngineDAO._create_state_indexes(cursor)
+        EngineDAO._create_state_counters(cursor, force)
+
+    @staticmethod
+    def _create_state_indexes(cursor):
+        # remote_ref lookups are already covered by the UNIQUE constraints
+        indexes = {
+            'idx_states_local_path': 'local_path',
+            'idx_states_local_parent_path': 'local_parent_path',
+            'idx_states_remote_parent_ref': 'remote_parent_ref, remote_name',
+            'idx_states_remote_parent_path': 'remote_parent_path',
+            # Also serves the "last synchronized files" ordering
+            'idx_states_pair_state': 'pair_state, folderish, last_sync_date',
+            'idx_states_remote_digest': 'remote_digest',
+            'idx_states_error_count': 'error_count',
+            'idx_states_last_sync_date': 'last_sync_date',
+        }
+        for name, columns in sorted(indexes.items()):
+            cursor.execute("CREATE INDEX if not exists " + name + " ON States(" + columns + ")")
+
+    @staticmethod
+    def _create_state_counters(cursor, force=False):
+        """
+        Maintain the States statistics by triggers so the metrics do not
+        have to scan the whole table.
+        The key columns are compared with IS as they can be NULL, and rows
+        are removed once they do not count anything anymore.
+        """
+        cursor.execute("CREATE TABLE if not exists StatesCounters(pair_state VARCHAR, folderish INTEGER,"
+                       " error_count INTEGER, count INTEGER NOT NULL DEFAULT (0), size INTEGER NOT NULL DEFAULT (0))")
+        if force:
+            # The States table is recreated: previous triggers were either
+            # dropped with it or belong to the table being migrated
+            cursor.execute("DELETE FROM StatesCounters")
+            for trigger in ('insert', 'update', 'delete'):
+                cursor.execute("DROP TRIGGER if exists states_counters_" + trigger)
+        add = ("INSERT INTO StatesCounters(pair_state, folderish, error_count)"
+               " SELECT NEW.pair_state, NEW.folderish, NEW.error_count WHERE NOT EXISTS("
+               "SELECT 1 FROM StatesCounters WHERE pair_state IS NEW.pair_state"
+               " AND folderish IS NEW.folderish AND error_count IS NEW.error_count);"
+               " UPDATE StatesCounters SET count = count + 1, size = size + IFNULL(NEW.size, 0)"
+               " WHERE pair_state IS NEW.pair_state AND folderish IS NEW.folderish"
+               " AND error_count IS NEW.error_count;")
+        remove = ("UPDATE StatesCounters SET count = count - 1, size = size - IFNULL(OLD.size, 0)"
+                  " WHERE pair_state IS OLD.pair_state AND folderish IS OLD.folderish"
+                  " AND error_count IS OLD.error_count;"
+                  " DELETE FROM StatesCounters WHERE count = 0;")
+        cursor.execute("CREATE TRIGGER if not exists states_counters_insert AFTER INSERT ON States"
+                       " BEGIN " + add + " END")
+        cursor.execute("CREATE TRIGGER if not exists states_counters_update"
+                       " AFTER UPDATE OF pair_state, folderish, error_count, size ON States"
+                       " BEGIN " + remove + " " + add + " END")
+        cursor.execute("CREATE TRIGGER if not exists states_counters_delete AFTER DELETE ON States"
+                       " BEGIN " + remove + " END")
+
+    @staticmethod
+    def _rebuild_counters(cursor):
+        cursor.execute("DELETE FROM StatesCounters")
+        cursor.execute("INSERT INTO StatesCounters(pair_state, folderish, error_count, count, size)"
+                       " SELECT pair_state, folderish, error_count, COUNT(*), IFNULL(SUM(size), 0)"
+                       "   FROM States"
+                       "  GROUP BY pair_state, folderish, error_count")
+
+    def check_counters(self, rebuild=False):
+        """
+        Compare the StatesCounters table with the actual States content.
+        Return True if they are consistent, otherwise the counters are
+        rebuilt if asked to.
+        """
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            expected = c.execute("SELECT pair_state, folderish, error_count, COUNT(*), IFNULL(SUM(size), 0)"
+                                 "  FROM States"
+                                 " GROUP BY pair_state, folderish, error_count").fetchall()
+            actual = c.execute("SELECT pair_state, folderish, error_count, count, size"
+                               "  FROM StatesCounters").fetchall()
+            consistent = sorted(map(tuple, expected)) == sorted(map(tuple, actual))
+            if not consistent:
+                log.warning('States counters are inconsistent')
+                if rebuild:
+                    self._rebuild_counters(c)
+                    if self.auto_commit:
+                        con.commit()
+                    log.info('States counters rebuilt')
+            return consistent
+        finally:
+            self._lock.release()
 
     def _init_db(self, cursor):
+        # Only effective before the first table is created, free pages are
+        # then given back to the disk by incremental_vacuum()
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
         super(EngineDAO, self)._init_db(cursor)
         cursor.execute("CREATE TABLE if not exists Filters(path STRING NOT NULL, PRIMARY KEY(path))")
         cursor.execute("CREATE TABLE if not exists RemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
@@ -570,55 +1439,72 @@ class EngineDAO(ConfigurationDAO):
             factory = self._state_factory
         return super(EngineDAO, self)._get_read_connection(factory)
 
+    @traced('db')
     def acquire_state(self, thread_id, row_id):
         if self.acquire_processor(thread_id, row_id):
-            # Avoid any lock for this call by using the write connection
             try:
-                return self.get_state_from_id(row_id, from_write=True)
+                # The row can be queued before its group of writes is committed
+                state = self.get_state_from_id(row_id, from_write=True)
             except:
                 self.release_processor(thread_id)
                 raise
+            if state is None:
+                log.trace("Couldn't acquire processor %d for row %d: row doesn't exist",
+                          thread_id, row_id)
+                self.release_processor(thread_id)
+            return state
         raise sqlite3.OperationalError("Cannot acquire")
 
+    @traced('db')
     def release_state(self, thread_id):
         self.release_processor(thread_id)
 
     def release_processor(self, processor_id):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            # TO_REVIEW Might go back to primary key id
-            c.execute("UPDATE States SET processor=0 WHERE processor=?", (processor_id,))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
-        res = c.rowcount > 0
-        if res:
+        with self._claims_lock:
+            row_ids = self._claimed.pop(processor_id, ())
+            for row_id in row_ids:
+                del self._claims[row_id]
+        if row_ids:
             log.trace('Released processor %d', processor_id)
         else:
             log.trace('No processor to release with id %d', processor_id)
-        return res
+        return bool(row_ids)
 
     def acquire_processor(self, thread_id, row_id):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET processor=? WHERE id=? AND (processor=0 OR processor=?)", (thread_id, row_id, thread_id))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
-        res = c.rowcount == 1
+        """
+        Claim a row for a processor thread.  Claims are only kept in memory,
+        they do not survive the DAO: the processor column is not used anymore.
+        """
+        with self._claims_lock:
+            owner = self._claims.setdefault(row_id, thread_id)
+            res = owner == thread_id
+            if res:
+                self._claimed.setdefault(thread_id, set()).add(row_id)
         if res:
             log.trace('Acquired processor %d for row %d', thread_id, row_id)
         else:
-            log.trace("Couldn't acquire processor %d for row %d: either row does't exist or it is being processed",
-                      thread_id, row_id)
+            log.trace("Couldn't acquire processor %d for row %d: it is being processed by %d",
+                      thread_id, row_id, owner)
         return res
 
+    def get_processor(self, row_id):
+        """ Return the id of the thread processing a row, 0 if there is none. """
+        return self._claims.get(row_id, 0)
+
+    def _release_row(self, row_id):
+        with self._claims_lock:
+            thread_id = self._claims.pop(row_id, None)
+            if thread_id is not None:
+                row_ids = self._claimed[thread_id]
+                row_ids.discard(row_id)
+                if not row_ids:
+                    del self._claimed[thread_id]
+
+    def dispose(self):
+        if self._conn is not None:
+            self.checkpoint_scanned()
+        super(EngineDAO, self).dispose()
+
     def _reinit_states(self, cursor):
         cursor.execute("DROP TABLE States")
         self._create_state_table(cursor, force=True)
@@ -635,24 +1521,38 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             self._reinit_states(c)
             con.commit()
-            log.trace('Vacuum SQLite')
-            con.execute('VACUUM')
-            log.trace('Vacuum SQLite finished')
         finally:
             self._lock.release()
 
     def reinit_processors(self):
+        with self._claims_lock:
+            self._claims.clear()
+            self._claimed.clear()
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("UPDATE States SET processor=0")
+            # Rows claimed by a previous version
+            c.execute("UPDATE States SET processor=0 WHERE processor != 0")
             c.execute("UPDATE States SET error_count=0, last_sync_error_date=NULL, last_error = NULL WHERE pair_state='synchronized'")
             if self.auto_commit:
                 con.commit()
-            log.trace('Vacuum SQLite')
-            con.execute('VACUUM')
-            log.trace('Vacuum SQLite finished')
+        finally:
+            self._lock.release()
+
+    def incremental_vacuum(self, pages=256):
+        """
+        Give back up to `pages` free pages to the disk, the lock is held
+        only for this slice.  Return the number of free pages left.
+        """
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("PRAGMA incremental_vacuum(%d)" % pages).fetchall()
+            if self.auto_commit:
+                con.commit()
+            return c.execute("PRAGMA freelist_count").fetchone()[0]
         finally:
             self._lock.release()
 
@@ -664,9 +1564,10 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET remote_state='deleted', pair_state=?"
             c.execute(update + " WHERE id=?", ('remotely_deleted', doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_remote_condition(doc_pair), ('parent_remotely_deleted',))
+                condition, params = self._get_recursive_remote_condition(doc_pair)
+                c.execute(update + condition, ('parent_remotely_deleted',) + params)
             # Only queue parent
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted')
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted', pair=doc_pair)
             if self.auto_commit:
                 con.commit()
         finally:
@@ -687,7 +1588,8 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET local_state='deleted', pair_state=?"
             c.execute(update + " WHERE id=?", (current_state, doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair), ('parent_locally_deleted',))
+                condition, params = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, ('parent_locally_deleted',) + params)
             if self.auto_commit:
                 con.commit()
         finally:
@@ -695,31 +1597,72 @@ class EngineDAO(ConfigurationDAO):
             self._queue_manager.interrupt_processors_on(doc_pair.local_path, exact_match=False)
             # Only queue parent
             if current_state is not None and current_state == "locally_deleted":
-                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state)
+                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state, pair=doc_pair)
 
     def insert_local_state(self, info, parent_path):
+        return self.insert_local_states([info], parent_path)[0]
+
+    def insert_local_states(self, infos, parent_path):
+        """
+        Insert the local states of several children of the same folder
+        in one transaction. Return the ids of the new rows, in the same
+        order as infos.
+        """
+        if not infos:
+            return []
         pair_state = PAIR_STATES.get(('created', 'unknown'))
-        digest = info.get_digest()
+        params = [(info.last_modification_time, info.get_digest(), info.path,
+                   parent_path, os.path.basename(info.path), info.folderish,
+                   info.size, pair_state)
+                  for info in infos]
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            name = os.path.basename(info.path)
-            c.execute("INSERT INTO States(last_local_updated, local_digest, "
-                      + "local_path, local_parent_path, local_name, folderish, size, local_state, remote_state, pair_state)"
-                      + " VALUES(?,?,?,?,?,?,?,'created','unknown',?)", (info.last_modification_time, digest, info.path,
-                                                    parent_path, name, info.folderish, info.size, pair_state))
-            row_id = c.lastrowid
-            parent = c.execute("SELECT * FROM States WHERE local_path=?", (parent_path,)).fetchone()
-            # Dont queue if parent is not yet created
-            if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
-            if self.auto_commit:
-                con.commit()
-            self._items_count = self._items_count + 1
+            row_ids = self._insert_states(
+                c, "INSERT INTO States(last_local_updated, local_digest, "
+                   + "local_path, local_parent_path, local_name, folderish, size, local_state, remote_state, pair_state)"
+                   + " VALUES(?,?,?,?,?,?,?,'created','unknown',?)", params)
+            try:
+                parent = c.execute("SELECT * FROM States WHERE local_path=?", (parent_path,)).fetchone()
+                # Dont queue if parent is not yet created
+                if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
+                    self._queue_pair_states([(row_id, info.folderish, pair_state, info.path, info.size)
+                                             for row_id, info in zip(row_ids, infos)])
+                if self.auto_commit:
+                    con.commit()
+            except:
+                # Do not keep the rows, callers can retry row by row
+                c.execute("DELETE FROM States WHERE id >= ?", (row_ids[0],))
+                raise
         finally:
             self._lock.release()
-        return row_id
+        return row_ids
+
+    @staticmethod
+    def _insert_states(cursor, query, params):
+        """
+        Insert all the rows at once, the lock must be held.
+        Return their ids, in the same order as params.
+        """
+        # New rows always get an id greater than the current ones
+        last_id = cursor.execute("SELECT IFNULL(MAX(id), 0) FROM States").fetchone()[0]
+        try:
+            cursor.executemany(query, params)
+        except:
+            # Do not keep half of the batch, callers can retry row by row
+            cursor.execute("DELETE FROM States WHERE id > ?", (last_id,))
+            raise
+        return [row[0] for row in cursor.execute(
+            "SELECT id FROM States WHERE id > ? ORDER BY id", (last_id,))]
+
+    @staticmethod
+    def _get_parent_states(cursor, remote_refs, parents):
+        """ Complete the parents mapping remote_ref -> pair_state. """
+        for remote_ref in set(remote_refs).difference(parents):
+            parent = cursor.execute("SELECT pair_state FROM States WHERE remote_ref=?", (remote_ref,)).fetchone()
+            parents[remote_ref] = parent.pair_state if parent is not None else None
+        return parents
 
     def get_last_files(self, number, direction=''):
         c = self._get_read_connection(factory=self._state_factory).cursor()
@@ -740,23 +1683,51 @@ class EngineDAO(ConfigurationDAO):
         return "pair_state != 'synchronized' AND pair_state != 'unsynchronized'"
 
     def register_queue_manager(self, manager):
-        # Prevent any update while init queue
+        """
+        Rebuild the queue of the manager from the rows to synchronize.
+        Only the first page is pushed: the QueueManager asks for the next
+        ones with queue_next_page() as its queue drains.
+        """
+        self._queue_manager = manager
+        # Id of the last row pushed, None once all the rows were pushed
+        self._queue_seek = 0
+        self.queue_next_page()
+
+    def is_queue_loaded(self):
+        return self._queue_seek is None
+
+    def queue_next_page(self, size=None):
+        """
+        Push the next rows to synchronize, by keyset pagination on the id.
+        The children of a folder to synchronize are not pushed, they are
+        queued once their parent is synchronized: the order of the pages
+        does not matter.  Return the number of rows pushed.
+        """
+        size = size or QUEUE_PAGE_SIZE
+        # Prevent any update while pushing the page
         self._lock.acquire()
         try:
-            self._queue_manager = manager
+            if self._queue_seek is None:
+                return 0
             con = self._get_write_connection(factory=self._state_factory)
             c = con.cursor()
-            # Order by path to be sure to process parents before childs
-            pairs = c.execute("SELECT * FROM States WHERE " + self._get_to_sync_condition() + " ORDER BY local_path ASC").fetchall()
-            folders = dict()
-            for pair in pairs:
-                # Add all the folders
-                if pair.folderish:
-                    folders[pair.local_path] = True
-                if pair.local_parent_path not in folders:
-                    self._queue_manager.push_ref(pair.id, pair.folderish, pair.pair_state)
-        # Dont block everything if queue manager fail
-        # TODO As the error should be fatal not sure we need this
+            pairs = c.execute(
+                "SELECT * FROM States"
+                " WHERE id > ? AND " + self._get_to_sync_condition() +
+                "   AND NOT EXISTS(SELECT 1 FROM States AS parent"
+                "                   WHERE parent.local_path = States.local_parent_path"
+                "                     AND parent.folderish = 1"
+                "                     AND " + self._get_to_sync_condition() + ")"
+                " ORDER BY id LIMIT ?", (self._queue_seek, size)).fetchall()
+            self._queue_seek = pairs[-1].id if len(pairs) == size else None
+            if pairs:
+                log.debug('Pushing %d rows to the queue, all loaded: %r',
+                          len(pairs), self._queue_seek is None)
+                self._queue_manager.push_refs([
+                    self._get_queue_ref(pair.id, pair.folderish,
+                                        pair.pair_state, pair)
+                    for pair in pairs])
+            return len(pairs)
         finally:
             self._lock.release()
 
@@ -768,13 +1739,43 @@ class EngineDAO(ConfigurationDAO):
                 self.newConflict.emit(row_id)
             else:
                 log.trace("Push to queue: %s, pair=%r", pair_state, pair)
-                self._queue_manager.push_ref(row_id, folderish, pair_state)
+                self._queue_manager.push_ref(
+                    *self._get_queue_ref(row_id, folderish, pair_state, pair))
         else:
             log.trace("Will not push pair: %s, pair=%r", pair_state, pair)
 
+    @staticmethod
+    def _get_queue_ref(row_id, folderish, pair_state, pair=None):
+        """ Return the QueueItem arguments, with the priority of the pair. """
+        if pair is None:
+            return row_id, folderish, pair_state
+        return (row_id, folderish, pair_state, pair.get_expected_local_path(),
+                pair.size, pair.error_count)
+
+    def _queue_pair_states(self, pairs):
+        """
+        Push several (row_id, folderish, pair_state[, path, size]) at once.
+        """
+        refs = []
+        for ref in pairs:
+            row_id, folderish, pair_state = ref[:3]
+            if (self._queue_manager is not None
+                    and pair_state not in ('synchronized', 'unsynchronized')):
+                if pair_state == 'conflicted':
+                    log.trace("Emit newConflict with: %r", row_id)
+                    self.newConflict.emit(row_id)
+                else:
+                    refs.append(ref)
+            else:
+                log.trace("Will not push pair: %s, id=%r", pair_state, row_id)
+        if refs:
+            log.trace("Push %d items to queue", len(refs))
+            self._queue_manager.push_refs(refs)
+
     def _get_pair_state(self, row):
         return PAIR_STATES.get((row.local_state, row.remote_state))
 
+    @traced('db')
     def update_last_transfer(self, row_id, transfer):
         self._lock.acquire()
         try:
@@ -786,11 +1787,13 @@ class EngineDAO(ConfigurationDAO):
         finally:
             self._lock.release()
 
+    @traced('db')
     def get_dedupe_pair(self, name, parent, row_id):
         c = self._get_read_connection(factory=self._state_factory).cursor()
         return c.execute("SELECT * FROM States WHERE id != ? AND local_name=? AND remote_parent_ref=?",
                                     (row_id, name, parent)).fetchone()
 
+    @traced('db')
     def remove_local_path(self, row_id):
         self._lock.acquire()
         try:
@@ -802,6 +1805,7 @@ class EngineDAO(ConfigurationDAO):
         finally:
             self._lock.release()
 
+    @traced('db')
     def update_local_state(self, row, info, versionned=True, queue=True):
         row.pair_state = self._get_pair_state(row)
         log.trace('Updating local state for row=%r with info=%r', row, info)
@@ -862,13 +1866,34 @@ class EngineDAO(ConfigurationDAO):
         c = self._get_read_connection(factory=self._state_factory).cursor()
         return c.execute("SELECT * FROM States WHERE remote_digest=? AND pair_state='synchronized'", (digest,)).fetchone()
 
+    def get_valid_duplicate_files(self, digest):
+        """
+        Return the synchronized files having this content, the most
+        recently synchronized first as they are the likeliest unchanged.
+        """
+        c = self._get_read_connection(factory=self._state_factory).cursor()
+        return c.execute("SELECT * FROM States WHERE remote_digest=? AND local_digest=remote_digest"
+                         " AND pair_state='synchronized' AND folderish=0"
+                         " ORDER BY last_sync_date DESC", (digest,)).fetchall()
+
     def get_remote_descendants(self, path):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_path LIKE ?", (path + '%',)).fetchall()
+        condition, params = self._get_prefix_condition('remote_parent_path', path)
+        return c.execute("SELECT * FROM States WHERE " + condition, params).fetchall()
 
     def get_remote_descendants_from_ref(self, ref):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_path LIKE ?", ('%' + ref + '%',)).fetchall()
+        paths = c.execute("SELECT DISTINCT remote_parent_path FROM States WHERE remote_ref=?", (ref,)).fetchall()
+        if not paths:
+            # Cannot locate the subtree without its root
+            return c.execute("SELECT * FROM States WHERE remote_parent_path LIKE ?", ('%' + ref + '%',)).fetchall()
+        descendants = dict()
+        for path in paths:
+            condition, params = self._get_subtree_condition(
+                'remote_parent_path', (path.remote_parent_path or '') + '/' + ref)
+            for row in c.execute("SELECT * FROM States WHERE " + condition, params):
+                descendants[row.id] = row
+        return [descendants[row_id] for row_id in sorted(descendants)]
 
     def get_remote_children(self, ref):
         c = self._get_read_connection(factory=self._state_factory).cursor()
@@ -879,21 +1904,17 @@ class EngineDAO(ConfigurationDAO):
         return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_state='created' AND local_state='unknown'", (ref,)).fetchall()
 
     def get_unsynchronized_count(self):
-        return self.get_count("pair_state='unsynchronized'")
+        return self._get_counter("pair_state='unsynchronized'")
 
     def get_conflict_count(self):
-        return self.get_count("pair_state='conflicted'")
+        return self._get_counter("pair_state='conflicted'")
 
     def get_error_count(self, threshold=3):
-        return self.get_count("error_count > " + str(threshold))
+        return self._get_counter("error_count > " + str(threshold))
 
     def get_syncing_count(self, threshold=3):
         query = "pair_state!='synchronized' AND pair_state!='conflicted' AND pair_state!='unsynchronized' AND error_count < " + str(threshold)
-        count = self.get_count(query)
-        if self._items_count is not None and count != self._items_count:
-            log.trace("Cache Syncing count incorrect should be %d was %d", count, self._items_count)
-            self._items_count = count
-        return count
+        return self._get_counter(query)
 
     def get_sync_count(self, filetype=None):
         query = "pair_state='synchronized'"
@@ -901,7 +1922,11 @@ class EngineDAO(ConfigurationDAO):
             query = query + " AND folderish=0"
         elif filetype == "folder":
             query = query + " AND folderish=1"
-        return self.get_count(query)
+        return self._get_counter(query)
+
+    def _get_counter(self, condition):
+        c = self._get_read_connection(factory=self._state_factory).cursor()
+        return c.execute("SELECT IFNULL(SUM(count), 0) as count FROM StatesCounters WHERE " + condition).fetchone().count
 
     def get_count(self, condition=None):
         query = "SELECT COUNT(*) as count FROM States"
@@ -912,7 +1937,7 @@ class EngineDAO(ConfigurationDAO):
 
     def get_global_size(self):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT SUM(size) as sum FROM States WHERE pair_state='synchronized'").fetchone().sum
+        return c.execute("SELECT SUM(size) as sum FROM StatesCounters WHERE pair_state='synchronized'").fetchone().sum
 
     def get_unsynchronizeds(self):
         c = self._get_read_connection(factory=self._state_factory).cursor()
@@ -930,15 +1955,31 @@ class EngineDAO(ConfigurationDAO):
         c = self._get_read_connection(factory=self._state_factory).cursor()
         return c.execute("SELECT * FROM States WHERE local_parent_path=?", (path,)).fetchall()
 
+    @traced('db')
+    def get_local_changes_count(self, path):
+        """
+        Return the number of children of the folder, and the number of
+        them locally changed and already known remotely.
+        """
+        c = self._get_read_connection(factory=self._state_factory).cursor()
+        row = c.execute("SELECT COUNT(*) as count,"
+                        "       IFNULL(SUM(remote_ref IS NOT NULL AND pair_state LIKE 'locally%'), 0) as changes"
+                        "  FROM States"
+                        " WHERE local_parent_path=?", (path,)).fetchone()
+        return row.count, row.changes
+
+    @traced('db')
     def get_states_from_partial_local(self, path):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE local_path LIKE ?", (path + '%',)).fetchall()
+        condition, params = self._get_prefix_condition('local_path', path)
+        return c.execute("SELECT * FROM States WHERE " + condition, params).fetchall()
 
     def get_first_state_from_partial_remote(self, ref):
         c = self._get_read_connection(factory=self._state_factory).cursor()
         return c.execute("SELECT * FROM States WHERE remote_ref LIKE ? ORDER BY last_remote_updated ASC LIMIT 1",
                          ('%' + ref,)).fetchone()
 
+    @traced('db')
     def get_normal_state_from_remote(self, ref):
         # TODO Select the only states that is not a collection
         states = self.get_states_from_remote(ref)
@@ -957,9 +1998,10 @@ class EngineDAO(ConfigurationDAO):
         c = self._get_read_connection(factory=self._state_factory).cursor()
         return c.execute("SELECT * FROM States WHERE remote_ref=?", (ref,)).fetchall()
 
+    @traced('db')
     def get_state_from_id(self, row_id, from_write=False):
-        # Dont need to read from write as auto_commit is True
-        if from_write and self.auto_commit:
+        # Dont need to read from write if every write is already committed
+        if from_write and self.auto_commit and self._committer is None:
             from_write = False
         try:
             if from_write:
@@ -973,20 +2015,40 @@ class EngineDAO(ConfigurationDAO):
                 self._lock.release()
         return state
 
+    @staticmethod
+    def _get_prefix_condition(column, prefix):
+        """
+        Condition on the values of column starting with prefix.
+        It is expressed as a range, unlike LIKE, to use the column index.
+        Return the condition and its parameters.
+        """
+        if not prefix:
+            return column + " IS NOT NULL", ()
+        last = ord(prefix[-1]) + 1
+        upper = prefix[:-1] + (unichr(last) if isinstance(prefix, unicode) else chr(last))
+        return "(" + column + " >= ? AND " + column + " < ?)", (prefix, upper)
+
+    @staticmethod
+    def _get_subtree_condition(column, path):
+        """ Condition on the values of column equal to path or under it. """
+        condition, params = EngineDAO._get_prefix_condition(column, path + '/')
+        return "(" + column + " = ? OR " + condition + ")", (path,) + params
+
     def _get_recursive_condition(self, doc_pair):
-        res = (" WHERE (local_parent_path LIKE '" + self._escape(doc_pair.local_path) + "/%'"
-                    + " OR local_parent_path = '" + self._escape(doc_pair.local_path) + "')")
+        condition, params = self._get_subtree_condition('local_parent_path', doc_pair.local_path)
         if doc_pair.remote_ref is not None:
-            res += " AND remote_parent_path LIKE '" + self._escape(doc_pair.remote_parent_path +
-                    '/' + doc_pair.remote_ref) + "%'"
-        return res
+            remote_condition, remote_params = self._get_prefix_condition(
+                'remote_parent_path', doc_pair.remote_parent_path + '/' + doc_pair.remote_ref)
+            condition += " AND " + remote_condition
+            params += remote_params
+        return " WHERE " + condition, params
 
     def _get_recursive_remote_condition(self, doc_pair):
-        remote_path = (self._escape(doc_pair.remote_parent_path)
-                       + '/' + self._escape(doc_pair.remote_name))
-        return (" WHERE remote_parent_path LIKE '" + remote_path + "/%'"
-                " OR remote_parent_path = '" + remote_path + "'")
+        condition, params = self._get_subtree_condition(
+            'remote_parent_path', doc_pair.remote_parent_path + '/' + doc_pair.remote_name)
+        return " WHERE " + condition, params
 
+    @traced('db')
     def update_remote_parent_path(self, doc_pair, new_path):
         self._lock.acquire()
         try:
@@ -994,11 +2056,10 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             if doc_pair.folderish:
                 remote_path = doc_pair.remote_parent_path + "/" + doc_pair.remote_ref
-                query = "UPDATE States SET remote_parent_path='%s/%s' || substr(remote_parent_path,%d)" % (
-                    self._escape(new_path), self._escape(doc_pair.remote_ref), len(remote_path) + 1)
-                query = query + self._get_recursive_remote_condition(doc_pair)
+                condition, params = self._get_recursive_remote_condition(doc_pair)
+                query = "UPDATE States SET remote_parent_path=? || substr(remote_parent_path, ?)" + condition
                 log.trace("Update remote_parent_path: " + query)
-                c.execute(query)
+                c.execute(query, (new_path + "/" + doc_pair.remote_ref, len(remote_path) + 1) + params)
             c.execute("UPDATE States SET remote_parent_path=? WHERE id=?", (new_path, doc_pair.id))
             if self.auto_commit:
                 con.commit()
@@ -1016,6 +2077,7 @@ class EngineDAO(ConfigurationDAO):
         finally:
             self._lock.release()
 
+    @traced('db')
     def update_local_parent_path(self, doc_pair, new_name, new_path):
         self._lock.acquire()
         try:
@@ -1024,13 +2086,12 @@ class EngineDAO(ConfigurationDAO):
             if doc_pair.folderish:
                 if new_path == '/':
                     new_path = ''
-                escaped_new_path = self._escape(new_path)
-                escaped_new_name = self._escape(new_name)
-                query = ("UPDATE States SET local_parent_path='%s/%s' || substr(local_parent_path,%d), local_path='%s/%s' || substr(local_path,%d)" %
-                         (escaped_new_path, escaped_new_name, len(doc_pair.local_path) + 1,
-                          escaped_new_path, escaped_new_name, len(doc_pair.local_path)+1))
-                query = query + self._get_recursive_condition(doc_pair)
-                c.execute(query)
+                new_local_path = new_path + '/' + new_name
+                condition, params = self._get_recursive_condition(doc_pair)
+                query = ("UPDATE States SET local_parent_path=? || substr(local_parent_path, ?),"
+                         " local_path=? || substr(local_path, ?)" + condition)
+                c.execute(query, (new_local_path, len(doc_pair.local_path) + 1,
+                                  new_local_path, len(doc_pair.local_path) + 1) + params)
             # Dont need to update the path as it is refresh later
             c.execute("UPDATE States SET local_parent_path=? WHERE id=?", (new_path, doc_pair.id))
             if self.auto_commit:
@@ -1046,13 +2107,15 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state='deleted', pair_state='remotely_deleted'"
             c.execute(update + " WHERE id=?", (doc_pair.id,))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
+                condition, params = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, params)
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, pair=doc_pair)
         finally:
             self._lock.release()
 
+    @traced('db')
     def mark_descendants_remotely_created(self, doc_pair):
         self._lock.acquire()
         try:
@@ -1061,10 +2124,11 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state='created', pair_state='remotely_created'"
             c.execute(update + " WHERE id=" + str(doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
+                condition, params = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, params)
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, pair=doc_pair)
         finally:
             self._lock.release()
 
@@ -1076,13 +2140,15 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET remote_digest=NULL, remote_ref=NULL, remote_parent_ref=NULL, remote_parent_path=NULL, last_remote_updated=NULL, remote_name=NULL, remote_state='unknown', local_state='created', pair_state='locally_created'"
             c.execute(update + " WHERE id=" + str(doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
+                condition, params = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, params)
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, pair=doc_pair)
         finally:
             self._lock.release()
 
+    @traced('db')
     def remove_state(self, doc_pair, remote_recursion=False):
         self._lock.acquire()
         try:
@@ -1091,45 +2157,63 @@ class EngineDAO(ConfigurationDAO):
             c.execute("DELETE FROM States WHERE id=?", (doc_pair.id,))
             if doc_pair.folderish:
                 if remote_recursion:
-                    c.execute("DELETE FROM States" + self._get_recursive_remote_condition(doc_pair))
+                    condition, params = self._get_recursive_remote_condition(doc_pair)
                 else:
-                    c.execute("DELETE FROM States" + self._get_recursive_condition(doc_pair))
+                    condition, params = self._get_recursive_condition(doc_pair)
+                c.execute("DELETE FROM States" + condition, params)
             if self.auto_commit:
                 con.commit()
         finally:
             self._lock.release()
 
+    @traced('db')
     def get_state_from_local(self, path):
         c = self._get_read_connection(factory=self._state_factory).cursor()
         return c.execute("SELECT * FROM States WHERE local_path=?", (path,)).fetchone()
 
     def insert_remote_state(self, info, remote_parent_path, local_path, local_parent_path):
+        return self.insert_remote_states([(info, remote_parent_path, local_path, local_parent_path)])[0]
+
+    def insert_remote_states(self, states):
+        """
+        Insert several remote states in one transaction, states being a list
+        of (info, remote_parent_path, local_path, local_parent_path).
+        Return the ids of the new rows, in the same order as states.
+        """
+        if not states:
+            return []
         pair_state = PAIR_STATES.get(('unknown','created'))
+        params = [(info.uid, info.parent_uid, remote_parent_path, info.name,
+                   info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
+                   info.can_create_child, info.last_contributor, info.digest, info.folderish, info.last_contributor,
+                   local_path, local_parent_path, pair_state, info.name)
+                  for info, remote_parent_path, local_path, local_parent_path in states]
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("INSERT INTO States (remote_ref, remote_parent_ref, " +
-                      "remote_parent_path, remote_name, last_remote_updated, remote_can_rename," +
-                      "remote_can_delete, remote_can_update, " +
-                      "remote_can_create_child, last_remote_modifier, remote_digest," +
-                      "folderish, last_remote_modifier, local_path, local_parent_path, remote_state, local_state, pair_state, local_name)" +
-                      " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,'created','unknown',?, ?)",
-                      (info.uid, info.parent_uid, remote_parent_path, info.name,
-                       info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
-                       info.can_create_child, info.last_contributor, info.digest, info.folderish, info.last_contributor,
-                       local_path, local_parent_path, pair_state, info.name))
-            row_id = c.lastrowid
+            row_ids = self._insert_states(
+                c, "INSERT INTO States (remote_ref, remote_parent_ref, " +
+                   "remote_parent_path, remote_name, last_remote_updated, remote_can_rename," +
+                   "remote_can_delete, remote_can_update, " +
+                   "remote_can_create_child, last_remote_modifier, remote_digest," +
+                   "folderish, last_remote_modifier, local_path, local_parent_path, remote_state, local_state, pair_state, local_name)" +
+                   " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,'created','unknown',?, ?)", params)
             if self.auto_commit:
                 con.commit()
-            # Check if parent is not in creation
-            parent = c.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
-            if (parent is None and local_parent_path == '') or (parent is not None and parent.pair_state != "remotely_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
-            self._items_count = self._items_count + 1
+            # Check if parent is not in creation, parents of the batch are
+            parents = {state[0].uid: pair_state for state in states}
+            self._get_parent_states(c, [state[0].parent_uid for state in states], parents)
+            to_queue = []
+            for row_id, (info, _, local_path, local_parent_path) in zip(row_ids, states):
+                parent = parents[info.parent_uid]
+                if (parent is None and local_parent_path == '') or (parent is not None and parent != "remotely_created"):
+                    to_queue.append((row_id, info.folderish, pair_state,
+                                     local_path or path_join(local_parent_path, info.name)))
+            self._queue_pair_states(to_queue)
         finally:
             self._lock.release()
-        return row_id
+        return row_ids
 
     def queue_children(self, row):
         self._lock.acquire()
@@ -1140,10 +2224,11 @@ class EngineDAO(ConfigurationDAO):
                                     self._get_to_sync_condition(), (row.remote_ref, row.local_path)).fetchall()
             log.debug("Queuing %d children of '%r'", len(children), row)
             for child in children:
-                self._queue_pair_state(child.id, child.folderish, child.pair_state)
+                self._queue_pair_state(child.id, child.folderish, child.pair_state, pair=child)
         finally:
             self._lock.release()
 
+    @traced('db')
     def increase_error(self, row, error, details=None, incr=1):
         error_date = datetime.utcnow()
         self._lock.acquire()
@@ -1160,6 +2245,7 @@ class EngineDAO(ConfigurationDAO):
         row.error_count = row.error_count + incr
         row.last_sync_error_date = error_date
 
+    @traced('db')
     def reset_error(self, row, last_error=None):
         self._lock.acquire()
         try:
@@ -1174,8 +2260,7 @@ class EngineDAO(ConfigurationDAO):
                       (last_error, row.id))
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(row.id, row.folderish, row.pair_state)
-            self._items_count = self._items_count + 1
+            self._queue_pair_state(row.id, row.folderish, row.pair_state, pair=row)
         finally:
             self._lock.release()
         row.last_error = None
@@ -1189,13 +2274,12 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET local_state='synchronized', remote_state='modified', pair_state='remotely_modified', last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
                       " WHERE id=? AND version=?", (row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, "remotely_modified")
+            self._queue_pair_state(row.id, row.folderish, "remotely_modified", pair=row)
             if self.auto_commit:
                 con.commit()
         finally:
             self._lock.release()
         if c.rowcount == 1:
-            self._items_count = self._items_count + 1
             return True
         return False
 
@@ -1207,16 +2291,16 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET local_state='resolved', remote_state='unknown', pair_state=?, last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
                       " WHERE id=? AND version=?", (pair_state, row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, pair_state)
+            self._queue_pair_state(row.id, row.folderish, pair_state, pair=row)
             if self.auto_commit:
                 con.commit()
         finally:
             self._lock.release()
         if c.rowcount == 1:
-            self._items_count = self._items_count + 1
             return True
         return False
 
+    @traced('db')
     def set_conflict_state(self, row):
         self._lock.acquire()
         try:
@@ -1230,23 +2314,25 @@ class EngineDAO(ConfigurationDAO):
         finally:
             self._lock.release()
         if c.rowcount == 1:
-            self._items_count = self._items_count - 1
             return True
         return False
 
+    @traced('db')
     def unsynchronize_state(self, row, last_error=None):
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("UPDATE States SET pair_state='unsynchronized', last_sync_date=?, processor = 0," +
+            c.execute("UPDATE States SET pair_state='unsynchronized', last_sync_date=?," +
                       "last_error=?, error_count=0, last_sync_error_date=NULL WHERE id=?",
                       (datetime.utcnow(), last_error, row.id))
             if self.auto_commit:
                 con.commit()
         finally:
             self._lock.release()
+        self._release_row(row.id)
 
+    @traced('db')
     def synchronize_state(self, row, version=None, dynamic_states=False):
         if version is None:
             version = row.version
@@ -1271,7 +2357,6 @@ class EngineDAO(ConfigurationDAO):
                       '       pair_state = ?,'
                       '       local_digest = ?,'
                       '       last_sync_date = ?,'
-                      '       processor = 0,'
                       '       last_error = NULL,'
                       '       error_count = 0,'
                       '       last_sync_error_date = NULL'
@@ -1304,7 +2389,6 @@ class EngineDAO(ConfigurationDAO):
                           '       remote_state = ?,'
                           '       pair_state = ?,'
                           '       last_sync_date = ?,'
-                          '       processor = 0,'
                           '       last_error = NULL,'
                           '       error_count = 0,'
                           '       last_sync_error_date = NULL'
@@ -1323,6 +2407,11 @@ class EngineDAO(ConfigurationDAO):
                 self._lock.release()
             result = c.rowcount == 1
 
+        # The pair must not be synchronized again after a crash
+        self.flush()
+        if result:
+            self._release_row(row.id)
+
         if not result:
             log.trace('Was not able to synchronize state: %r', row)
             con = self._get_read_connection()
@@ -1339,7 +2428,65 @@ class EngineDAO(ConfigurationDAO):
 
         return result
 
+    @traced('db')
     def update_remote_state(self, row, info, remote_parent_path=None, versionned=True, queue=True, force_update=False, no_digest=False):
+        update = self._get_remote_update(row, info, remote_parent_path, versionned, force_update, no_digest)
+        if update is None:
+            return
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute(*update)
+            if self.auto_commit:
+                con.commit()
+            if queue:
+                # Check if parent is not in creation
+                parent = c.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
+                # Parent can be None if the parent is filtered
+                if (parent is not None and parent.pair_state != "remotely_created") or parent is None:
+                    self._queue_pair_state(row.id, info.folderish, row.pair_state, pair=row)
+        finally:
+            self._lock.release()
+
+    def update_remote_states(self, states, remote_parent_path=None):
+        """
+        Update several remote states in one transaction, states being a list
+        of (row, info). Rows are versionned and queued like with
+        update_remote_state().
+        """
+        queries = dict()
+        updated = []
+        for row, info in states:
+            update = self._get_remote_update(row, info, remote_parent_path, True, False, False)
+            if update is None:
+                continue
+            query, params = update
+            queries.setdefault(query, []).append(params)
+            updated.append((row, info))
+        if not updated:
+            return
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            for query, params in queries.iteritems():
+                c.executemany(query, params)
+            if self.auto_commit:
+                con.commit()
+            # Check if parent is not in creation
+            parents = self._get_parent_states(c, [info.parent_uid for _, info in updated], dict())
+            self._queue_pair_states([self._get_queue_ref(row.id, info.folderish, row.pair_state, row)
+                                     for row, info in updated
+                                     if parents[info.parent_uid] != "remotely_created"])
+        finally:
+            self._lock.release()
+
+    def _get_remote_update(self, row, info, remote_parent_path, versionned, force_update, no_digest):
+        """
+        Compute the new states of the row from the remote info.
+        Return the query and its parameters, or None if there is nothing to update.
+        """
         row.pair_state = self._get_pair_state(row)
         if remote_parent_path is None:
             remote_parent_path = row.remote_parent_path
@@ -1364,7 +2511,7 @@ class EngineDAO(ConfigurationDAO):
                 if info.digest == row.remote_digest and not force_update:
                     log.trace('Not updating remote state (not dirty)'
                               ' for row=%r with info=%r', row, info)
-                    return
+                    return None
 
         log.trace('Updating remote state for row=%r with info=%r (force=%r)',
                   row, info, force_update)
@@ -1383,33 +2530,20 @@ class EngineDAO(ConfigurationDAO):
         if versionned:
             version = ', version=version+1'
             log.trace('Increasing version to %d for pair %r', row.version + 1, row)
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            query = "UPDATE States SET remote_ref=?, remote_parent_ref=?, " + \
-                      "remote_parent_path=?, remote_name=?, last_remote_updated=?, remote_can_rename=?," + \
-                      "remote_can_delete=?, remote_can_update=?, " + \
-                      "remote_can_create_child=?, last_remote_modifier=?,"
-            if not no_digest and info.digest is not None:
-                query = query + "remote_digest='" + info.digest + "',"
-            query = query + " local_state=?," + \
-                      "remote_state=?, pair_state=?" + version + " WHERE id=?"
-            c.execute(query,
-                      (info.uid, info.parent_uid, remote_parent_path, info.name,
-                       info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
-                       info.can_create_child, info.last_contributor, row.local_state,
-                       row.remote_state, row.pair_state, row.id))
-            if self.auto_commit:
-                con.commit()
-            if queue:
-                # Check if parent is not in creation
-                parent = c.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
-                # Parent can be None if the parent is filtered
-                if (parent is not None and parent.pair_state != "remotely_created") or parent is None:
-                    self._queue_pair_state(row.id, info.folderish, row.pair_state)
-        finally:
-            self._lock.release()
+        query = "UPDATE States SET remote_ref=?, remote_parent_ref=?, " + \
+                  "remote_parent_path=?, remote_name=?, last_remote_updated=?, remote_can_rename=?," + \
+                  "remote_can_delete=?, remote_can_update=?, " + \
+                  "remote_can_create_child=?, last_remote_modifier=?,"
+        params = [info.uid, info.parent_uid, remote_parent_path, info.name,
+                  info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
+                  info.can_create_child, info.last_contributor]
+        if not no_digest and info.digest is not None:
+            query = query + "remote_digest=?,"
+            params.append(info.digest)
+        query = query + " local_state=?," + \
+                  "remote_state=?, pair_state=?" + version + " WHERE id=?"
+        params.extend([row.local_state, row.remote_state, row.pair_state, row.id])
+        return query, params
 
     def _clean_filter_path(self, path):
         if not path.endswith("/"):
@@ -1452,24 +2586,60 @@ class EngineDAO(ConfigurationDAO):
         c = self._get_read_connection().cursor()
         return c.execute('SELECT * FROM ToRemoteScan').fetchall()
 
+    def _get_scanned(self):
+        if self._scanned is None:
+            self._lock.acquire()
+            try:
+                if self._scanned is None:
+                    c = self._get_read_connection().cursor()
+                    self._scanned = set(row[0] for row in
+                                        c.execute("SELECT path FROM RemoteScan"))
+            finally:
+                self._lock.release()
+        return self._scanned
+
     def add_path_scanned(self, path):
+        """
+        Remember a scanned path, it is only checkpointed to RemoteScan
+        every SCANNED_CHECKPOINT_SIZE paths or SCANNED_CHECKPOINT_DELAY
+        seconds, to resume the scan after a crash.
+        """
         path = self._clean_filter_path(path)
         self._lock.acquire()
         try:
+            scanned = self._get_scanned()
+            if path in scanned:
+                return
+            scanned.add(path)
+            self._scanned_pending.append(path)
+            if (len(self._scanned_pending) >= self.SCANNED_CHECKPOINT_SIZE
+                    or time() - self._scanned_checkpoint
+                    >= self.SCANNED_CHECKPOINT_DELAY):
+                self.checkpoint_scanned()
+        finally:
+            self._lock.release()
+
+    def checkpoint_scanned(self):
+        self._lock.acquire()
+        try:
+            self._scanned_checkpoint = time()
+            if not self._scanned_pending:
+                return
             con = self._get_write_connection()
             c = con.cursor()
-            # ADD IT
-            c.execute("INSERT INTO RemoteScan(path) VALUES(?)", (path,))
+            c.executemany("INSERT OR IGNORE INTO RemoteScan(path) VALUES(?)",
+                          [(path,) for path in self._scanned_pending])
+            self._scanned_pending = []
             if self.auto_commit:
                 con.commit()
-        except sqlite3.IntegrityError:
-            pass
         finally:
             self._lock.release()
 
     def clean_scanned(self):
         self._lock.acquire()
         try:
+            self._scanned = set()
+            self._scanned_pending = []
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("DELETE FROM RemoteScan")
@@ -1479,10 +2649,7 @@ class EngineDAO(ConfigurationDAO):
             self._lock.release()
 
     def is_path_scanned(self, path):
-        path = self._clean_filter_path(path)
-        c = self._get_read_connection().cursor()
-        row = c.execute("SELECT COUNT(path) FROM RemoteScan WHERE path=? LIMIT 1", (path,)).fetchone()
-        return row[0] > 0
+        return self._clean_filter_path(path) in self._get_scanned()
 
     def get_previous_sync_file(self, ref, sync_mode=None):
         mode_condition = ""
@@ -1519,15 +2686,19 @@ class EngineDAO(ConfigurationDAO):
         return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_name < ? AND folderish=0 ORDER BY remote_name DESC LIMIT 1", (state.remote_parent_ref,state.remote_name)).fetchone()
 
     def is_filter(self, path):
-        path = self._clean_filter_path(path)
-        if any([path.startswith(filter_obj.path) for filter_obj in self._filters]):
-            return True
-        return False
+        return self._filters.is_filtered(path)
+
+    def filtered_subtree(self, path):
+        """ Return the filters on the path or below it. """
+        return self._filters.filtered_subtree(path)
 
     def get_filters(self):
         c = self._get_read_connection().cursor()
         return c.execute("SELECT * FROM Filters").fetchall()
 
+    def _get_filters_trie(self):
+        return PathTrie(filter_obj.path for filter_obj in self.get_filters())
+
     def add_filter(self, path):
         if self.is_filter(path):
             return
@@ -1537,7 +2708,8 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             # DELETE ANY SUBFILTERS
-            c.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
+            c.executemany("DELETE FROM Filters WHERE path=?",
+                          [(sub,) for sub in self.filtered_subtree(path)])
             # PREVENT ANY RESCAN
             c.execute("DELETE FROM ToRemoteScan WHERE path LIKE ?", (path+'%',))
             # ADD IT
@@ -1545,8 +2717,7 @@ class EngineDAO(ConfigurationDAO):
             # TODO ADD THIS path AS remotely_deleted
             if self.auto_commit:
                 con.commit()
-            self._filters = self.get_filters()
-            self._items_count = self.get_syncing_count()
+            self._filters = self._get_filters_trie()
         finally:
             self._lock.release()
 
@@ -1556,14 +2727,10 @@ class EngineDAO(ConfigurationDAO):
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
+            c.executemany("DELETE FROM Filters WHERE path=?",
+                          [(sub,) for sub in self.filtered_subtree(path)])
             if self.auto_commit:
                 con.commit()
-            self._filters = self.get_filters()
-            self._items_count = self.get_syncing_count()
+            self._filters = self._get_filters_trie()
         finally:
             self._lock.release()
-
-    @staticmethod
-    def _escape(_str):
-        return _str.replace("'", "''")
@@ -6,7 +6,8 @@ from cookielib import CookieJar
 from threading import Thread, current_thread
 from time import sleep
 
-from PyQt4.QtCore import QCoreApplication, QObject, pyqtSignal, pyqtSlot
+from PyQt4.QtCore import QCoreApplication, QObject, Qt, pyqtSignal, \
+    pyqtSlot
 
 from nxdrive.client import LocalClient, RemoteDocumentClient, \
     RemoteFileSystemClient, RemoteFilteredFileSystemClient
@@ -15,11 +16,13 @@ from nxdrive.client.common import BaseClient, NotFound, safe_filename
 from nxdrive.client.rest_api_client import RestAPIClient
 from nxdrive.engine.activity import Action, FileAction
 from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.prefetch import RemoteInfoCache
 from nxdrive.engine.processor import Processor
 from nxdrive.engine.queue_manager import QueueManager
 from nxdrive.engine.watcher.local_watcher import LocalWatcher
 from nxdrive.engine.watcher.remote_watcher import RemoteWatcher
-from nxdrive.engine.workers import PairInterrupt, ThreadInterrupt, Worker
+from nxdrive.engine.workers import PairInterrupt, ThreadInterrupt, \
+    VacuumWorker, Worker
 from nxdrive.gui.resources import find_icon
 from nxdrive.logging_config import get_logger
 from nxdrive.manager import ServerBindingSettings
@@ -164,6 +167,8 @@ class Engine(QObject):
         self._threads = list()
         self._client_cache_timestamps = dict()
         self._dao = self._create_dao()
+        # Remote infos shared by the remote watcher and the processors
+        self._remote_info_cache = RemoteInfoCache()
         if binder is not None:
             self.bind(binder)
         self._load_configuration()
@@ -181,6 +186,9 @@ class Engine(QObject):
         self._remote_watcher.remoteWatcherStopped.connect(self._queue_manager.shutdown_processors)
         # Connect last_sync checked
         self._remote_watcher.updated.connect(self._check_last_sync)
+        # Database maintenance when there is nothing to synchronize
+        self._vacuum_worker = VacuumWorker(self, Options.db_vacuum_interval)
+        self.create_thread(worker=self._vacuum_worker, start_connect=False)
         # Connect for sync start
         self.newQueueItem.connect(self._check_sync_start)
         self._queue_manager.newItem.connect(self._check_sync_start)
@@ -194,6 +202,7 @@ class Engine(QObject):
             self.conflict_resolver(conflict.id, emit=False)
         # Scan in remote_watcher thread
         self._scanPair.connect(self._remote_watcher.scan_pair)
+        self._scanPair.connect(self._remote_watcher.wake, Qt.DirectConnection)
         # Set the root icon
         self._set_root_icon()
         # Set user full name
@@ -473,7 +482,13 @@ class Engine(QObject):
                             'ndrive_' + self.uid + '.db')
 
     def _create_dao(self):
-        return EngineDAO(self._get_db_file())
+        return EngineDAO(self._get_db_file(),
+                         group_commit=Options.db_group_commit,
+                         pool_size=Options.db_pool_size,
+                         cache_size=Options.db_cache_size,
+                         mmap_size=Options.db_mmap_size,
+                         busy_timeout=Options.db_busy_timeout,
+                         profile=Options.db_profile)
 
     def get_abspath(self, path):
         return self.get_local_client().abspath(path)
@@ -513,6 +528,9 @@ class Engine(QObject):
     def get_dao(self):
         return self._dao
 
+    def get_remote_info_cache(self):
+        return self._remote_info_cache
+
     @staticmethod
     def local_rollback(force=None):
         """
@@ -891,6 +909,28 @@ class Engine(QObject):
             self._case_sensitive = client.is_case_sensitive()
         return client
 
+    def get_valid_duplicate_file(self, digest):
+        """
+        Return the path of a local file having this content, or None.
+        The candidates are checked against the size and modification time
+        recorded at their last synchronization, so a file modified since
+        then is not copied in place of the downloaded content.
+        """
+        local_client = self.get_local_client()
+        for pair in self._dao.get_valid_duplicate_files(digest):
+            os_path = local_client.abspath(pair.local_path)
+            try:
+                stat_info = os.stat(os_path)
+            except OSError:
+                continue
+            mtime = datetime.datetime.utcfromtimestamp(stat_info.st_mtime)
+            if (stat_info.st_size == pair.size
+                    and unicode(mtime) == pair.last_local_updated):
+                return os_path
+            log.trace('Skipping duplicate %r modified since its last sync',
+                      os_path)
+        return None
+
     def get_server_version(self):
         return self._dao.get_config("server_version")
 
@@ -1,11 +1,11 @@
 # coding: utf-8
 import os
-import shutil
 
 from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_PREFIX, \
     DOWNLOAD_TMP_FILE_SUFFIX
 from nxdrive.engine.processor import Processor as OldProcessor
 from nxdrive.logging_config import get_logger
+from nxdrive.utils import copy_file
 
 log = get_logger(__name__)
 
@@ -37,9 +37,10 @@ class Processor(OldProcessor):
         file_out = os.path.join(self._get_partial_folders(), DOWNLOAD_TMP_FILE_PREFIX +
                             doc_pair.remote_digest + str(self._thread_id) + DOWNLOAD_TMP_FILE_SUFFIX)
         # Check if the file is already on the HD
-        pair = self._dao.get_valid_duplicate_file(doc_pair.remote_digest)
-        if pair:
-            shutil.copy(local_client.abspath(pair.local_path), file_out)
+        duplicate = self._engine.get_valid_duplicate_file(
+            doc_pair.remote_digest)
+        if duplicate:
+            copy_file(duplicate, file_out)
             return file_out
         tmp_file = remote_client.stream_content( doc_pair.remote_ref, file_path,
                                 parent_fs_item_id=doc_pair.remote_parent_ref, file_out=file_out)
@@ -16,8 +16,7 @@ class QueueManager(OldQueueManager):
         log.debug("Blacklisting pair for %ds: %r", interval, doc_pair)
         self._error_lock.acquire()
         try:
-            self._on_error_queue[doc_pair.id] = doc_pair
-            if not self._error_timer.isActive():
-                self.newError.emit(doc_pair.id)
+            self._on_error_queue.push(doc_pair.id, doc_pair, next_try=interval)
         finally:
             self._error_lock.release()
+        self.newError.emit(doc_pair.id)
@@ -2,7 +2,7 @@
 import copy
 import os
 from Queue import Queue
-from time import sleep, time
+from time import time
 
 from watchdog.events import DirModifiedEvent
 
@@ -43,6 +43,11 @@ class SimpleWatcher(LocalWatcher):
     def empty_events(self):
         return self._watchdog_queue.empty() and len(self._to_scan) == 0
 
+    def _get_wait_timeout(self):
+        if self._to_scan or self._delete_files:
+            return 1
+        return None
+
     def get_scan_delay(self):
         return self._scan_delay
 
@@ -107,7 +112,7 @@ class SimpleWatcher(LocalWatcher):
         if not os.path.exists(src_path):
             log.warning("Event on a disappeared file: %r %s %s", evt, rel_path, file_name)
             return
-        if doc_pair is not None and doc_pair.processor > 0:
+        if doc_pair is not None and self._dao.get_processor(doc_pair.id):
             log.warning("Don't update as in process %r", doc_pair)
             return
         if isinstance(evt, DirModifiedEvent):
@@ -138,23 +143,21 @@ class SimpleWatcher(LocalWatcher):
             self._action = Action("Full local scan")
             self._scan()
             self._end_action()
-            # Check windows dequeue and folder scan only every 100 loops ( every 1s )
             current_time_millis = int(round(time() * 1000))
             self._win_delete_interval = current_time_millis
             self._win_folder_scan_interval = current_time_millis
-            i = 0
+            # Check the paths to scan only every second
+            next_check = current_time_millis + 1000
             while (1):
-                self._interact()
-                sleep(0.01)
+                self._wait(self._get_wait_timeout())
                 while (not self._watchdog_queue.empty()):
                     # Dont retest if already local scan
                     evt = self._watchdog_queue.get()
                     self.handle_watchdog_event(evt)
                 # Check to scan
-                i += 1
-                if i % 100 != 0:
+                if current_milli_time() < next_check:
                     continue
-                i = 0
+                next_check = current_milli_time() + 1000
                 threshold_time = current_milli_time() - 1000 * self._scan_delay
                 # Need to create a list of to scan as the dictionary cannot grow while iterating
                 local_scan = []
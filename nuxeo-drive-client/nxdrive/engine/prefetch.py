@@ -0,0 +1,88 @@
+# coding: utf-8
+"""
+Remote information of the pairs to synchronize, fetched ahead.
+
+Before synchronizing a local change, the Processor checks the remote
+document to detect a concurrent remote modification.  On a high-latency
+link, a round trip per pair caps the throughput of each processor: the
+RemoteInfoCache keeps for a short time the FileSystemItems already known,
+from the remote watcher changes or from the children of a folder fetched
+in one call when several of them are waiting to be synchronized.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from nxdrive.logging_config import get_logger
+
+log = get_logger(__name__)
+
+
+class RemoteInfoCache(object):
+    """
+    Thread-safe cache of RemoteFileInfo by remote reference.
+    An info is given once only: once synchronized, a pair has to be checked
+    against the server again.
+    """
+
+    def __init__(self, ttl=10, max_size=10000, clock=time.time):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._clock = clock
+        self._lock = Lock()
+        # Remote ref -> (time, info), the oldest first
+        self._infos = OrderedDict()
+        # Remote ref of a folder -> time its children were fetched
+        self._prefetched = dict()
+        self._metrics = {
+            'hits': 0,
+            'misses': 0,
+            'prefetches': 0,
+        }
+
+    def put(self, infos):
+        now = self._clock()
+        with self._lock:
+            for info in infos:
+                self._infos.pop(info.uid, None)
+                self._infos[info.uid] = now, info
+            while len(self._infos) > self._max_size:
+                self._infos.popitem(last=False)
+
+    def pop(self, ref):
+        """ Return the info of the document if it is still fresh, or None. """
+        with self._lock:
+            cached = self._infos.pop(ref, None)
+            if cached is None or self._clock() - cached[0] > self._ttl:
+                self._metrics['misses'] += 1
+                return None
+            self._metrics['hits'] += 1
+            return cached[1]
+
+    def discard(self, ref):
+        with self._lock:
+            self._infos.pop(ref, None)
+
+    def start_prefetch(self, parent_ref):
+        """
+        Return True if the children of the folder have to be fetched, that
+        is if no other thread fetched them recently.
+        """
+        now = self._clock()
+        with self._lock:
+            last = self._prefetched.get(parent_ref)
+            if last is not None and now - last <= self._ttl:
+                return False
+            self._prefetched[parent_ref] = now
+            # Forget about the old prefetches
+            for ref, last in self._prefetched.items():
+                if now - last > self._ttl:
+                    del self._prefetched[ref]
+            self._metrics['prefetches'] += 1
+            return True
+
+    def get_metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['size'] = len(self._infos)
+        return metrics
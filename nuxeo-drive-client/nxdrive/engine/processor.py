@@ -1,6 +1,5 @@
 # coding: utf-8
 import os
-import shutil
 import sqlite3
 import socket
 from threading import Lock
@@ -14,13 +13,20 @@ from nxdrive.client.base_automation_client import CorruptedFile,\
 from nxdrive.client.common import DuplicationDisabledError, NotFound, \
     UNACCESSIBLE_HASH, safe_filename
 from nxdrive.engine.activity import Action
+from nxdrive.engine.tracing import traced, tracer
 from nxdrive.engine.workers import EngineWorker, PairInterrupt, ThreadInterrupt
 from nxdrive.logging_config import get_logger
 from nxdrive.osi import AbstractOSIntegration
-from nxdrive.utils import current_milli_time, is_generated_tmp_file
+from nxdrive.utils import copy_file, current_milli_time, \
+    is_generated_tmp_file
 
 log = get_logger(__name__)
 
+# Fetch the children of a folder in one call if at least this number of
+# them are locally changed, and if it does not have more children than that
+PREFETCH_MIN_CHANGES = 2
+PREFETCH_MAX_CHILDREN = 1000
+
 
 class Processor(EngineWorker):
     pairSync = pyqtSignal(object, object)
@@ -36,6 +42,31 @@ class Processor(EngineWorker):
         self._get_item = item_getter
         self._engine = engine
 
+    @traced('remote', name='remote_check')
+    def _get_remote_info(self, doc_pair, remote_client):
+        """
+        Get the remote info of a locally changed pair, from the cache if
+        still fresh.  Otherwise, if several of its siblings are waiting to
+        be synchronized too, fetch all the children of its parent at once.
+        """
+        cache = self._engine.get_remote_info_cache()
+        info = cache.pop(doc_pair.remote_ref)
+        if info is not None:
+            return info
+        parent_ref = doc_pair.remote_parent_ref
+        if parent_ref:
+            children, changes = self._dao.get_local_changes_count(
+                doc_pair.local_parent_path)
+            if (PREFETCH_MIN_CHANGES <= changes
+                    and children <= PREFETCH_MAX_CHILDREN
+                    and cache.start_prefetch(parent_ref)):
+                log.trace('Prefetching the children of %r', parent_ref)
+                cache.put(remote_client.get_children_info(parent_ref))
+                info = cache.pop(doc_pair.remote_ref)
+                if info is not None:
+                    return info
+        return remote_client.get_info(doc_pair.remote_ref)
+
     def _unlock_soft_path(self, path):
         log.trace('Soft unlocking %r', path)
         path = path.lower()
@@ -49,6 +80,7 @@ class Processor(EngineWorker):
         finally:
             Processor.path_locker.release()
 
+    @traced('lock')
     def _unlock_readonly(self, local_client, path):
         Processor.readonly_locker.acquire()
         if self._engine.uid not in Processor.readonly_locks:
@@ -64,6 +96,7 @@ class Processor(EngineWorker):
         finally:
             Processor.readonly_locker.release()
 
+    @traced('lock')
     def _lock_readonly(self, local_client, path):
         Processor.readonly_locker.acquire()
         if self._engine.uid not in Processor.readonly_locks:
@@ -156,172 +189,186 @@ class Processor(EngineWorker):
             # Take client every time as it is cached in engine
             local_client = self._engine.get_local_client()
             remote_client = self._engine.get_remote_client()
-            try:
-                doc_pair = self._dao.acquire_state(self._thread_id, item.id)
-            except sqlite3.OperationalError:
-                state = self._dao.get_state_from_id(item.id)
-                if state:
-                    if (AbstractOSIntegration.is_windows()
-                            and state.pair_state == 'locally_moved'
-                            and not state.remote_can_rename):
-                        log.debug('A local rename on a read-only folder is'
-                                  ' allowed on Windows, but it should not.'
-                                  ' Skipping.')
-                        continue
-
-                    log.trace('Cannot acquire state for: %r', item)
-                    self._postpone_pair(item, 'Pair in use', interval=3)
-                continue
-
-            if doc_pair is None:
-                log.trace('Did not acquire state, dropping %r', item)
-                continue
+            with tracer.trace(item.pair_state, queued_time=item.queued_time,
+                              pair=item.id, engine=self._engine.uid):
+                handled = self._process_item(item, local_client,
+                                             remote_client)
+            if handled:
+                self._interact()
+
+    def _process_item(self, item, local_client, remote_client):
+        """
+        Synchronize the pair of the item.  Return True if its handler was
+        called without error.
+        """
+        try:
+            doc_pair = self._dao.acquire_state(self._thread_id, item.id)
+        except sqlite3.OperationalError:
+            state = self._dao.get_state_from_id(item.id)
+            if state:
+                if (AbstractOSIntegration.is_windows()
+                        and state.pair_state == 'locally_moved'
+                        and not state.remote_can_rename):
+                    log.debug('A local rename on a read-only folder is'
+                              ' allowed on Windows, but it should not.'
+                              ' Skipping.')
+                    return
 
-            try:
-                soft_lock = None
-
-                # In case of duplicate we remove the local_path as it
-                # has conflict
-                if doc_pair.local_path == '':
-                    doc_pair.local_path = os.path.join(
-                        doc_pair.local_parent_path, doc_pair.remote_name)
-                    log.trace('Re-guess local_path from duplicate: %r', doc_pair)
-                log.debug('Executing processor on %r(%d)', doc_pair,
-                          doc_pair.version)
-                self._current_doc_pair = doc_pair
-                self._current_temp_file = None
-                if not self.check_pair_state(doc_pair):
-                    continue
-
-                if (AbstractOSIntegration.is_mac()
-                        and local_client.exists(doc_pair.local_path)):
-                    try:
-                        finder_info = local_client.get_remote_id(
-                            doc_pair.local_path, "com.apple.FinderInfo")
-                        if (finder_info is not None
-                                and 'brokMACS' in finder_info):
-                            log.trace('Skip as pair is in use by Finder: %r',
-                                      doc_pair)
-                            self._postpone_pair(doc_pair, 'Finder using file',
-                                                interval=3)
-                            continue
-                    except IOError:
-                        pass
-                # TODO Update as the server dont take hash to avoid conflict yet
-                if (doc_pair.pair_state.startswith('locally')
-                        and doc_pair.remote_ref is not None):
-                    try:
-                        remote_info = remote_client.get_info(
-                            doc_pair.remote_ref)
-                        if (remote_info.digest != doc_pair.remote_digest
-                                and doc_pair.remote_digest is not None):
-                            doc_pair.remote_state = 'modified'
-                        elif (doc_pair.folderish
-                                and remote_info.name != doc_pair.remote_name):
-                            doc_pair.remote_state = 'moved'
-                        self._refresh_remote(doc_pair, remote_client,
-                                             remote_info)
-                        # Can run into conflict
-                        if doc_pair.pair_state == 'conflicted':
-                            continue
-                        doc_pair = self._dao.get_state_from_id(doc_pair.id)
-                        if not self.check_pair_state(doc_pair):
-                            continue
-                    except NotFound:
-                        doc_pair.remote_ref = None
-
-                # NXDRIVE-842: parent is in disabled duplication error
-                parent_pair = self._get_normal_state_from_remote_ref(
-                    doc_pair.remote_parent_ref)
-                if parent_pair and parent_pair.last_error == 'DEDUP':
-                    continue
-
-                parent_path = doc_pair.local_parent_path
-                if parent_path == '':
-                    parent_path = "/"
-                if not local_client.exists(parent_path):
-                    if parent_pair and doc_pair.local_parent_path != parent_pair.local_path:
-                        # The parent folder has been renamed sooner
-                        # in the current synchronization
-                        doc_pair.local_parent_path = parent_pair.local_path
-                    else:
-                        self._dao.remove_state(doc_pair)
-                        continue
-
-                self._current_metrics = dict()
-                handler_name = '_synchronize_' + doc_pair.pair_state
-                self._action = Action(handler_name)
-                sync_handler = getattr(self, handler_name, None)
-                if sync_handler is None:
-                    log.debug('Unhandled pair_state: %r for %r',
-                              doc_pair.pair_state, doc_pair)
-                    self.increase_error(doc_pair, "ILLEGAL_STATE")
-                    continue
+                log.trace('Cannot acquire state for: %r', item)
+                self._postpone_pair(item, 'Pair in use', interval=3)
+            return
+
+        if doc_pair is None:
+            log.trace('Did not acquire state, dropping %r', item)
+            return
+
+        tracer.annotate(path=doc_pair.local_path)
+        try:
+            soft_lock = None
+
+            # In case of duplicate we remove the local_path as it
+            # has conflict
+            if doc_pair.local_path == '':
+                doc_pair.local_path = os.path.join(
+                    doc_pair.local_parent_path, doc_pair.remote_name)
+                log.trace('Re-guess local_path from duplicate: %r', doc_pair)
+            log.debug('Executing processor on %r(%d)', doc_pair,
+                      doc_pair.version)
+            self._current_doc_pair = doc_pair
+            self._current_temp_file = None
+            if not self.check_pair_state(doc_pair):
+                return
+
+            if (AbstractOSIntegration.is_mac()
+                    and local_client.exists(doc_pair.local_path)):
+                try:
+                    finder_info = local_client.get_remote_id(
+                        doc_pair.local_path, "com.apple.FinderInfo")
+                    if (finder_info is not None
+                            and 'brokMACS' in finder_info):
+                        log.trace('Skip as pair is in use by Finder: %r',
+                                  doc_pair)
+                        self._postpone_pair(doc_pair, 'Finder using file',
+                                            interval=3)
+                        return
+                except IOError:
+                    pass
+            # TODO Update as the server dont take hash to avoid conflict yet
+            if (doc_pair.pair_state.startswith('locally')
+                    and doc_pair.remote_ref is not None):
+                try:
+                    remote_info = self._get_remote_info(
+                        doc_pair, remote_client)
+                    if (remote_info.digest != doc_pair.remote_digest
+                            and doc_pair.remote_digest is not None):
+                        doc_pair.remote_state = 'modified'
+                    elif (doc_pair.folderish
+                            and remote_info.name != doc_pair.remote_name):
+                        doc_pair.remote_state = 'moved'
+                    self._refresh_remote(doc_pair, remote_client,
+                                         remote_info)
+                    # Can run into conflict
+                    if doc_pair.pair_state == 'conflicted':
+                        return
+                    doc_pair = self._dao.get_state_from_id(doc_pair.id, from_write=True)
+                    if not self.check_pair_state(doc_pair):
+                        return
+                except NotFound:
+                    doc_pair.remote_ref = None
+
+            # NXDRIVE-842: parent is in disabled duplication error
+            parent_pair = self._get_normal_state_from_remote_ref(
+                doc_pair.remote_parent_ref)
+            if parent_pair and parent_pair.last_error == 'DEDUP':
+                return
+
+            parent_path = doc_pair.local_parent_path
+            if parent_path == '':
+                parent_path = "/"
+            if not local_client.exists(parent_path):
+                if parent_pair and doc_pair.local_parent_path != parent_pair.local_path:
+                    # The parent folder has been renamed sooner
+                    # in the current synchronization
+                    doc_pair.local_parent_path = parent_pair.local_path
                 else:
-                    self._current_metrics = {
-                        'handler': doc_pair.pair_state,
-                        'start_time': current_milli_time(),
-                    }
-                    log.trace('Calling %s on doc pair %r', sync_handler,
-                              doc_pair)
-                    try:
-                        soft_lock = self._lock_soft_path(doc_pair.local_path)
+                    self._dao.remove_state(doc_pair)
+                    return
+
+            self._current_metrics = dict()
+            handler_name = '_synchronize_' + doc_pair.pair_state
+            self._action = Action(handler_name)
+            sync_handler = getattr(self, handler_name, None)
+            if sync_handler is None:
+                log.debug('Unhandled pair_state: %r for %r',
+                          doc_pair.pair_state, doc_pair)
+                self.increase_error(doc_pair, "ILLEGAL_STATE")
+                return
+            else:
+                self._current_metrics = {
+                    'handler': doc_pair.pair_state,
+                    'start_time': current_milli_time(),
+                }
+                log.trace('Calling %s on doc pair %r', sync_handler,
+                          doc_pair)
+                try:
+                    soft_lock = self._lock_soft_path(doc_pair.local_path)
+                    with tracer.span(handler_name, 'handler'):
                         sync_handler(doc_pair, local_client, remote_client)
-                        self._current_metrics['end_time'] = current_milli_time()
-                        self.pairSync.emit(doc_pair, self._current_metrics)
-                    except ThreadInterrupt:
-                        raise
-                    except HTTPError as exc:
-                        if exc.code == 404:
-                            # We saw it happened once a migration is done.
-                            # Nuxeo kept the document reference but it does
-                            # not exist physically anywhere.
-                            log.debug('The document does not exist anymore: %r', doc_pair)
-                            self._dao.remove_state(doc_pair)
-                        elif exc.code == 409:  # Conflict
-                            # It could happen on multiple files drag'n drop
-                            # starting with identical characters.
-                            log.debug('Delaying conflicted document: %r', doc_pair)
-                            self._postpone_pair(doc_pair, 'Conflict')
-                        else:
-                            self._handle_pair_handler_exception(
-                                doc_pair, handler_name, exc)
-                        del exc  # Fix reference leak
-                        continue
-                    except (URLError, socket.error, PairInterrupt) as exc:
-                        # socket.error for SSLError
-                        log.debug('%s on %r, wait 1s and requeue',
-                                  type(exc).__name__, doc_pair)
-                        sleep(1)
-                        self._engine.get_queue_manager().push(doc_pair)
-                        del exc  # Fix reference leak
-                        continue
-                    except DuplicationDisabledError:
-                        self.giveup_error(doc_pair, 'DEDUP')
-                        log.trace('Removing local_path on %r', doc_pair)
-                        self._dao.remove_local_path(doc_pair.id)
-                        continue
-                    except CorruptedFile as exc:
-                        self.increase_error(doc_pair, 'CORRUPT', exception=exc)
-                        continue
-                    except Exception as exc:
+                    self._current_metrics['end_time'] = current_milli_time()
+                    self.pairSync.emit(doc_pair, self._current_metrics)
+                except ThreadInterrupt:
+                    raise
+                except HTTPError as exc:
+                    if exc.code == 404:
+                        # We saw it happened once a migration is done.
+                        # Nuxeo kept the document reference but it does
+                        # not exist physically anywhere.
+                        log.debug('The document does not exist anymore: %r', doc_pair)
+                        self._dao.remove_state(doc_pair)
+                    elif exc.code == 409:  # Conflict
+                        # It could happen on multiple files drag'n drop
+                        # starting with identical characters.
+                        log.debug('Delaying conflicted document: %r', doc_pair)
+                        self._postpone_pair(doc_pair, 'Conflict')
+                    else:
                         self._handle_pair_handler_exception(
                             doc_pair, handler_name, exc)
-                        del exc  # Fix reference leak
-                        continue
-            except ThreadInterrupt:
-                self._engine.get_queue_manager().push(doc_pair)
-                raise
-            except Exception as e:
-                log.exception('Pair error')
-                self.increase_error(doc_pair, 'EXCEPTION', exception=e)
-                raise e
-            finally:
-                self._current_doc_pair = None  # Fix reference leak
-                if soft_lock is not None:
-                    self._unlock_soft_path(soft_lock)
-                self._dao.release_state(self._thread_id)
-            self._interact()
+                    del exc  # Fix reference leak
+                    return
+                except (URLError, socket.error, PairInterrupt) as exc:
+                    # socket.error for SSLError
+                    log.debug('%s on %r, wait 1s and requeue',
+                              type(exc).__name__, doc_pair)
+                    sleep(1)
+                    self._engine.get_queue_manager().push(doc_pair)
+                    del exc  # Fix reference leak
+                    return
+                except DuplicationDisabledError:
+                    self.giveup_error(doc_pair, 'DEDUP')
+                    log.trace('Removing local_path on %r', doc_pair)
+                    self._dao.remove_local_path(doc_pair.id)
+                    return
+                except CorruptedFile as exc:
+                    self.increase_error(doc_pair, 'CORRUPT', exception=exc)
+                    return
+                except Exception as exc:
+                    self._handle_pair_handler_exception(
+                        doc_pair, handler_name, exc)
+                    del exc  # Fix reference leak
+                    return
+        except ThreadInterrupt:
+            self._engine.get_queue_manager().push(doc_pair)
+            raise
+        except Exception as e:
+            log.exception('Pair error')
+            self.increase_error(doc_pair, 'EXCEPTION', exception=e)
+            raise e
+        finally:
+            self._current_doc_pair = None  # Fix reference leak
+            if soft_lock is not None:
+                self._unlock_soft_path(soft_lock)
+            self._dao.release_state(self._thread_id)
+        return True
 
     def _handle_pair_handler_exception(self, doc_pair, handler_name, e):
         if isinstance(e, IOError) and e.errno == 28:
@@ -547,7 +594,7 @@ class Processor(EngineWorker):
                         doc_pair, fs_item_info,
                         remote_parent_path=remote_parent_path, versionned=False)
                     # Handle document modification - update the doc_pair
-                    doc_pair = self._dao.get_state_from_id(doc_pair.id)
+                    doc_pair = self._dao.get_state_from_id(doc_pair.id, from_write=True)
                     self._synchronize_locally_modified(
                         doc_pair, local_client, remote_client)
                     return
@@ -635,7 +682,7 @@ class Processor(EngineWorker):
                 if not remote_id_done:
                     local_client.set_remote_id(doc_pair.local_path, remote_ref)
             except (NotFound, IOError, OSError):
-                new_pair = self._dao.get_state_from_id(doc_pair.id)
+                new_pair = self._dao.get_state_from_id(doc_pair.id, from_write=True)
                 # File has been moved during creation
                 if new_pair.local_path != doc_pair.local_path:
                     local_client.set_remote_id(new_pair.local_path, remote_ref)
@@ -687,7 +734,7 @@ class Processor(EngineWorker):
 
     def _synchronize_locally_moved_remotely_modified(self, doc_pair, local_client, remote_client):
         self._synchronize_locally_moved(doc_pair, local_client, remote_client, update=False)
-        refreshed_pair = self._dao.get_state_from_id(doc_pair.id)
+        refreshed_pair = self._dao.get_state_from_id(doc_pair.id, from_write=True)
         self._synchronize_remotely_modified(refreshed_pair, local_client, remote_client)
 
     def _synchronize_locally_moved_created(self, doc_pair, local_client, remote_client):
@@ -777,14 +824,16 @@ class Processor(EngineWorker):
 
     def _download_content(self, local_client, remote_client, doc_pair, file_path):
         # Check if the file is already on the HD
-        pair = self._dao.get_valid_duplicate_file(doc_pair.remote_digest)
-        if pair:
+        duplicate = self._engine.get_valid_duplicate_file(
+            doc_pair.remote_digest)
+        if duplicate:
             file_out = self._get_temporary_file(file_path)
             locker = local_client.unlock_path(file_out)
             try:
-                shutil.copy(local_client.abspath(pair.local_path), file_out)
+                method = copy_file(duplicate, file_out)
             finally:
                 local_client.lock_path(file_out, locker)
+            log.debug('Copied local duplicate %r (%s)', duplicate, method)
             return file_out
 
         tmp_file = remote_client.stream_content(
@@ -1,28 +1,26 @@
 # coding: utf-8
 import time
-from Queue import Empty, Queue
-from copy import deepcopy
-from threading import Lock, local
+from Queue import Empty
+from collections import deque
+from itertools import count
+from threading import Lock, current_thread, local
 
 from PyQt4.QtCore import QObject, QTimer, pyqtSignal, pyqtSlot
 
+from nxdrive.engine.blacklist_queue import BlacklistQueue, get_backoffs
 from nxdrive.engine.processor import Processor
+from nxdrive.engine.scheduler import CHEAP_STATES, FolderClaims, PairQueue, \
+    PoolSizer, QUEUE_POLICIES, QueueItem
 from nxdrive.logging_config import get_logger
+from nxdrive.options import Options
+from nxdrive.utils import PathTrie
 
 log = get_logger(__name__)
 WINERROR_CODE_PROCESS_CANNOT_ACCESS_FILE = 32
-
-
-class QueueItem(object):
-    def __init__(self, row_id, folderish, pair_state):
-        self.id = row_id
-        self.folderish = folderish
-        self.pair_state = pair_state
-
-    def __repr__(self):
-        return "%s[%s](Folderish:%s, State: %s)" % (
-                        self.__class__.__name__, self.id,
-                        self.folderish, self.pair_state)
+# Number of paths kept by QueueManager.prioritize()
+PRIORITIZED_PATHS = 10
+# The next rows to synchronize are loaded from the database below this size
+QUEUE_REFILL_SIZE = 500
 
 
 class QueueManager(QObject):
@@ -40,10 +38,22 @@ class QueueManager(QObject):
         super(QueueManager, self).__init__()
         self._dao = dao
         self._engine = engine
-        self._local_folder_queue = Queue()
-        self._local_file_queue = Queue()
-        self._remote_file_queue = Queue()
-        self._remote_folder_queue = Queue()
+        policy = QUEUE_POLICIES.get(Options.queue_policy)
+        if policy is None:
+            log.warning('Unknown queue policy %r, using the default one',
+                        Options.queue_policy)
+            policy = QUEUE_POLICIES['priority']
+        self._prioritized_paths = deque(maxlen=PRIORITIZED_PATHS)
+        self._prioritized = PathTrie()
+
+        def key(item):
+            return policy(item, self._prioritized)
+
+        sequence = count()
+        self._local_folder_queue = PairQueue(key, sequence)
+        self._local_file_queue = PairQueue(key, sequence)
+        self._remote_file_queue = PairQueue(key, sequence)
+        self._remote_folder_queue = PairQueue(key, sequence)
         self._connected = local()
         self._local_folder_enable = True
         self._local_file_enable = True
@@ -53,11 +63,27 @@ class QueueManager(QObject):
         self._local_file_thread = None
         self._remote_folder_thread = None
         self._remote_file_thread = None
+        # Additional folder processors, for the folders of disjoint subtrees
+        self._max_folder_processors = max(1, Options.folder_processors)
+        self._local_folder_pool = list()
+        self._remote_folder_pool = list()
+        self._folder_claims = FolderClaims()
+        # Pushes merged into an already queued item
+        self._coalesced = 0
         self._error_threshold = 3
         self._error_interval = 60
         self.set_max_processors(max_file_processors)
+        self._pool_sizer = None
+        if Options.processors_adaptive:
+            self._pool_sizer = PoolSizer(self._max_processors,
+                                         Options.processors_min,
+                                         Options.processors_max)
+            self._max_processors = self._pool_sizer.size
         self._threads_pool = list()
         self._processors_pool = list()
+        # Generic processors not told to stop yet, the pool only shrinks
+        # once their threads are finished
+        self._running_processors = 0
         self._get_file_lock = Lock()
         # Should not operate on thread while we are inspecting them
         '''
@@ -77,8 +103,12 @@ class QueueManager(QObject):
 
         # ERROR HANDLING
         self._error_lock = Lock()
-        self._on_error_queue = dict()
+        self._on_error_queue = BlacklistQueue(
+            delay=self._error_interval,
+            backoffs=get_backoffs(Options.error_backoff))
+        # Started for the next retry only
         self._error_timer = QTimer()
+        self._error_timer.setSingleShot(True)
         self._error_timer.timeout.connect(self._on_error_timer)
         self.newError.connect(self._on_new_error)
         self.queueProcessing.connect(self.launch_processors)
@@ -99,16 +129,32 @@ class QueueManager(QObject):
             pass
 
     def init_queue(self, queue):
-        # Dont need to change modify as State is compatible with QueueItem
         for item in queue:
             self.push(item)
 
     @staticmethod
     def _copy_queue(queue):
-        result = deepcopy(queue.queue)
+        result = queue.get_items()
         result.reverse()
         return result
 
+    def _get_queues(self):
+        return (self._local_folder_queue, self._local_file_queue,
+                self._remote_folder_queue, self._remote_file_queue)
+
+    def prioritize(self, path):
+        """
+        Process first the items at or below this path, the user is looking
+        at it.  Only the last PRIORITIZED_PATHS paths are kept.
+        """
+        if path in self._prioritized_paths:
+            return
+        log.debug('Prioritizing the items under %r', path)
+        self._prioritized_paths.append(path)
+        self._prioritized = PathTrie(self._prioritized_paths)
+        for queue in self._get_queues():
+            queue.reprioritize()
+
     def set_max_processors(self, max_file_processors):
         if max_file_processors < 2:
             max_file_processors = 2
@@ -146,6 +192,9 @@ class QueueManager(QObject):
         self._local_folder_enable = value
         if self._local_folder_thread is not None and not value:
             self._local_folder_thread.quit()
+        if not value:
+            for thread in self._local_folder_pool:
+                thread.quit()
         if value and emit:
             self.queueProcessing.emit()
 
@@ -160,6 +209,9 @@ class QueueManager(QObject):
         self._remote_folder_enable = value
         if self._remote_folder_thread is not None and not value:
             self._remote_folder_thread.quit()
+        if not value:
+            for thread in self._remote_folder_pool:
+                thread.quit()
         if value and emit:
             self.queueProcessing.emit()
 
@@ -175,61 +227,90 @@ class QueueManager(QObject):
     def get_remote_folder_queue(self):
         return self._copy_queue(self._remote_folder_queue)
 
-    def push_ref(self, row_id, folderish, pair_state):
-        self.push(QueueItem(row_id, folderish, pair_state))
+    def push_ref(self, row_id, folderish, pair_state, *args, **kwargs):
+        """ The extra arguments are the ones of QueueItem. """
+        self.push(QueueItem(row_id, folderish, pair_state, *args, **kwargs))
+
+    def push_refs(self, refs):
+        """
+        Push several (row_id, folderish, pair_state[, path, size,
+        error_count]), notifying only once.
+        """
+        last_id = None
+        for ref in refs:
+            if self._put(QueueItem(*ref)):
+                last_id = ref[0]
+        if last_id is not None:
+            self.newItem.emit(last_id)
 
     def push(self, state):
+        if not isinstance(state, QueueItem):
+            # A row of the States table, keep only what is needed
+            state = QueueItem.from_pair(state)
+        if self._put(state):
+            self.newItem.emit(state.id)
+
+    def _put(self, state):
+        """
+        Queue the state, coalescing it with the pending item of the same
+        row if any.  Return True if a processor has to be notified.
+        """
         if state.pair_state is None:
             log.trace("Don't push an empty pair_state: %r", state)
-            return
+            return False
         log.trace("Pushing %r", state)
-        row_id = state.id
         if state.pair_state.startswith('locally'):
-            if state.folderish:
-                self._local_folder_queue.put(state)
-                log.trace('Pushed to _local_folder_queue, now of size: %d', self._local_folder_queue.qsize())
-            else:
-                if "deleted" in state.pair_state:
-                    self._engine.cancel_action_on(state.id)
-                self._local_file_queue.put(state)
-                log.trace('Pushed to _local_file_queue, now of size: %d', self._local_file_queue.qsize())
-            self.newItem.emit(row_id)
+            queue = (self._local_folder_queue if state.folderish
+                     else self._local_file_queue)
         elif state.pair_state.startswith('remotely'):
-            if state.folderish:
-                self._remote_folder_queue.put(state)
-                log.trace('Pushed to _remote_folder_queue, now of size: %d', self._remote_folder_queue.qsize())
-            else:
-                if "deleted" in state.pair_state:
-                    self._engine.cancel_action_on(state.id)
-                self._remote_file_queue.put(state)
-                log.trace('Pushed to _remote_file_queue, now of size: %d', self._remote_file_queue.qsize())
-            self.newItem.emit(row_id)
+            queue = (self._remote_folder_queue if state.folderish
+                     else self._remote_file_queue)
         else:
             # deleted and conflicted
             log.debug("Not processable state: %r", state)
+            return False
+        if not state.folderish and "deleted" in state.pair_state:
+            self._engine.cancel_action_on(state.id)
+        # The row may have changed of direction since it was queued
+        moved = any([other.discard(state.id) for other in self._get_queues()
+                     if other is not queue])
+        if queue.put(state):
+            log.trace('Pushed %r, queue now of size: %d',
+                      state.id, queue.qsize())
+            if moved:
+                self._coalesced += 1
+            return True
+        log.trace('Coalesced with the pending item: %r', state)
+        self._coalesced += 1
+        return False
 
     @pyqtSlot()
     def _on_error_timer(self):
-        cur_time = int(time.time())
         self._error_lock.acquire()
         try:
-            for doc_pair in self._on_error_queue.values():
-                if doc_pair.error_next_try < cur_time:
-                    queue_item = QueueItem(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
-                    del self._on_error_queue[doc_pair.id]
-                    log.debug('End of blacklist period, pushing doc_pair: %r', doc_pair)
-                    self.push(queue_item)
-            if len(self._on_error_queue) == 0:
-                self._error_timer.stop()
+            item = self._on_error_queue.get()
+            while item is not None:
+                doc_pair = item.get()
+                log.debug('End of blacklist period, pushing doc_pair: %r', doc_pair)
+                self.push(QueueItem.from_pair(doc_pair))
+                item = self._on_error_queue.get()
         finally:
             self._error_lock.release()
+        self._schedule_error_timer()
+
+    def _schedule_error_timer(self):
+        wait = self._on_error_queue.get_next_wait()
+        if wait is None:
+            self._error_timer.stop()
+        else:
+            self._error_timer.start(int(wait * 1000))
 
     def _is_on_error(self, row_id):
         return row_id in self._on_error_queue
 
     @pyqtSlot()
     def _on_new_error(self):
-        self._error_timer.start(1000)
+        self._schedule_error_timer()
 
     def get_errors_count(self):
         return len(self._on_error_queue)
@@ -238,6 +319,8 @@ class QueueManager(QObject):
         return self._error_threshold
 
     def push_error(self, doc_pair, exception=None, interval=None):
+        if self._pool_sizer is not None:
+            self._pool_sizer.record(0, error=True)
         error_count = doc_pair.error_count
         if (isinstance(exception, OSError)
                 and hasattr(exception, 'winerror')
@@ -250,102 +333,118 @@ class QueueManager(QObject):
             self.newErrorGiveUp.emit(doc_pair.id)
             log.debug("Giving up on pair : %r", doc_pair)
             return
-        if interval is None:
-            interval = self._error_interval * error_count
-        doc_pair.error_next_try = interval + int(time.time())
-        log.debug("Blacklisting pair for %ds: %r", interval, doc_pair)
         self._error_lock.acquire()
         try:
-            emit_sig = False
-            if doc_pair.id not in self._on_error_queue:
-                emit_sig = True
-            self._on_error_queue[doc_pair.id] = doc_pair
-            if emit_sig:
-                self.newError.emit(doc_pair.id)
+            # The backoff depends on the error type
+            item = self._on_error_queue.push(
+                doc_pair.id, doc_pair, next_try=interval, count=error_count,
+                error=doc_pair.last_error)
         finally:
             self._error_lock.release()
+        doc_pair.error_next_try = item.get_next_try()
+        log.debug("Blacklisting pair for %ds: %r",
+                  doc_pair.error_next_try - int(time.time()), doc_pair)
+        self.newError.emit(doc_pair.id)
 
     def requeue_errors(self):
-        self._error_lock.acquire()
-        try:
-            for doc_pair in self._on_error_queue.values():
-                doc_pair.error_next_try = 0
-        finally:
-            self._error_lock.release()
+        self._on_error_queue.retry_all()
+        self.newError.emit(None)
+
+    def _refill(self):
+        """ Load the next rows to synchronize when the queues run low. """
+        if (not self._dao.is_queue_loaded()
+                and self.get_overall_size() < QUEUE_REFILL_SIZE):
+            self._dao.queue_next_page()
+
+    def _get_item(self, queue):
+        self._refill()
+        while True:
+            try:
+                state = queue.get()
+            except Empty:
+                return None
+            if not self._is_on_error(state.id):
+                return state
+
+    def _get_folder(self, queue):
+        """
+        Take the next folder whose ancestors and descendants are not being
+        processed by another thread, once done with the previous one.
+        """
+        thread_id = current_thread().ident
+        if self._folder_claims.release(thread_id):
+            # Folders were waiting for the previous one
+            self.newItem.emit(None)
+        self._refill()
+        return self._folder_claims.get(
+            queue, thread_id, skip=lambda state: self._is_on_error(state.id))
 
     def _get_local_folder(self):
-        if self._local_folder_queue.empty():
-            return None
-        try:
-            state = self._local_folder_queue.get(True, 3)
-        except Empty:
-            return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_local_folder()
-        return state
+        return self._get_folder(self._local_folder_queue)
 
     def _get_local_file(self):
-        if self._local_file_queue.empty():
-            return None
-        try:
-            state = self._local_file_queue.get(True, 3)
-        except Empty:
-            return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_local_file()
-        return state
+        return self._get_item(self._local_file_queue)
 
     def _get_remote_folder(self):
-        if self._remote_folder_queue.empty():
-            return None
-        try:
-            state = self._remote_folder_queue.get(True, 3)
-        except Empty:
-            return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_remote_folder()
-        return state
+        return self._get_folder(self._remote_folder_queue)
 
     def _get_remote_file(self):
-        if self._remote_file_queue.empty():
-            return None
-        try:
-            state = self._remote_file_queue.get(True, 3)
-        except Empty:
-            return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_remote_file()
-        return state
+        return self._get_item(self._remote_file_queue)
 
     def _get_file(self):
-        self._get_file_lock.acquire()
-        if self._remote_file_queue.empty() and self._local_file_queue.empty():
-            self._get_file_lock.release()
-            return None
-        if self._remote_file_queue.qsize() > self._local_file_queue.qsize():
-            state = self._get_remote_file()
-        else:
-            state = self._get_local_file()
-        self._get_file_lock.release()
-        if state is not None and self._is_on_error(state.id):
-            return self._get_file()
-        return state
+        """ Take the file of highest priority, be it local or remote. """
+        self._refill()
+        while True:
+            with self._get_file_lock:
+                if self._running_processors > self._max_processors:
+                    # The pool has been shrunk, stop this processor
+                    self._running_processors -= 1
+                    return None
+                local_key = self._local_file_queue.peek_key()
+                remote_key = self._remote_file_queue.peek_key()
+                if local_key is None and remote_key is None:
+                    # Nothing left, the processor stops
+                    self._running_processors -= 1
+                    return None
+                if local_key is None or (remote_key is not None
+                                         and remote_key < local_key):
+                    queue = self._remote_file_queue
+                else:
+                    queue = self._local_file_queue
+                try:
+                    state = queue.get()
+                except Empty:
+                    # Taken by its dedicated processor meanwhile
+                    continue
+            if not self._is_on_error(state.id):
+                return state
 
     @pyqtSlot()
     def _thread_finished(self):
         self._thread_inspection.acquire()
         try:
-            for thread in self._processors_pool:
+            for thread in self._processors_pool[:]:
                 if thread.isFinished():
                     self._processors_pool.remove(thread)
+            with self._get_file_lock:
+                # Processors that ended on an error were still counted
+                self._running_processors = min(self._running_processors,
+                                               len(self._processors_pool))
+            for pool in (self._local_folder_pool, self._remote_folder_pool):
+                for thread in pool[:]:
+                    if thread.isFinished():
+                        self._release_folder(thread)
+                        pool.remove(thread)
             if (self._local_folder_thread is not None and
                     self._local_folder_thread.isFinished()):
+                self._release_folder(self._local_folder_thread)
                 self._local_folder_thread = None
             if (self._local_file_thread is not None and
                     self._local_file_thread.isFinished()):
                 self._local_file_thread = None
             if (self._remote_folder_thread is not None and
                     self._remote_folder_thread.isFinished()):
+                self._release_folder(self._remote_folder_thread)
                 self._remote_folder_thread = None
             if (self._remote_file_thread is not None and
                     self._remote_file_thread.isFinished()):
@@ -355,6 +454,10 @@ class QueueManager(QObject):
         finally:
             self._thread_inspection.release()
 
+    def _release_folder(self, thread):
+        # The processor may have been interrupted in the middle of a folder
+        self._folder_claims.release(thread.worker.get_thread_id())
+
     def active(self):
         # Recheck threads
         self._thread_finished()
@@ -365,17 +468,41 @@ class QueueManager(QObject):
                 or self._local_file_thread is not None
                 or self._remote_file_thread is not None
                 or self._remote_folder_thread is not None
+                or len(self._local_folder_pool) > 0
+                or len(self._remote_folder_pool) > 0
                 or len(self._processors_pool) > 0)
 
     def _create_thread(self, item_getter, **kwargs):
         log.debug('Creating %s', kwargs.get('name'))
         processor = self._engine.create_processor(item_getter, **kwargs)
+        if self._pool_sizer is not None:
+            processor.pairSync.connect(self._on_pair_sync)
         thread = self._engine.create_thread(worker=processor)
         thread.finished.connect(self._thread_finished)
         thread.terminated.connect(self._thread_finished)
         thread.start()
         return thread
 
+    @pyqtSlot(object, object)
+    def _on_pair_sync(self, doc_pair, metrics):
+        latency = (metrics['end_time'] - metrics['start_time']) / 1000.0
+        size = 0
+        if not doc_pair.folderish and metrics['handler'] not in CHEAP_STATES:
+            size = doc_pair.size or 0
+        self._pool_sizer.record(latency, size)
+        self._adjust_processors()
+
+    def _adjust_processors(self):
+        size = self._pool_sizer.adjust(self._local_file_queue.qsize()
+                                       + self._remote_file_queue.qsize())
+        if size == self._max_processors:
+            return
+        grow = size > self._max_processors
+        with self._get_file_lock:
+            self._max_processors = size
+        if grow:
+            self.newItem.emit(None)
+
     def get_metrics(self):
         metrics = {
             'local_folder_queue': self._local_folder_queue.qsize(),
@@ -386,9 +513,27 @@ class QueueManager(QObject):
             'remote_folder_thread': self._remote_folder_thread is not None,
             'local_file_thread': self._local_file_thread is not None,
             'local_folder_thread': self._local_folder_thread is not None,
+            'queue_loaded': self._dao.is_queue_loaded(),
             'error_queue': self.get_errors_count(),
+            'error_next_retry': self._on_error_queue.get_next_wait(),
+            'error_retry_waits':
+                self._on_error_queue.get_metrics()['retry_waits'],
+            'coalesced_pushes': self._coalesced,
             'additional_processors': len(self._processors_pool),
+            'additional_folder_processors': (len(self._local_folder_pool)
+                                             + len(self._remote_folder_pool)),
+            'processors_adaptive': self._pool_sizer is not None,
+            'processors_target': self._max_processors,
         }
+        for name, value in self._folder_claims.get_metrics().iteritems():
+            metrics['folders_' + name] = value
+        cache_metrics = self._engine.get_remote_info_cache().get_metrics()
+        for name, value in cache_metrics.iteritems():
+            metrics['remote_info_' + name] = value
+        if self._pool_sizer is not None:
+            metrics['processors_decision'] = self._pool_sizer.decision
+            for name, value in self._pool_sizer.metrics.iteritems():
+                metrics['processors_' + name] = value
         metrics['total_queue'] = (metrics['local_folder_queue']
                                   + metrics['local_file_queue']
                                   + metrics['remote_folder_queue']
@@ -444,7 +589,9 @@ class QueueManager(QObject):
                     self._remote_file_thread, path, exact_match=exact_match):
                 res.append(self._remote_file_thread.worker)
             else:
-                for thread in self._processors_pool:
+                for thread in (self._local_folder_pool
+                               + self._remote_folder_pool
+                               + self._processors_pool):
                     if self.is_processing_file(
                             thread, path, exact_match=exact_match):
                         res.append(thread.worker)
@@ -468,6 +615,7 @@ class QueueManager(QObject):
 
     @pyqtSlot()
     def launch_processors(self):
+        self._refill()
         if (self._disable or self.is_paused()
             or (self._local_folder_queue.empty()
                 and self._local_file_queue.empty()
@@ -484,6 +632,11 @@ class QueueManager(QObject):
             self._local_folder_thread = self._create_thread(
                 self._get_local_folder, name='LocalFolderProcessor')
 
+        if self._local_folder_enable:
+            self._extend_folder_pool(
+                self._local_folder_pool, self._local_folder_queue,
+                self._get_local_folder, 'LocalFolderProcessor')
+
         if (self._local_file_thread is None
                 and not self._local_file_queue.empty()
                 and self._local_file_enable):
@@ -496,6 +649,11 @@ class QueueManager(QObject):
             self._remote_folder_thread = self._create_thread(
                 self._get_remote_folder, name='RemoteFolderProcessor')
 
+        if self._remote_folder_enable:
+            self._extend_folder_pool(
+                self._remote_folder_pool, self._remote_folder_queue,
+                self._get_remote_folder, 'RemoteFolderProcessor')
+
         if (self._remote_file_thread is None
                 and not self._remote_file_queue.empty()
                 and self._remote_file_enable):
@@ -507,5 +665,14 @@ class QueueManager(QObject):
             return
 
         while len(self._processors_pool) < self._max_processors:
+            with self._get_file_lock:
+                self._running_processors += 1
             self._processors_pool.append(self._create_thread(
                 self._get_file, name='GenericProcessor'))
+
+    def _extend_folder_pool(self, pool, queue, item_getter, name):
+        """ Add folder processors while there are enough folders queued. """
+        # The dedicated folder processor is the first one
+        while len(pool) + 1 < min(self._max_folder_processors,
+                                  queue.qsize()):
+            pool.append(self._create_thread(item_getter, name=name))
@@ -0,0 +1,443 @@
+# coding: utf-8
+"""
+Scheduling of the QueueManager items.
+
+A policy gives the sort key of a queue item: the items are processed by
+ascending key, then in their arrival order.  Folders are always sorted by
+depth first, so a parent folder is created before its children whatever
+the policy.
+
+The FolderClaims let several processors take folders from a same queue,
+without processing a folder before its parent.
+
+The PoolSizer adapts the number of generic processors to the observed
+throughput.
+"""
+import time
+from copy import deepcopy
+from heapq import heapify, heappop, heappush
+from itertools import count
+from Queue import Empty
+from threading import Lock
+
+from nxdrive.logging_config import get_logger
+
+log = get_logger(__name__)
+
+# States handled without transferring any content
+CHEAP_STATES = ('locally_deleted', 'remotely_deleted', 'locally_moved',
+                'remotely_moved', 'locally_renamed', 'remotely_renamed')
+
+
+class QueueItem(object):
+    def __init__(self, row_id, folderish, pair_state, path=None, size=0,
+                 error_count=0):
+        self.id = row_id
+        self.folderish = folderish
+        self.pair_state = pair_state
+        # Only used to prioritize the item
+        self.path = path
+        self.size = size
+        self.error_count = error_count
+        self.queued_time = time.time()
+
+    @classmethod
+    def from_pair(cls, pair):
+        return cls(pair.id, pair.folderish, pair.pair_state,
+                   path=pair.get_expected_local_path(), size=pair.size,
+                   error_count=pair.error_count)
+
+    def __repr__(self):
+        return "%s[%s](Folderish:%s, State: %s)" % (
+                        self.__class__.__name__, self.id,
+                        self.folderish, self.pair_state)
+
+
+def _depth(item):
+    return item.path.count('/') if item.path else 0
+
+
+def fifo_policy(item, prioritized):
+    """ Keep the arrival order, the legacy behavior. """
+    if item.folderish:
+        return _depth(item),
+    return ()
+
+
+def priority_policy(item, prioritized):
+    """
+    Files: the ones in error last, then the paths the user is looking at,
+    the operations without any transfer and the smallest files first.
+    """
+    wanted = 0 if item.path and prioritized.is_filtered(item.path) else 1
+    if item.folderish:
+        return _depth(item), wanted
+    cheap = 0 if item.pair_state in CHEAP_STATES else 1
+    # Files of the same order of magnitude keep their arrival order
+    size = (item.size or 0).bit_length()
+    return item.error_count or 0, wanted, cheap, size, _depth(item)
+
+
+def download_first_policy(item, prioritized):
+    key = priority_policy(item, prioritized)
+    if item.folderish:
+        return key
+    return (0 if item.pair_state.startswith('remotely') else 1,) + key
+
+
+def upload_first_policy(item, prioritized):
+    key = priority_policy(item, prioritized)
+    if item.folderish:
+        return key
+    return (0 if item.pair_state.startswith('locally') else 1,) + key
+
+
+# Values of Options.queue_policy
+QUEUE_POLICIES = {
+    'download_first': download_first_policy,
+    'fifo': fifo_policy,
+    'priority': priority_policy,
+    'upload_first': upload_first_policy,
+}
+
+
+class IndexedHeap(object):
+    """
+    Min-heap of items indexed by their id, not thread-safe.
+    Entries are [key, sequence, item, item_id] lists, ordered by key then
+    sequence.
+    Replacing or removing an item only marks its entry as removed, the
+    marked entries are skipped when they reach the head of the heap.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # Item id -> pending entry
+        self._entries = dict()
+
+    def push(self, item_id, key, sequence, item):
+        """ Add the item, replacing the pending one of the same id. """
+        self.discard(item_id)
+        entry = self._entries[item_id] = [key, sequence, item, item_id]
+        heappush(self._heap, entry)
+        self._compact()
+
+    def get_entry(self, item_id):
+        """ Return the pending entry of the id, or None. """
+        return self._entries.get(item_id)
+
+    def discard(self, item_id):
+        """ Remove the item, if pending. Return True if it was. """
+        entry = self._entries.pop(item_id, None)
+        if entry is None:
+            return False
+        entry[2] = None
+        self._compact()
+        return True
+
+    def _compact(self):
+        # Rebuild the heap when it is mostly made of removed entries
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heapify()
+
+    def _heapify(self):
+        self._heap = self._entries.values()
+        heapify(self._heap)
+
+    def _prune(self):
+        # Drop the removed entries from the head
+        while self._heap and self._heap[0][2] is None:
+            heappop(self._heap)
+
+    def peek(self):
+        """ Return the entry of the next item, or None. """
+        self._prune()
+        return self._heap[0] if self._heap else None
+
+    def pop(self):
+        """ Remove and return the next item, raise IndexError if none. """
+        self._prune()
+        entry = heappop(self._heap)
+        del self._entries[entry[3]]
+        return entry[2]
+
+    def rekey(self, key):
+        """ Compute again the key of every entry with key(item). """
+        for entry in self._entries.itervalues():
+            entry[0] = key(entry[2])
+        self._heapify()
+
+    def entries(self):
+        """ Return the pending entries, in no particular order. """
+        return self._entries.values()
+
+    def __contains__(self, item_id):
+        return item_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PairQueue(object):
+    """
+    Thread-safe heap of queue items, push and pop are in O(log n).
+    The sequence is shared by the queues of a QueueManager so their heads
+    can be compared.
+    A row is queued only once: pushing it again updates the pending item,
+    which keeps its place in the arrival order.
+    """
+
+    def __init__(self, key, sequence=None):
+        self._key = key
+        self._sequence = sequence or count()
+        self._heap = IndexedHeap()
+        self._lock = Lock()
+
+    def put(self, item):
+        """ Return False if the row was already queued. """
+        key = self._key(item)
+        with self._lock:
+            entry = self._heap.get_entry(item.id)
+            if entry is None:
+                sequence = next(self._sequence)
+            else:
+                # Waiting since the first push
+                item.queued_time = entry[2].queued_time
+                if entry[0] == key:
+                    entry[2] = item
+                    return False
+                # The priority changed, the item keeps its place
+                sequence = entry[1]
+            self._heap.push(item.id, key, sequence, item)
+            return entry is None
+
+    def discard(self, row_id):
+        """ Remove the row, if queued. Return True if it was. """
+        with self._lock:
+            return self._heap.discard(row_id)
+
+    def get(self):
+        with self._lock:
+            try:
+                return self._heap.pop()
+            except IndexError:
+                raise Empty()
+
+    def peek_key(self):
+        """ Return the (key, sequence) of the next item, or None. """
+        with self._lock:
+            entry = self._heap.peek()
+            if entry is None:
+                return None
+            return tuple(entry[:2])
+
+    def reprioritize(self):
+        """ Compute again the keys, after a change of the policy inputs. """
+        with self._lock:
+            self._heap.rekey(self._key)
+
+    def get_items(self):
+        """ Return a copy of the items, in the processing order. """
+        with self._lock:
+            entries = sorted(self._heap.entries())
+        return deepcopy([entry[2] for entry in entries])
+
+    def empty(self):
+        return not self._heap
+
+    def qsize(self):
+        return len(self._heap)
+
+    def __contains__(self, row_id):
+        return row_id in self._heap
+
+
+class FolderClaims(object):
+    """
+    Folders being processed, by thread.
+
+    The folders are sorted by depth in their queue, so a parent is always
+    taken before its children.  With several processors on a queue, a
+    folder is not given while one of its ancestors or descendants is still
+    being processed by another thread: it is deferred until that thread
+    releases its folder.  Disjoint subtrees are processed concurrently.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # Thread id -> item being processed
+        self._claims = dict()
+        # Thread id -> [(queue, item)] waiting for the thread to be done
+        self._deferred = dict()
+
+    @staticmethod
+    def _is_related(path, other):
+        if path is None or other is None:
+            # Unknown location, it could be anywhere
+            return True
+        path = path.rstrip('/') + '/'
+        other = other.rstrip('/') + '/'
+        return path.startswith(other) or other.startswith(path)
+
+    def get(self, queue, thread_id, skip=None):
+        """
+        Claim the next folder of the queue that can be processed, or return
+        None.  skip(item) tells if an item has to be dropped.
+        """
+        with self._lock:
+            while True:
+                try:
+                    item = queue.get()
+                except Empty:
+                    return None
+                if skip is not None and skip(item):
+                    continue
+                blocker = next((other_id for other_id, other
+                                in self._claims.iteritems()
+                                if self._is_related(item.path, other.path)),
+                               None)
+                if blocker is None:
+                    self._claims[thread_id] = item
+                    return item
+                self._deferred.setdefault(blocker, []).append((queue, item))
+
+    def release(self, thread_id):
+        """
+        The thread is done with its folder: queue again the folders that
+        were waiting for it.  Return their number.
+        """
+        with self._lock:
+            self._claims.pop(thread_id, None)
+            deferred = self._deferred.pop(thread_id, ())
+            for queue, item in deferred:
+                # Unless pushed again meanwhile
+                if item.id not in queue:
+                    queue.put(item)
+        return len(deferred)
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'claimed': len(self._claims),
+                'deferred': sum(len(items)
+                                for items in self._deferred.itervalues()),
+            }
+
+
+class PoolSizer(object):
+    """
+    Hill climbing on the throughput of the processors.
+
+    Every interval, the throughput of the last window is compared to the
+    one of the previous window: the pool keeps changing in the same
+    direction while it improves, and goes back when it degrades.
+    Small files are latency bound, so their item rate is measured and the
+    pool grows first.  Big files are bandwidth bound, so their byte rate
+    is measured and the pool shrinks first, as long as the rate holds.
+    Too many errors shrink the pool, whatever the throughput.
+    """
+
+    # Mean size above which the transfers are considered bandwidth bound
+    big_item_size = 1024 * 1024
+    # Relative throughput change considered as noise
+    tolerance = 0.05
+    error_threshold = 0.2
+
+    def __init__(self, size, minimum, maximum, interval=10, clock=time.time):
+        self.minimum = max(0, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.size = min(max(size, self.minimum), self.maximum)
+        self._interval = interval
+        self._clock = clock
+        self._lock = Lock()
+        self._direction = 0
+        self._last_score = None
+        self._big = False
+        self.decision = None
+        self.metrics = dict()
+        self._reset(clock())
+
+    def _reset(self, now):
+        self._start = now
+        self._items = 0
+        self._errors = 0
+        self._bytes = 0
+        self._latency = 0.0
+
+    def record(self, latency, size=0, error=False):
+        """ Record an item processed in latency seconds. """
+        with self._lock:
+            if error:
+                self._errors += 1
+                return
+            self._items += 1
+            self._bytes += size
+            self._latency += latency
+
+    def adjust(self, backlog):
+        """
+        Return the new pool size, once the window is over.
+        backlog is the number of files waiting to be processed.
+        """
+        now = self._clock()
+        with self._lock:
+            elapsed = float(now - self._start)
+            if elapsed < self._interval:
+                return self.size
+            items, errors, transferred = (self._items, self._errors,
+                                          self._bytes)
+            latency = self._latency / items if items else 0
+            self._reset(now)
+
+        total = items + errors
+        if not total:
+            # Nothing processed, there is nothing to measure
+            self._last_score = None
+            return self.size
+        big = bool(items) and transferred / items > self.big_item_size
+        error_rate = float(errors) / total
+        score = (transferred if big else items) / elapsed
+        self.metrics = {
+            'items_rate': items / elapsed,
+            'bytes_rate': transferred / elapsed,
+            'latency': latency,
+            'error_rate': error_rate,
+        }
+
+        preferred = -1 if big else 1
+        if error_rate > self.error_threshold:
+            step, self._direction, reason = -1, 0, 'errors'
+        elif self._last_score is None or big != self._big:
+            step = self._direction = preferred
+            reason = 'bandwidth bound' if big else 'latency bound'
+        else:
+            gain = (score - self._last_score) / (self._last_score or 1)
+            if not self._direction:
+                # Stable, probe again only if the workload changed
+                changed = abs(gain) > self.tolerance
+                step = self._direction = preferred if changed else 0
+                reason = 'workload changed' if changed else 'stable'
+            elif gain < -self.tolerance:
+                # Go back to the previous size and stay there
+                step, self._direction = -self._direction, 0
+                reason = 'throughput dropped'
+                score = self._last_score
+            elif gain > self.tolerance:
+                step, reason = self._direction, 'throughput improved'
+            elif self._direction < 0:
+                # Less processors for the same throughput is still better
+                step, reason = -1, 'throughput held'
+            else:
+                step, self._direction, reason = 0, 0, 'throughput held'
+        if step > 0 and backlog <= self.size:
+            step, self._direction, reason = 0, 0, 'no backlog'
+        self._last_score = score
+        self._big = big
+
+        size = min(max(self.size + step, self.minimum), self.maximum)
+        if size != self.size:
+            log.debug('Resizing the processors pool from %d to %d (%s):'
+                      ' %r', self.size, size, reason, self.metrics)
+            self.size = size
+        self.decision = reason
+        return self.size
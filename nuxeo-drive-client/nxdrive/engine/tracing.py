@@ -0,0 +1,344 @@
+# coding: utf-8
+"""
+Tracing of the synchronization of each pair.
+
+The Processor starts a trace for each pair it handles, the phases of its
+synchronization are recorded as spans of the trace of the current thread:
+DAO calls, remote calls, transfers, digests, local operations...
+Outside of a trace, or while tracing is disabled, recording a span costs a
+thread-local lookup only.
+
+The last traces are kept in a ring buffer, they can be exported as JSON or
+in the Chrome trace event format, to be opened in chrome://tracing.
+
+    >>> from nxdrive.engine.tracing import tracer, traced
+    >>> tracer.enable()
+    >>> @traced('local')
+    ... def scan(path):
+    ...     pass
+    >>> with tracer.trace('sync', pair=42):
+    ...     with tracer.span('checks', 'handler'):
+    ...         scan('/')
+    >>> sorted(tracer.get_traces()[0]['phases'])
+    ['handler', 'local', 'other']
+"""
+import json
+import os
+import time
+from collections import deque
+from functools import wraps
+from threading import Lock, current_thread, local
+
+# Number of traces kept
+TRACES_SIZE = 1000
+
+# Spans recorded per trace, the next ones are only counted
+SPANS_SIZE = 1000
+
+
+class Span(object):
+    """ Timed phase of a trace, to be used as a context manager. """
+
+    __slots__ = ('name', 'category', 'args', 'start', 'end', 'self_time',
+                 '_trace')
+
+    def __init__(self, trace, name, category, args):
+        self._trace = trace
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = self.end = None
+        # Duration without the one of the nested spans
+        self.self_time = 0
+
+    def __enter__(self):
+        self._trace.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self._trace.pop(self)
+
+    def get_duration(self):
+        return self.end - self.start
+
+
+class NullSpan(object):
+    """ Span recording nothing, when there is no trace to record to. """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Trace(object):
+    """ Spans of the synchronization of an item, in one thread. """
+
+    def __init__(self, name, args, clock=time.time, queued_time=None):
+        thread = current_thread()
+        self.name = name
+        self.args = args
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.queued_time = queued_time
+        self.spans = []
+        self.dropped = 0
+        self._clock = clock
+        self._stack = []
+        self.start = clock()
+        self.end = None
+
+    def push(self, span):
+        span.start = self._clock()
+        self._stack.append(span)
+
+    def pop(self, span):
+        span.end = self._clock()
+        duration = span.get_duration()
+        span.self_time += duration
+        self._stack.pop()
+        if self._stack:
+            self._stack[-1].self_time -= duration
+        if len(self.spans) < SPANS_SIZE:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+    def annotate(self, **args):
+        """ Add arguments to the current span, or to the trace. """
+        (self._stack[-1] if self._stack else self).args.update(args)
+
+    def get_duration(self):
+        return self.end - self.start
+
+    def get_queue_wait(self):
+        if self.queued_time is None:
+            return 0
+        return max(0, self.start - self.queued_time)
+
+    def get_phases(self):
+        """
+        Return the time spent by category, in seconds.  The time spent out
+        of any span is in 'other', the time spent in the queue in 'queue'.
+        """
+        phases = dict()
+        spanned = 0
+        for span in self.spans:
+            phases[span.category] = (phases.get(span.category, 0)
+                                     + span.self_time)
+            spanned += span.self_time
+        phases['other'] = max(0, self.get_duration() - spanned)
+        if self.queued_time is not None:
+            phases['queue'] = self.get_queue_wait()
+        return phases
+
+    def export(self):
+        return {
+            'name': self.name,
+            'args': self.args,
+            'thread': self.thread_name,
+            'start': self.start,
+            'duration': self.get_duration(),
+            'queue_wait': self.get_queue_wait(),
+            'phases': self.get_phases(),
+            'spans': [{
+                'name': span.name,
+                'category': span.category,
+                'args': span.args,
+                'start': span.start,
+                'duration': span.get_duration(),
+            } for span in sorted(self.spans, key=lambda span: span.start)],
+            'dropped_spans': self.dropped,
+        }
+
+
+class TraceContext(object):
+    """ Make the trace the current one of the thread while entered. """
+
+    __slots__ = ('_tracer', '_trace')
+
+    def __init__(self, tracer, trace):
+        self._tracer = tracer
+        self._trace = trace
+
+    def __enter__(self):
+        self._tracer._local.trace = self._trace
+        return self._trace
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        trace = self._trace
+        self._tracer._local.trace = None
+        trace.end = trace._clock()
+        if exc_type is not None:
+            trace.args['error'] = exc_type.__name__
+        self._tracer.record(trace)
+
+
+class Tracer(object):
+    """
+    Ring buffer of the last traces, recorded while enabled.
+    Enabling and disabling can be done at any time, from any thread.
+    """
+
+    def __init__(self, size=TRACES_SIZE, clock=time.time):
+        self.enabled = False
+        self._clock = clock
+        self._lock = Lock()
+        self._traces = deque(maxlen=size)
+        self._local = local()
+
+    def enable(self, size=None):
+        with self._lock:
+            if size is not None and size != self._traces.maxlen:
+                self._traces = deque(self._traces, maxlen=size)
+            self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self._lock:
+            self._traces.clear()
+
+    def trace(self, name, queued_time=None, **args):
+        """
+        Return a context manager tracing the synchronization of an item in
+        the current thread.  queued_time is when the item was queued.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return TraceContext(self, Trace(name, args, clock=self._clock,
+                                        queued_time=queued_time))
+
+    def get_current_trace(self):
+        return getattr(self._local, 'trace', None)
+
+    def span(self, name, category, **args):
+        """ Return a context manager recording a span of the current trace. """
+        trace = getattr(self._local, 'trace', None)
+        if trace is None:
+            return NULL_SPAN
+        return Span(trace, name, category, args)
+
+    def annotate(self, **args):
+        """ Add arguments to the current span of the thread, if any. """
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            trace.annotate(**args)
+
+    def record(self, trace):
+        with self._lock:
+            self._traces.append(trace)
+
+    def get_traces(self):
+        """ Return the traces as JSON serializable dicts, the oldest first. """
+        with self._lock:
+            traces = list(self._traces)
+        return [trace.export() for trace in traces]
+
+    def export_chrome(self):
+        """
+        Return the traces in the Chrome trace event format: a complete event
+        per trace and per span, and an async event per queue wait.
+        Timestamps are in microseconds.
+        """
+        with self._lock:
+            traces = list(self._traces)
+        pid = os.getpid()
+        events = []
+        threads = dict()
+
+        def to_us(seconds):
+            return int(seconds * 1000000)
+
+        for i, trace in enumerate(traces):
+            threads[trace.thread_id] = trace.thread_name
+            events.append({
+                'name': trace.name,
+                'cat': 'pair',
+                'ph': 'X',
+                'ts': to_us(trace.start),
+                'dur': to_us(trace.get_duration()),
+                'pid': pid,
+                'tid': trace.thread_id,
+                'args': dict(trace.args, phases=trace.get_phases()),
+            })
+            for span in trace.spans:
+                events.append({
+                    'name': span.name,
+                    'cat': span.category,
+                    'ph': 'X',
+                    'ts': to_us(span.start),
+                    'dur': to_us(span.get_duration()),
+                    'pid': pid,
+                    'tid': trace.thread_id,
+                    'args': span.args,
+                })
+            if trace.queued_time is not None:
+                # Not a span of the thread, it did something else meanwhile
+                for phase, ts in (('b', trace.queued_time),
+                                  ('e', trace.start)):
+                    events.append({
+                        'name': 'queue_wait',
+                        'cat': 'queue',
+                        'ph': phase,
+                        'id': i,
+                        'ts': to_us(ts),
+                        'pid': pid,
+                        'tid': trace.thread_id,
+                        'args': trace.args if phase == 'b' else {},
+                    })
+        for thread_id, thread_name in threads.iteritems():
+            events.append({
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': pid,
+                'tid': thread_id,
+                'args': {'name': thread_name},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump_chrome(self, path):
+        """ Write the Chrome trace to a file. """
+        with open(path, 'w') as output:
+            json.dump(self.export_chrome(), output, default=repr)
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'traces': len(self._traces),
+                'size': self._traces.maxlen,
+            }
+
+
+tracer = Tracer()
+
+
+def traced(category, name=None):
+    """
+    Decorator recording the calls of a function as spans of the current
+    trace.  The span is named after the function by default.
+    """
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(tracer._local, 'trace', None) is None:
+                return func(*args, **kwargs)
+            with tracer.span(span_name, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -4,7 +4,7 @@ import re
 import sqlite3
 from Queue import Queue
 from threading import Lock
-from time import mktime, sleep, time
+from time import mktime, time
 
 from PyQt4.QtCore import pyqtSignal, pyqtSlot
 from watchdog.events import PatternMatchingEventHandler
@@ -93,13 +93,12 @@ class LocalWatcher(EngineWorker):
             self._action = Action("Full local scan")
             self._scan()
             self._end_action()
-            # Check Windows dequeue and folder scan only every 100 loops (1s)
             current_time_millis = int(round(time() * 1000))
             self._win_delete_interval = current_time_millis
             self._win_folder_scan_interval = current_time_millis
             while True:
-                self._interact()
-                sleep(0.01)
+                # Woken up by the watchdog events
+                self._wait(self._get_wait_timeout())
                 while not self._watchdog_queue.empty():
                     evt = self._watchdog_queue.get()
                     self.handle_watchdog_event(evt)
@@ -113,6 +112,13 @@ class LocalWatcher(EngineWorker):
         finally:
             self._stop_watchdog()
 
+    def _get_wait_timeout(self):
+        # Check the Windows dequeue and folder scan every second, if needed
+        if self._windows and (self._delete_events
+                              or self._folder_scan_events):
+            return 1
+        return None
+
     def win_queue_empty(self):
         return not self._delete_events
 
@@ -294,6 +300,8 @@ class LocalWatcher(EngineWorker):
         # Create a list of all children by their name
         to_scan = []
         to_scan_new = []
+        # New children are inserted all at once
+        to_insert = []
         children = {child.local_name: child for child in db_children}
 
         # Load all children from FS
@@ -330,7 +338,7 @@ class LocalWatcher(EngineWorker):
                             continue
                         log.debug('Found new %s %r', child_type, child_info.path)
                         self._metrics['new_files'] += 1
-                        self._dao.insert_local_state(child_info, info.path)
+                        to_insert.append(child_info)
                     else:
                         log.debug('Found potential moved file %r[%s]', child_info.path, remote_id)
                         doc_pair = self._dao.get_normal_state_from_remote(remote_id)
@@ -356,7 +364,7 @@ class LocalWatcher(EngineWorker):
                             self._metrics['new_files'] += 1
                             self._dao.insert_local_state(child_info, info.path)
                             self._protected_files[remote_id] = True
-                        elif doc_pair.processor > 0:
+                        elif self._dao.get_processor(doc_pair.id):
                             log.debug('Skip pair as it is being processed: %r', doc_pair)
                             continue
                         elif doc_pair.local_path == child_info.path:
@@ -414,7 +422,7 @@ class LocalWatcher(EngineWorker):
                 try:
                     last_mtime = unicode(child_info.last_modification_time.strftime(
                         "%Y-%m-%d %H:%M:%S"))
-                    if (child_pair.processor == 0
+                    if (not self._dao.get_processor(child_pair.id)
                             and child_pair.last_local_updated is not None
                             and last_mtime != child_pair.last_local_updated.split('.')[0]):
                         log.trace('Update file %r', child_info.path)
@@ -491,6 +499,21 @@ class LocalWatcher(EngineWorker):
                     self.increase_error(child_pair, "SCAN RECURSIVE", exception=e)
                     continue
 
+        if to_insert:
+            try:
+                self._dao.insert_local_states(to_insert, info.path)
+            except (sqlite3.IntegrityError, IOError, OSError):
+                log.debug('Cannot insert new children of %r at once,'
+                          ' inserting them one by one', info.path,
+                          exc_info=True)
+                for child_info in to_insert:
+                    try:
+                        self._dao.insert_local_state(child_info, info.path)
+                    except:
+                        log.exception('Error during recursive scan of %r,'
+                                      ' ignoring until next full scan',
+                                      child_info.path)
+
         for deleted in children.values():
             if deleted.pair_state == "remotely_created" or deleted.remote_state == "created":
                 continue
@@ -897,7 +920,7 @@ class LocalWatcher(EngineWorker):
                 moved = False
                 from_pair = self._dao.get_normal_state_from_remote(local_info.remote_ref)
                 if from_pair is not None:
-                    if from_pair.processor > 0 or from_pair.local_path == rel_path:
+                    if self._dao.get_processor(from_pair.id) or from_pair.local_path == rel_path:
                         # First condition is in process
                         # Second condition is a race condition
                         log.trace("Ignore creation or modification as the coming pair is being processed: %r",
@@ -1025,6 +1048,7 @@ class DriveFSEventHandler(PatternMatchingEventHandler):
         self.counter += 1
         log.trace('Queueing watchdog: %r', event)
         self.watcher._watchdog_queue.put(event)
+        self.watcher.wake()
 
 
 class DriveFSRootEventHandler(PatternMatchingEventHandler):
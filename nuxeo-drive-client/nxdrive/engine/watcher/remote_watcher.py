@@ -1,9 +1,10 @@
 # coding: utf-8
 import os
 import socket
+import sqlite3
+from collections import namedtuple
 from datetime import datetime
 from httplib import BadStatusLine
-from time import sleep
 from urllib2 import HTTPError, URLError
 
 from PyQt4.QtCore import pyqtSignal, pyqtSlot
@@ -20,6 +21,11 @@ from nxdrive.utils import current_milli_time, path_join
 
 log = get_logger(__name__)
 
+# New pair of a batch not inserted yet, enough to be the parent of the
+# next descendants of the batch
+PendingPair = namedtuple('PendingPair',
+                         'local_path remote_parent_path remote_ref')
+
 
 class RemoteWatcher(EngineWorker):
     initiate = pyqtSignal()
@@ -82,8 +88,11 @@ class RemoteWatcher(EngineWorker):
                     self._next_check = now + self.server_interval * 1000
                     if self._handle_changes(first_pass):
                         first_pass = False
-                sleep(0.01)
+                # Sleep until the next check, or a scan_pair
+                self._block((self._next_check - current_milli_time()) / 1000.0)
         except ThreadInterrupt:
+            # Resume an interrupted full scan where it stopped
+            self._dao.checkpoint_scanned()
             self.remoteWatcherStopped.emit()
             raise
 
@@ -229,7 +238,11 @@ class RemoteWatcher(EngineWorker):
             # Results are not necessarily sorted
             descendants_info = sorted(descendants_info, key=lambda x: x.path)
 
-            # Handle descendants
+            # Handle descendants, the database is updated once per batch
+            to_update = []
+            to_insert = []
+            # Remote ref -> parent pair, from the database or the batch
+            parents = dict()
             for descendant_info in descendants_info:
                 if self.filtered(descendant_info):
                     log.debug('Ignoring banned file: %r', descendant_info)
@@ -240,15 +253,26 @@ class RemoteWatcher(EngineWorker):
                     descendant_pair = descendants.pop(descendant_info.uid)
                     if self._check_modified(descendant_pair, descendant_info):
                         descendant_pair.remote_state = 'modified'
-                    self._dao.update_remote_state(descendant_pair, descendant_info)
+                    to_update.append((descendant_pair, descendant_info))
                 else:
-                    parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
+                    parent_pair = parents.get(descendant_info.parent_uid)
+                    if parent_pair is None:
+                        parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
                     if parent_pair is None:
                         log.trace('Cannot find parent pair of remote descendant, postponing processing of %r',
                                   descendant_info)
                         to_process.append(descendant_info)
                         continue
-                    self._find_remote_child_match_or_create(parent_pair, descendant_info)
+                    parents[descendant_info.parent_uid] = parent_pair
+                    self._find_remote_child_match_or_create(parent_pair, descendant_info, to_insert=to_insert)
+                    if to_insert and to_insert[-1][0] is descendant_info:
+                        # Its children are matched without inserting it first
+                        _, remote_parent_path, local_path, _ = to_insert[-1]
+                        parents[descendant_info.uid] = PendingPair(
+                            local_path, remote_parent_path, descendant_info.uid)
+
+            self._insert_remote_states(to_insert)
+            self._dao.update_remote_states(to_update)
 
             # Check if synchronization thread was suspended
             self._interact()
@@ -271,6 +295,18 @@ class RemoteWatcher(EngineWorker):
         for deleted in descendants.values():
             self._dao.delete_remote_state(deleted)
 
+    def _insert_remote_states(self, states):
+        if not states:
+            return
+        try:
+            self._dao.insert_remote_states(states)
+        except sqlite3.IntegrityError:
+            log.debug('Cannot insert %d remote states at once,'
+                      ' inserting them one by one', len(states))
+            for state in states:
+                self._dao.insert_remote_state(*state)
+        del states[:]
+
     @staticmethod
     def _get_elapsed_time_milliseconds(t0, t1):
         delta = t1 - t0
@@ -297,6 +333,7 @@ class RemoteWatcher(EngineWorker):
         children_info = self._client.get_children_info(remote_info.uid)
 
         to_scan = []
+        to_update = []
         for child_info in children_info:
             if self.filtered(child_info):
                 log.debug('Ignoring banned file: %r', child_info)
@@ -308,13 +345,15 @@ class RemoteWatcher(EngineWorker):
                 child_pair = children.pop(child_info.uid)
                 if self._check_modified(child_pair, child_info):
                     child_pair.remote_state = 'modified'
-                self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
+                to_update.append((child_pair, child_info))
             else:
                 child_pair, new_pair = self._find_remote_child_match_or_create(doc_pair, child_info)
 
             if (new_pair or force_recursion) and child_info.folderish:
                     to_scan.append((child_pair, child_info))
 
+        self._dao.update_remote_states(to_update, remote_parent_path=remote_parent_path)
+
         # Delete remaining
         for deleted in children.values():
             # TODO Should be DAO
@@ -343,7 +382,11 @@ class RemoteWatcher(EngineWorker):
             log.debug('Remote scanning: %r', doc_pair.local_path)
         return remote_parent_path
 
-    def _find_remote_child_match_or_create(self, parent_pair, child_info):
+    def _find_remote_child_match_or_create(self, parent_pair, child_info, to_insert=None):
+        """
+        If to_insert is given, a new pair is not created but appended to it,
+        so that the caller inserts it later with its siblings.
+        """
         if not parent_pair.local_path:
             # The parent folder has an empty local_path,
             # it probably means that it has been put in error as a duplicate
@@ -408,6 +451,9 @@ class RemoteWatcher(EngineWorker):
                     self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
                 child_pair = self._dao.get_state_from_id(child_pair.id, from_write=True)
                 return child_pair, False
+        if to_insert is not None:
+            to_insert.append((child_info, remote_parent_path, local_path, parent_pair.local_path))
+            return None, True
         row_id = self._dao.insert_remote_state(child_info, remote_parent_path, local_path, parent_pair.local_path)
         child_pair = self._dao.get_state_from_id(row_id, from_write=True)
         return child_pair, True
@@ -536,9 +582,11 @@ class RemoteWatcher(EngineWorker):
         else:
             self._last_event_log_id = None
 
-        self._dao.update_config('remote_last_sync_date', self._last_sync_date)
-        self._dao.update_config('remote_last_event_log_id', self._last_event_log_id)
-        self._dao.update_config('remote_last_root_definitions', self._last_root_definitions)
+        self._dao.update_configs({
+            'remote_last_sync_date': self._last_sync_date,
+            'remote_last_event_log_id': self._last_event_log_id,
+            'remote_last_root_definitions': self._last_root_definitions,
+        })
 
         return summary
 
@@ -604,6 +652,9 @@ class RemoteWatcher(EngineWorker):
             if self.filtered(new_info):
                 log.debug('Ignoring banned file: %r', new_info)
                 continue
+            if new_info is not None:
+                # Saves a round trip to a processor of a local change
+                self._engine.get_remote_info_cache().put([new_info])
 
             log.trace("Processing event: %r", change)
             # Possibly fetch multiple doc pairs as the same doc can be synchronized at 2 places,
@@ -3,8 +3,8 @@ from threading import current_thread
 from time import sleep, time
 from urllib2 import HTTPError
 
-from PyQt4.QtCore import QCoreApplication, QObject, QThread, pyqtSignal, \
-    pyqtSlot
+from PyQt4.QtCore import QCoreApplication, QMutex, QObject, QThread, \
+    QWaitCondition, pyqtSignal, pyqtSlot
 
 from nxdrive.engine.activity import Action, IdleAction
 from nxdrive.logging_config import get_logger
@@ -42,6 +42,11 @@ class Worker(QObject, object):
         self._name = kwargs.get('name', type(self).__name__)
         self._running = False
         self._thread.terminated.connect(self._terminated)
+        # The thread sleeps on the condition until there is something to do
+        self._wake_mutex = QMutex()
+        self._wake_condition = QWaitCondition()
+        self._woken = False
+        self._wakeups = 0
 
     def __repr__(self):
         return '<{} ID={}>'.format(type(self).__name__, self._thread_id)
@@ -66,6 +71,7 @@ class Worker(QObject, object):
         """
 
         self._continue = False
+        self.wake()
         if not self._thread.wait(5000):
             log.exception('Thread %d is not responding - terminate it',
                           self._thread_id)
@@ -77,6 +83,7 @@ class Worker(QObject, object):
         """ Resume the thread. """
 
         self._pause = False
+        self.wake()
 
     def suspend(self):
         """
@@ -85,6 +92,7 @@ class Worker(QObject, object):
         """
 
         self._pause = True
+        self.wake()
 
     def _end_action(self):
         Action.finish_action()
@@ -99,6 +107,7 @@ class Worker(QObject, object):
         """ Order the stop of the thread. Return before thread is stopped. """
 
         self._continue = False
+        self.wake()
 
     def get_thread_id(self):
         """ Get the thread ID. """
@@ -117,20 +126,61 @@ class Worker(QObject, object):
         QCoreApplication.processEvents()
         # Handle thread pause
         while self._pause and self._continue:
+            self._block()
             QCoreApplication.processEvents()
-            sleep(0.01)
         # Handle thread interruption
         if not self._continue:
             raise ThreadInterrupt()
 
+    @pyqtSlot()
+    def wake(self):
+        """
+        Wake up the thread if it is blocked in _block or _wait.
+        Thread-safe, to call when giving some work to the worker: the
+        Qt events sent to its thread are only processed once it is awake.
+        """
+
+        self._wake_mutex.lock()
+        try:
+            self._woken = True
+            self._wake_condition.wakeAll()
+        finally:
+            self._wake_mutex.unlock()
+
+    def _block(self, timeout=None):
+        """
+        Block the thread until wake is called or timeout seconds passed,
+        forever if timeout is None.
+        Return True if the thread was woken up.
+        """
+
+        self._wake_mutex.lock()
+        try:
+            if not self._woken:
+                if timeout is None:
+                    self._wake_condition.wait(self._wake_mutex)
+                else:
+                    self._wake_condition.wait(self._wake_mutex,
+                                              max(0, int(timeout * 1000)))
+            woken, self._woken = self._woken, False
+        finally:
+            self._wake_mutex.unlock()
+        self._wakeups += 1
+        return woken
+
+    def _wait(self, timeout=None):
+        """ Block until there is something to do, then interact. """
+
+        self._block(timeout)
+        self._interact()
+
     def _execute(self):
         """
         Empty execute method, override this method to add your worker logic.
         """
 
         while True:
-            self._interact()
-            sleep(0.01)
+            self._wait()
 
     def _terminated(self):
         log.debug("Thread %s(%r) terminated", self._name, self._thread_id)
@@ -162,6 +212,7 @@ class Worker(QObject, object):
         metrics['thread_id'] = self._thread_id
         # Get action from activity as methods can have its own Action
         metrics['action'] = self.action
+        metrics['wakeups'] = self._wakeups
         if hasattr(self, '_metrics'):
             metrics = dict(metrics.items() + self._metrics.items())
         return metrics
@@ -263,6 +314,7 @@ class PollWorker(Worker):
     @pyqtSlot()
     def force_poll(self):
         self._next_check = 0
+        self.wake()
 
     def _execute(self):
         while self._enable:
@@ -271,19 +323,54 @@ class PollWorker(Worker):
                 if self._poll():
                     self._metrics['last_poll'] = int(time())
                 self._next_check = int(time()) + self._check_interval
-            sleep(0.01)
+            self._block(max(0, self.get_next_poll()))
 
     def _poll(self):
         return True
 
 
+class VacuumWorker(PollWorker):
+    """
+    Give the free pages of the engine database back to the disk, by small
+    slices and only while the engine has nothing to synchronize.
+    """
+
+    def __init__(self, engine, check_interval, pages=256, **kwargs):
+        super(VacuumWorker, self).__init__(check_interval, **kwargs)
+        self._engine = engine
+        self._dao = engine.get_dao()
+        self._pages = pages
+        self._metrics['free_pages'] = 0
+        # Leave the startup to the scans
+        self._next_check = int(time()) + check_interval
+
+    def _is_idle(self):
+        queue_manager = self._engine.get_queue_manager()
+        return (not self._engine.is_paused()
+                and not queue_manager.is_active()
+                and not queue_manager.get_overall_size())
+
+    def _poll(self):
+        while self._is_idle():
+            left = self._dao.incremental_vacuum(self._pages)
+            self._metrics['free_pages'] = left
+            if not left:
+                break
+            # Let the other threads take the database lock
+            self._interact()
+            sleep(0.1)
+        return True
+
+    def _clean(self, reason, e=None):
+        self._dao.dispose_thread()
+
+
 class DummyWorker(Worker):
     """ Just a DummyWorker with infinite loop. """
 
     def _execute(self):
         while True:
-            self._interact()
-            sleep(0.01)
+            self._wait()
 
 
 class CrazyWorker(Worker):
@@ -6,6 +6,7 @@ from PyQt4 import QtCore, QtGui
 
 from nxdrive.gui.resources import find_icon
 from nxdrive.logging_config import get_logger
+from nxdrive.utils import PathTrie
 
 log = get_logger(__name__)
 
@@ -177,18 +178,13 @@ class FsClient(Client):
 class FilteredFsClient(FsClient):
     def __init__(self, fs_client, filters=None):
         super(FilteredFsClient, self).__init__(fs_client)
-        if filters:
-            self.filters = [filter_obj.path for filter_obj in filters]
-        else:
-            self.filters = []
+        self.filters = PathTrie(filter_obj.path for filter_obj in filters or [])
 
     def get_item_state(self, path):
-        if not path.endswith('/'):
-            path += '/'
-        if any([path.startswith(filter_path) for filter_path in self.filters]):
+        if self.filters.is_filtered(path):
             return QtCore.Qt.Unchecked
         # Find partial checked
-        if any([filter_path.startswith(path) for filter_path in self.filters]):
+        if self.filters.filtered_subtree(path):
             return QtCore.Qt.PartiallyChecked
         return QtCore.Qt.Checked
 
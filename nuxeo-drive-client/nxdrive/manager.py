@@ -17,6 +17,7 @@ from PyQt4.QtWebKit import qWebKitVersion
 from nxdrive import __version__
 from nxdrive.client import LocalClient
 from nxdrive.client.base_automation_client import get_proxies_for_handler
+from nxdrive.engine.tracing import tracer
 from nxdrive.logging_config import FILE_HANDLER, get_logger
 from nxdrive.options import Options
 from nxdrive.osi import AbstractOSIntegration
@@ -341,6 +342,9 @@ class Manager(QtCore.QObject):
 
         # Pause if in debug
         self._pause = Options.debug
+        # Synchronization traces, can also be toggled at runtime
+        if Options.tracing:
+            tracer.enable()
         self.updated = False  # self.update_version()
 
         self.load()
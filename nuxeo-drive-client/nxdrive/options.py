@@ -119,9 +119,18 @@ class MetaOptions(type):
         'beta_update_site_url': (
             'http://community.nuxeo.com/static/drive-tests/', 'default'),
         'consider_ssl_errors': (False, 'default'),
+        'db_busy_timeout': (5, 'default'),
+        'db_cache_size': (-2000, 'default'),
+        'db_group_commit': (False, 'default'),
+        'db_mmap_size': (0, 'default'),
+        'db_pool_size': (10, 'default'),
+        'db_profile': (False, 'default'),
+        'db_vacuum_interval': (600, 'default'),
         'debug': (False, 'default'),
         'debug_pydev': (False, 'default'),
         'delay': (30, 'default'),
+        'error_backoff': ((), 'default'),
+        'folder_processors': (4, 'default'),
         'force_locale': (None, 'default'),
         'handshake_timeout': (60, 'default'),
         'ignored_files': (__files, 'default'),
@@ -135,16 +144,21 @@ class MetaOptions(type):
         'max_sync_step': (10, 'default'),
         'nxdrive_home': (os.path.join('~', '.nuxeo-drive'), 'default'),
         'nofscheck': (False, 'default'),
+        'processors_adaptive': (False, 'default'),
+        'processors_max': (10, 'default'),
+        'processors_min': (1, 'default'),
         'protocol_url': (None, 'default'),
         'proxy_exceptions': (None, 'default'),
         'proxy_server': (None, 'default'),
         'proxy_type': (None, 'default'),
+        'queue_policy': ('priority', 'default'),
         'quit_timeout': (-1, 'default'),
         'remote_repo': ('default', 'default'),
         'theme': ('ui5', 'default'),
         'startup_page': ('drive_login.jsp', 'default'),
         'stop_on_error': (True, 'default'),
         'timeout': (30, 'default'),
+        'tracing': (False, 'default'),
         'ui': ('jsf', 'default'),
         'update_check_delay': (3600, 'default'),
         'update_site_url': (
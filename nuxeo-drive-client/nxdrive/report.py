@@ -1,8 +1,14 @@
 # conding: utfr-8
+import json
 import os
+import shutil
+import tempfile
+from Queue import Queue
 from datetime import datetime
+from threading import Thread
 from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
 
+from nxdrive.engine.tracing import tracer
 from nxdrive.logging_config import MAX_LOG_DISPLAYED, get_handler, get_logger
 
 log = get_logger(__name__)
@@ -66,22 +72,37 @@ class Report(object):
                 log.exception('Impossible to copy the log %s', rel_path)
 
     @staticmethod
-    def copy_db(myzip, dao):
+    def snapshot_db(dao, folder):
         """
-        Copy a databse file to the ZIP report.
-        If it fails, we just try ignore the file.
+        Snapshot a database file in the folder, without blocking the
+        synchronization.  Return the snapshot path, None if it failed.
         """
 
-        # Lock to avoid inconsistence
-        dao._lock.acquire()
+        path = os.path.join(folder, os.path.basename(dao.get_db()))
         try:
-            myzip.write(dao._db, os.path.basename(dao._db),
-                        compress_type=ZIP_DEFLATED)
+            dao.snapshot(path)
         except:
             log.exception('Impossible to copy the database %s',
-                          os.path.basename(dao._db))
-        finally:
-            dao._lock.release()
+                          os.path.basename(path))
+            return None
+        return path
+
+    @staticmethod
+    def _compress_snapshots(myzip, snapshots):
+        """ Add the snapshots to the ZIP report until None is received. """
+
+        while True:
+            path = snapshots.get()
+            if path is None:
+                return
+            try:
+                myzip.write(path, os.path.basename(path),
+                            compress_type=ZIP_DEFLATED)
+            except:
+                log.exception('Impossible to copy the database %s',
+                              os.path.basename(path))
+            finally:
+                os.remove(path)
 
     def get_path(self):
         return self._zipfile
@@ -109,13 +130,32 @@ class Report(object):
 
         log.debug('Create report %r', self._zipfile)
         log.debug('Manager metrics: %r', self._manager.get_metrics())
-        dao = self._manager.get_dao()
+        daos = [self._manager.get_dao()]
+        for engine in self._manager.get_engines().values():
+            log.debug('Engine metrics: %r', engine.get_metrics())
+            log.debug('Database metrics: %r', engine.get_dao().get_metrics())
+            profile = engine.get_dao().get_profile()
+            if profile is not None:
+                log.debug('Database profile: %r', profile)
+            daos.append(engine.get_dao())
+
         with ZipFile(self._zipfile, mode='w', allowZip64=True) as zip_:
-            # Databases
-            self.copy_db(zip_, dao)
-            for engine in self._manager.get_engines().values():
-                log.debug('Engine metrics: %r', engine.get_metrics())
-                self.copy_db(zip_, engine.get_dao())
+            # Databases: a snapshot is compressed while the next one is taken
+            folder = tempfile.mkdtemp()
+            snapshots = Queue()
+            compressor = Thread(target=self._compress_snapshots,
+                                args=(zip_, snapshots),
+                                name='ReportCompressor')
+            compressor.start()
+            try:
+                for dao in daos:
+                    path = self.snapshot_db(dao, folder)
+                    if path is not None:
+                        snapshots.put(path)
+            finally:
+                snapshots.put(None)
+                compressor.join()
+                shutil.rmtree(folder, ignore_errors=True)
 
             # Logs
             self.copy_logs(zip_)
@@ -126,3 +166,9 @@ class Report(object):
                 zip_.writestr('debug.log', lines, compress_type=ZIP_DEFLATED)
             except:
                 log.exception('Impossible to get lines from the memory logger')
+
+            # Synchronization traces -> trace.json, for chrome://tracing
+            if tracer.get_metrics()['traces']:
+                zip_.writestr('trace.json',
+                              json.dumps(tracer.export_chrome(), default=repr),
+                              compress_type=ZIP_DEFLATED)
@@ -1,9 +1,12 @@
 # coding: utf-8
 import base64
+import ctypes
+import errno
 import locale
 import mimetypes
 import os
 import re
+import shutil
 import sys
 import time
 import unicodedata
@@ -21,6 +24,8 @@ from nxdrive.logging_config import get_logger
 
 if sys.platform == 'win32':
     import win32api
+else:
+    import fcntl
 
 DEVICE_DESCRIPTIONS = {
     'cygwin': 'Windows',
@@ -44,6 +49,13 @@ TOKEN_PERMISSION = 'ReadWrite'
 NUXEO_DRIVE_FOLDER_NAME = 'Nuxeo Drive'
 OSX_SUFFIX = "Contents/Resources/lib/python2.7/site-packages.zip/nxdrive"
 ENCODING = locale.getpreferredencoding()
+# Linux ioctl sharing the data blocks of a file (btrfs, XFS)
+FICLONE = 0x40049409
+# Bytes copied by the kernel per copy_file_range()/sendfile() call
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+# Errors telling that a copy method is not supported for these files
+COPY_UNSUPPORTED = {errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                    errno.EPERM, errno.EXDEV, errno.ENOTTY, errno.ETXTBSY}
 
 log = get_logger(__name__)
 
@@ -323,6 +335,91 @@ def safe_long_path(path):
     return path
 
 
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(None, use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc
+
+
+def _clone_file(src, dst):
+    fcntl.ioctl(dst, FICLONE, src)
+
+
+def _kernel_copy(func, name):
+    """ Loop on a zero-copy system call until the end of the source. """
+    copied = 0
+    while True:
+        result = func()
+        if result < 0:
+            error = ctypes.get_errno()
+            if not copied and error in COPY_UNSUPPORTED:
+                raise IOError(error, name + ' is not supported')
+            raise OSError(error, os.strerror(error))
+        if not result:
+            return
+        copied += result
+
+
+def _copy_file_range(src, dst):
+    func = getattr(_get_libc(), 'copy_file_range', None)
+    if func is None:
+        raise IOError(errno.ENOSYS, 'copy_file_range is not supported')
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                     ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+    _kernel_copy(lambda: func(src, None, dst, None, COPY_CHUNK_SIZE, 0),
+                 'copy_file_range')
+
+
+def _sendfile(src, dst):
+    func = getattr(_get_libc(), 'sendfile', None)
+    if func is None:
+        raise IOError(errno.ENOSYS, 'sendfile is not supported')
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                     ctypes.c_size_t)
+    _kernel_copy(lambda: func(dst, src, None, COPY_CHUNK_SIZE), 'sendfile')
+
+
+def copy_file(src, dst):
+    """
+    Copy the content and the permission bits of src to dst, like
+    shutil.copy() but without reading the data in Python when possible.
+    On GNU/Linux, the data blocks are shared with a reflink, then copied
+    by the kernel with copy_file_range() or sendfile(), before falling
+    back on a buffered copy.
+    Return the name of the method that did the copy.
+    """
+    method = 'buffered'
+    if sys.platform.startswith('linux'):
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            for name, func in (('reflink', _clone_file),
+                               ('copy_file_range', _copy_file_range),
+                               ('sendfile', _sendfile)):
+                try:
+                    func(fsrc.fileno(), fdst.fileno())
+                except IOError as e:
+                    if e.errno not in COPY_UNSUPPORTED:
+                        raise
+                    log.trace('Cannot copy %r with %s: %s', src, name, e)
+                else:
+                    method = name
+                    break
+            else:
+                shutil.copyfileobj(fsrc, fdst)
+    else:
+        shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+    return method
+
+
 def path_join(parent, child):
     if parent == '/':
         return '/' + child
@@ -544,6 +641,65 @@ def guess_server_url(url, login_page=Options.startup_page, timeout=5):
     return url
 
 
+class PathTrie(object):
+    """
+    Set of paths stored by segment, to find in O(depth) if a path or one
+    of its ancestors is in the set, whatever the number of paths.
+    """
+
+    def __init__(self, paths=()):
+        # Segment -> child node, the None key marks a path of the set
+        self._root = dict()
+        for path in paths:
+            self.add(path)
+
+    @staticmethod
+    def _split(path):
+        return [name for name in path.split('/') if name]
+
+    def add(self, path):
+        node = self._root
+        for name in self._split(path):
+            node = node.setdefault(name, dict())
+        node[None] = path
+
+    def _get_node(self, path):
+        node = self._root
+        for name in self._split(path):
+            node = node.get(name)
+            if node is None:
+                break
+        return node
+
+    def is_filtered(self, path):
+        """ Tell if the path or one of its ancestors is in the set. """
+        node = self._root
+        if None in node:
+            return True
+        for name in self._split(path):
+            node = node.get(name)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def filtered_subtree(self, path):
+        """ Return the paths of the set that are the path or below it. """
+        node = self._get_node(path)
+        if node is None:
+            return []
+        paths = []
+        nodes = [node]
+        while nodes:
+            for name, child in nodes.pop().iteritems():
+                if name is None:
+                    paths.append(child)
+                else:
+                    nodes.append(child)
+        return paths
+
+
 class ServerLoader(object):
     def __init__(self, remote_client, local_client):
         self._remote_client = remote_client
@@ -14,7 +14,7 @@ from dateutil.tz import tzlocal
 
 from nxdrive.client.base_automation_client import Unauthorized
 from nxdrive.engine.activity import Action, FileAction
-from nxdrive.engine.dao.sqlite import StateRow
+from nxdrive.engine.dao.sqlite import BaseStateRow
 from nxdrive.engine.engine import Engine
 from nxdrive.engine.workers import Worker
 from nxdrive.logging_config import get_logger
@@ -88,7 +88,7 @@ class WebDriveApi(QtCore.QObject):
             return self._export_engine(obj)
         if isinstance(obj, Notification):
             return self._export_notification(obj)
-        if isinstance(obj, StateRow):
+        if isinstance(obj, BaseStateRow):
             return self._export_state(obj)
         if isinstance(obj, Worker):
             return self._export_worker(obj)
@@ -469,6 +469,8 @@ class WebDriveApi(QtCore.QObject):
             if engine:
                 filepath = engine.get_abspath(path)
                 self._manager.open_local_file(filepath)
+                # Sync first what the user is looking at
+                engine.get_queue_manager().prioritize(path)
 
     @QtCore.pyqtSlot()
     def show_activities(self):
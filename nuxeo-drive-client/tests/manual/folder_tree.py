@@ -0,0 +1,94 @@
+# coding: utf-8
+"""
+Wall-clock time to create a generated tree of 20k folders, depending on the
+number of folder processors.
+
+The creation of a folder is simulated by a sleep, the round trip to the
+server, so that only the scheduling of the QueueManager is measured:
+
+    $ python tests/manual/folder_tree.py --latency 0.005 1 2 4 8
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+from threading import Lock, Thread, current_thread
+
+from nxdrive.engine.scheduler import FolderClaims, PairQueue, \
+    QUEUE_POLICIES, QueueItem
+from nxdrive.utils import PathTrie
+
+
+def generate_tree(queue, width=20, depth=3, leaves=49):
+    """ Queue width folders of width subfolders... of leaves folders. """
+
+    paths = ['']
+    row_id = 0
+    for level in range(depth):
+        children = leaves if level == depth - 1 else width
+        paths = [path + '/folder_%d' % i for path in paths
+                 for i in range(children)]
+        for path in paths:
+            row_id += 1
+            queue.put(QueueItem(row_id, True, 'locally_created', path))
+    return row_id
+
+
+def create_tree(processors, latency):
+    """ Return the time taken to create the tree, and its size. """
+
+    policy = QUEUE_POLICIES['priority']
+    queue = PairQueue(lambda item: policy(item, PathTrie()))
+    size = generate_tree(queue)
+    claims = FolderClaims()
+    created = set()
+    lock = Lock()
+    errors = []
+
+    def processor():
+        thread_id = current_thread().ident
+        while True:
+            claims.release(thread_id)
+            item = claims.get(queue, thread_id)
+            if item is None:
+                if not claims.get_metrics()['claimed']:
+                    break
+                # Waiting for the parents being created
+                time.sleep(latency)
+                continue
+            parent = item.path.rpartition('/')[0]
+            if parent and parent not in created:
+                errors.append(item.path)
+            time.sleep(latency)
+            with lock:
+                created.add(item.path)
+
+    start = time.time()
+    threads = [Thread(target=processor) for _ in range(processors)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    assert len(created) == size, 'Missing folders'
+    assert not errors, 'Children created before their parent: %r' % errors
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds to create a folder')
+    parser.add_argument('processors', type=int, nargs='*', default=[1, 4])
+    args = parser.parse_args()
+
+    for processors in args.processors:
+        elapsed, size = create_tree(processors, args.latency)
+        print('%d processor(s): %d folders in %.1fs (%.0f folders/s)'
+              % (processors, size, elapsed, size / elapsed))
+
+
+if __name__ == '__main__':
+    main()
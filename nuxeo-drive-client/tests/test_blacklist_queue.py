@@ -1,8 +1,9 @@
 # coding: utf-8
 import unittest
-from time import sleep
+from time import sleep, time
 
-from nxdrive.engine.blacklist_queue import BlacklistQueue
+from nxdrive.engine.blacklist_queue import BlacklistQueue, \
+    exponential_backoff, get_backoffs
 from tests.common_unit_test import RandomBug
 
 
@@ -58,3 +59,51 @@ class BlacklistQueueTest(unittest.TestCase):
         self.assertEqual(item._count, 3)
         item = queue.get()
         self.assertIsNone(item)
+
+    def test_order(self):
+        queue = BlacklistQueue(delay=60)
+        for item_id, wait in ((1, 30), (2, 0), (3, 10), (4, -1)):
+            queue.push(item_id, 'Item%d' % item_id, next_try=wait)
+        self.assertEqual(len(queue), 4)
+        self.assertIn(3, queue)
+        self.assertLessEqual(queue.get_next_wait(), 0)
+
+        # Update and remove items
+        queue.push(1, 'Item1', next_try=-1)
+        self.assertEqual(len(queue), 4)
+        self.assertTrue(queue.remove(4))
+        self.assertFalse(queue.remove(4))
+        self.assertEqual(queue.get().get_id(), 1)
+        self.assertIsNone(queue.get())
+        self.assertGreater(queue.get_next_wait(), 0)
+
+        queue.retry_all()
+        self.assertEqual([queue.get().get_id() for _ in range(2)], [2, 3])
+        self.assertIsNone(queue.get())
+        self.assertTrue(queue.empty())
+        self.assertIsNone(queue.get_next_wait())
+
+    def test_backoff(self):
+        backoffs = get_backoffs(['LOCKED:exponential', 'EXCEPTION:constant',
+                                 'UNKNOWN:policy'])
+        self.assertEqual(backoffs, {'LOCKED': exponential_backoff,
+                                    'EXCEPTION': backoffs['EXCEPTION']})
+        queue = BlacklistQueue(delay=10, backoffs=backoffs)
+        now = int(time())
+        for count, linear, exponential, constant in ((1, 10, 10, 10),
+                                                     (2, 20, 20, 10),
+                                                     (3, 30, 40, 10)):
+            for error, wait in (('CORRUPT', linear), ('LOCKED', exponential),
+                                ('EXCEPTION', constant)):
+                item = queue.push(error, error, count=count, error=error)
+                self.assertIn(item.get_next_try() - now, (wait, wait + 1))
+
+        item.increase()
+        self.assertIn(item.get_next_try() - now, (10, 11))
+        metrics = queue.get_metrics()
+        self.assertEqual(metrics['size'], 3)
+        self.assertEqual(metrics['retry_waits'], {
+            'CORRUPT': {'10s': 1, '60s': 2},
+            'LOCKED': {'10s': 1, '60s': 2},
+            'EXCEPTION': {'10s': 3},
+        })
@@ -1,16 +1,29 @@
 # coding: utf-8
 import os
+import sqlite3
 import sys
 import tempfile
 import unittest
+from copy import deepcopy
+from datetime import datetime
+from threading import Event, Thread
+from time import sleep
 
-from nxdrive.engine.dao.sqlite import EngineDAO
+from mock import Mock, patch
+
+from nxdrive.client.local_client import FileInfo
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+from nxdrive.engine.dao.sqlite import AutoRetryCursor, EngineDAO, \
+    SlottedStateRow, StateRow
 from nxdrive.engine.engine import Engine
+from nxdrive.engine.tracing import tracer
 from tests.common import clean_dir
 
 
 class EngineDAOTest(unittest.TestCase):
 
+    state_factory = StateRow
+
     def _get_default_db(self, name='test_engine.db'):
         return os.path.join(os.path.dirname(__file__), 'resources', name)
 
@@ -36,7 +49,8 @@ class EngineDAOTest(unittest.TestCase):
         with open(self._get_default_db(), 'rb') as db, \
                 open(self.tmp_db.name, 'wb') as f:
             f.write(db.read())
-        self._dao = EngineDAO(self.tmp_db.name)
+        self._dao = EngineDAO(self.tmp_db.name,
+                              state_factory=self.state_factory)
         self.addCleanup(self._clean_dao, self._dao)
 
     def test_init_db(self):
@@ -54,6 +68,365 @@ class EngineDAOTest(unittest.TestCase):
         self.assertFalse(dao.is_path_scanned("/"))
         self._clean_dao(dao)
 
+    def test_counters(self):
+        dao = self._dao
+        self.assertTrue(dao.check_counters())
+        c = dao._get_read_connection().cursor()
+        size = c.execute("SELECT SUM(size) FROM States"
+                         " WHERE pair_state='synchronized'").fetchone()[0]
+        self.assertEqual(dao.get_global_size(), size)
+        files = dao.get_sync_count(filetype='file')
+        folders = dao.get_sync_count(filetype='folder')
+        self.assertEqual(dao.get_sync_count(), files + folders)
+
+        # Counters follow the updates and deletions
+        conflicts = dao.get_conflict_count()
+        errors = dao.get_error_count()
+        row = dao.get_state_from_id(1)
+        dao.set_conflict_state(row)
+        self.assertEqual(dao.get_conflict_count(), conflicts + 1)
+        dao.increase_error(row, 'Test', incr=5)
+        self.assertEqual(dao.get_error_count(), errors + 1)
+        dao.remove_state(row)
+        self.assertEqual(dao.get_conflict_count(), conflicts)
+        self.assertEqual(dao.get_error_count(), errors)
+        self.assertTrue(dao.check_counters())
+
+        # Inconsistencies are detected and fixed
+        dao._get_write_connection().execute(
+            "UPDATE StatesCounters SET count = 42")
+        self.assertFalse(dao.check_counters())
+        self.assertFalse(dao.check_counters(rebuild=True))
+        self.assertTrue(dao.check_counters())
+
+    def test_bulk_states(self):
+        dao = self._dao
+        dao._queue_manager = Mock()
+        now = datetime.utcnow()
+
+        infos = [FileInfo(u'/nonexistent', u'/Bulk %d' % i, True, now)
+                 for i in range(3)]
+        row_ids = dao.insert_local_states(infos, '/')
+        self.assertEqual([dao.get_state_from_id(row_id).local_path
+                          for row_id in row_ids], [info.path for info in infos])
+        dao._queue_manager.push_refs.assert_called_once_with(
+            [(row_id, True, 'locally_created', info.path, 0)
+             for row_id, info in zip(row_ids, infos)])
+
+        # Children of a folder created in the same batch are not queued
+        dao._queue_manager.reset_mock()
+        root = dao.get_state_from_local('/')
+        folder = RemoteFileInfo(
+            u'Folder', 'bulk#folder', root.remote_ref, '/Folder', True, now,
+            'Administrator', None, None, None, True, True, True, True, None,
+            None, True)
+        child = folder._replace(name=u'File', uid='bulk#file',
+                                parent_uid=folder.uid, folderish=False,
+                                digest='digest')
+        remote_parent_path = root.remote_parent_path + '/' + root.remote_ref
+        folder_id, child_id = dao.insert_remote_states([
+            (folder, remote_parent_path, u'/Folder', u'/'),
+            (child, remote_parent_path + '/' + folder.uid, u'/Folder/File',
+             u'/Folder'),
+        ])
+        self.assertEqual(dao.get_state_from_id(child_id).remote_ref,
+                         child.uid)
+        dao._queue_manager.push_refs.assert_called_once_with(
+            [(folder_id, True, 'remotely_created', u'/Folder')])
+
+        row = dao.get_state_from_id(folder_id)
+        dao.update_remote_states([(row, folder._replace(name=u'Renamed'))])
+        row = dao.get_state_from_id(folder_id)
+        self.assertEqual(row.remote_name, u'Renamed')
+        self.assertEqual(row.version, 1)
+
+        # A failed batch keeps none of its rows
+        dao._queue_manager.push_refs.side_effect = ValueError
+        infos = [FileInfo(u'/nonexistent', u'/Failed %d' % i, True, now)
+                 for i in range(3)]
+        self.assertRaises(ValueError, dao.insert_local_states, infos, '/')
+        self.assertEqual([dao.get_state_from_local(info.path)
+                          for info in infos], [None] * 3)
+
+    def test_queue_pages(self):
+        dao = self._dao
+        dao._queue_manager = Mock()
+        now = datetime.utcnow()
+        folder_ids = dao.insert_local_states(
+            [FileInfo(u'/nonexistent', u'/Page %d' % i, True, now)
+             for i in range(5)], '/')
+        dao.insert_local_states(
+            [FileInfo(u'/nonexistent', u'/Page 0/File', False, now)], '/Page 0')
+
+        manager = Mock()
+        with patch('nxdrive.engine.dao.sqlite.QUEUE_PAGE_SIZE', 2):
+            dao.register_queue_manager(manager)
+        self.assertFalse(dao.is_queue_loaded())
+        while dao.queue_next_page(size=2):
+            pass
+        self.assertTrue(dao.is_queue_loaded())
+        self.assertEqual(dao.queue_next_page(), 0)
+
+        # The children of the folders to synchronize are queued later
+        pushed = [ref[0] for call in manager.push_refs.call_args_list
+                  for ref in call[0][0]]
+        self.assertEqual(pushed, [2] + folder_ids)
+        self.assertEqual(manager.push_refs.call_count, 3)
+
+    def test_local_changes_count(self):
+        children = self._dao.get_local_children('/SmallFolder')
+        self.assertEqual(self._dao.get_local_changes_count('/SmallFolder'),
+                         (len(children), 1))
+        self.assertEqual(self._dao.get_local_changes_count('/Nowhere'),
+                         (0, 0))
+
+    def test_subtree_updates(self):
+        dao = self._dao
+        folder = dao.get_state_from_local('/SmallFolder')
+        descendants = dao.get_states_from_partial_local('/SmallFolder/')
+        self.assertTrue(descendants)
+        # Neither a sibling sharing the prefix nor LIKE wildcards match
+        sibling_id = dao.insert_local_state(
+            FileInfo(u'/nonexistent', u'/SmallFolder_bis', True,
+                     datetime.utcnow()), '/')
+        self.assertFalse(dao.get_states_from_partial_local('/Small_older/'))
+
+        dao.update_local_parent_path(folder, 'Renamed', '/')
+        self.assertFalse(dao.get_states_from_partial_local('/SmallFolder/'))
+        renamed = dao.get_states_from_partial_local('/Renamed/')
+        self.assertEqual(sorted(row.id for row in renamed),
+                         sorted(row.id for row in descendants))
+        self.assertEqual(dao.get_state_from_id(sibling_id).local_path,
+                         '/SmallFolder_bis')
+
+    def test_group_commit(self):
+        init_db = self.get_db_temp_file()
+        if sys.platform != 'win32':
+            os.remove(init_db.name)
+        dao = EngineDAO(init_db.name, group_commit=True)
+        committer = dao._committer
+        self.assertIsNotNone(committer)
+        c = dao._get_read_connection().cursor()
+        self.assertEqual(c.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+        # Hold the group open to check statements are committed together
+        committer.flush()
+        committer._delay = 60
+        commits = committer.commits
+        for i in range(50):
+            dao.update_config('key_%d' % i, i)
+        self.assertEqual(committer.commits, commits)
+        con = sqlite3.connect(init_db.name)
+        try:
+            # Pending writes are not visible before the group is committed
+            self.assertEqual(con.execute(
+                "SELECT COUNT(*) FROM Configuration WHERE name LIKE 'key_%'"
+            ).fetchone()[0], 0)
+            dao.flush()
+            self.assertEqual(committer.commits, commits + 1)
+            self.assertEqual(con.execute(
+                "SELECT COUNT(*) FROM Configuration WHERE name LIKE 'key_%'"
+            ).fetchone()[0], 50)
+
+            # Pending writes are committed on dispose
+            dao.update_config('last_key', 'value')
+            self._clean_dao(dao)
+            self.assertEqual(con.execute(
+                "SELECT value FROM Configuration WHERE name='last_key'"
+            ).fetchone()[0], 'value')
+        finally:
+            con.close()
+
+    def test_group_commit_acquire(self):
+        init_db = self.get_db_temp_file()
+        if sys.platform != 'win32':
+            os.remove(init_db.name)
+        dao = EngineDAO(init_db.name, group_commit=True,
+                        state_factory=self.state_factory)
+        self.addCleanup(self._clean_dao, dao)
+        dao._committer.flush()
+        dao._committer._delay = 60
+        commits = dao._committer.commits
+        info = FileInfo(u'/nonexistent', u'/Pending', False,
+                        datetime.utcnow())
+        row_id = dao.insert_local_state(info, '/')
+
+        # A processor acquires the row before its group is committed
+        states = []
+
+        def acquire():
+            try:
+                states.append(dao.acquire_state(1, row_id))
+            finally:
+                dao.release_state(1)
+                dao.dispose_thread()
+
+        thread = Thread(target=acquire)
+        thread.start()
+        thread.join()
+        self.assertEqual(dao._committer.commits, commits)
+        self.assertEqual(states[0].local_path, u'/Pending')
+
+    def test_connection_pool(self):
+        dao = EngineDAO(self.get_db_temp_file().name, pool_size=2)
+        dao._pool._timeout = 0.1
+        try:
+            con = dao._get_read_connection()
+            self.assertIs(dao._get_read_connection(), con)
+
+            # A disposed thread gives its connection back to the next one
+            dao.dispose_thread()
+            connections = []
+
+            def read():
+                connections.append(dao._get_read_connection())
+                dao.dispose_thread()
+
+            thread = Thread(target=read)
+            thread.start()
+            thread.join()
+            self.assertIs(connections[0], con)
+
+            # Connections of ended threads are reclaimed when exhausted
+            for _ in range(2):
+                thread = Thread(target=dao._get_read_connection)
+                thread.start()
+                thread.join()
+            metrics = dao.get_metrics()
+            self.assertEqual(metrics['pool_created'], 2)
+            self.assertEqual(metrics['pool_overflows'], 0)
+
+            # Past the timeout, an exhausted pool opens an extra connection
+            event = Event()
+
+            def hold(ready):
+                dao._get_read_connection()
+                ready.set()
+                event.wait()
+                dao.dispose_thread()
+
+            threads = []
+            for _ in range(2):
+                ready = Event()
+                threads.append(Thread(target=hold, args=(ready,)))
+                threads[-1].start()
+                ready.wait()
+            extra = dao._get_read_connection()
+            metrics = dao.get_metrics()
+            self.assertEqual(metrics['pool_created'], 3)
+            self.assertEqual(metrics['pool_waits'], 1)
+            self.assertEqual(metrics['pool_overflows'], 1)
+
+            # The pool stays bounded
+            dao.dispose_thread()
+            self.assertRaises(sqlite3.ProgrammingError, extra.execute,
+                              'SELECT 1')
+            event.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(dao.get_metrics()['pool_idle'], 2)
+        finally:
+            self._clean_dao(dao)
+
+    def test_lock_wait(self):
+        dao = EngineDAO(self.get_db_temp_file().name, busy_timeout=0)
+        con = sqlite3.connect(dao.get_db())
+        try:
+            # Real operational errors are not retried
+            cursor = dao._get_read_connection().cursor()
+            self.assertRaises(sqlite3.OperationalError, cursor.execute,
+                              'SELECT * FROM Missing')
+            self.assertEqual(dao.get_metrics()['lock_waits'], 0)
+
+            # Writes are retried until the lock is released
+            con.execute('BEGIN EXCLUSIVE')
+            thread = Thread(target=dao.update_config, args=('key', 'value'))
+            thread.start()
+            sleep(0.2)
+            con.rollback()
+            thread.join()
+            self.assertEqual(dao.get_config('key'), 'value')
+            metrics = dao.get_metrics()
+            self.assertEqual(metrics['lock_waits'], 1)
+            self.assertGreater(metrics['lock_retries'], 0)
+            self.assertGreater(metrics['lock_wait_time'], 0.1)
+            self.assertEqual(sum(metrics['lock_wait_histogram'].values()), 1)
+
+            # And given up after the last retry
+            con.execute('BEGIN EXCLUSIVE')
+            with patch.object(AutoRetryCursor, 'retries', 1):
+                self.assertRaises(sqlite3.OperationalError,
+                                  dao.update_config, 'key', 'other')
+            con.rollback()
+            self.assertEqual(dao.get_metrics()['lock_failures'], 1)
+        finally:
+            con.close()
+            self._clean_dao(dao)
+
+    def test_incremental_vacuum(self):
+        c = self._dao._get_read_connection().cursor()
+        self.assertEqual(c.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+        self._dao.begin_transaction()
+        try:
+            for i in range(500):
+                self._dao.update_config('key_%d' % i, 'x' * 1000)
+        finally:
+            self._dao.end_transaction()
+        size = os.path.getsize(self._dao.get_db())
+        self._dao.reinit_states()
+        free = self._dao.get_reclaimable_size()
+        self.assertGreater(free, 0)
+        self.assertEqual(self._dao.get_metrics()['reclaimable_size'], free)
+
+        # Pages are given back by slices
+        left = self._dao.incremental_vacuum(1)
+        self.assertGreater(left, 0)
+        self.assertLess(self._dao.get_reclaimable_size(), free)
+        while left:
+            left = self._dao.incremental_vacuum(10)
+        self.assertEqual(self._dao.get_reclaimable_size(), 0)
+        self.assertLess(os.path.getsize(self._dao.get_db()), size)
+
+    def test_profile(self):
+        self.assertIsNone(self._dao.get_profile())
+        self.assertIs(type(self._dao._get_read_connection().cursor()),
+                      AutoRetryCursor)
+
+        dao = EngineDAO(self.tmp_db.name, profile=True)
+        try:
+            dao.get_state_from_id(1)
+            dao.get_state_from_id(2)
+            dao.get_last_files(5)
+            dao.update_config('key', 'value')
+            c = dao._get_read_connection().cursor()
+            states = list(c.execute("SELECT * FROM States WHERE id < 10"))
+
+            # Other threads wait for the lock
+            dao._lock.acquire()
+            thread = Thread(target=dao.update_config, args=('key', 'other'))
+            thread.start()
+            sleep(0.1)
+            dao._lock.release()
+            thread.join()
+
+            profile = dao.get_profile()
+            queries = profile['queries']
+            stats = queries['SELECT * FROM States WHERE id=?']
+            self.assertEqual(stats['count'], 2)
+            self.assertEqual(stats['rows'], 2)
+            self.assertLessEqual(stats['p50'], stats['p99'])
+            stats = queries['SELECT * FROM States WHERE id < ?']
+            self.assertEqual(stats['rows'], len(states))
+            stats = queries['INSERT OR REPLACE INTO Configuration(name, value)'
+                            ' VALUES(?, ?)']
+            self.assertEqual(stats['count'], 2)
+            self.assertEqual(stats['rows'], 2)
+            stats = profile['lock_waits']['update_configs']
+            self.assertEqual(stats['count'], 1)
+            self.assertGreater(stats['total'], 0.05)
+        finally:
+            self._clean_dao(dao)
+
     def test_migration_db_v1_with_duplicates(self):
         # Test a non empty db
         migrate_db = self.get_db_temp_file()
@@ -85,6 +458,8 @@ class EngineDAOTest(unittest.TestCase):
         self.assertEqual(len(cols), 30)
         cols = c.execute("SELECT * FROM States").fetchall()
         self.assertEqual(len(cols), 63)
+        # Free pages are given back by incremental vacuum
+        self.assertEqual(c.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
         self.test_batch_folder_files()
         self.test_batch_upload_files()
         self.test_conflicts()
@@ -124,6 +499,123 @@ class EngineDAOTest(unittest.TestCase):
         self.assertTrue(self._dao.synchronize_state(row))
         self.assertEqual(self._dao.get_error_count(2), 0)
 
+    def test_configuration_cache(self):
+        now = datetime.utcnow()
+        # Load the cache
+        self.assertIsNone(self._dao.get_config('int'))
+        self._dao.update_configs({'int': 42, 'bool': True, 'date': now,
+                                  'str': 'value', 'unicode': u'\xe9t\xe9',
+                                  'float': 1.5})
+        self._dao.update_config('empty', None)
+        values = dict((name, self._dao.get_config(name)) for name in
+                      ('int', 'bool', 'date', 'str', 'unicode', 'float'))
+
+        # Cached values are the ones read back from the database
+        self._dao._config = None
+        for name, value in values.iteritems():
+            self.assertEqual(self._dao.get_config(name), value)
+        self.assertEqual(values['bool'], u'1')
+        self.assertEqual(values['date'], unicode(now))
+
+        # No read, nor write for each key
+        queries = []
+        execute = AutoRetryCursor.execute
+        executemany = AutoRetryCursor.executemany
+
+        def record(cursor, query, *args, **kwargs):
+            queries.append(query)
+            return execute(cursor, query, *args, **kwargs)
+
+        def record_many(cursor, query, *args, **kwargs):
+            queries.append(query)
+            return executemany(cursor, query, *args, **kwargs)
+
+        with patch.object(AutoRetryCursor, 'execute', record), \
+                patch.object(AutoRetryCursor, 'executemany', record_many):
+            self._dao.update_configs({'int': 43, 'str': None})
+            self.assertEqual(self._dao.get_config('int'), u'43')
+            self.assertEqual(self._dao.get_config('str', 'default'), 'default')
+        self.assertEqual(len(queries), 2)
+
+    def test_snapshot(self):
+        path = os.path.join(self.tmpdir, 'snapshot.db')
+        self._dao.update_config('pending', 'value')
+        self._dao.snapshot(path, rows=7)
+
+        con = sqlite3.connect(path)
+        source = sqlite3.connect(self._dao._db)
+        try:
+            query = ("SELECT type, name FROM sqlite_master"
+                     " ORDER BY type, name")
+            self.assertEqual(con.execute(query).fetchall(),
+                             source.execute(query).fetchall())
+            for table in ('States', 'StatesCounters', 'Configuration',
+                          'Filters'):
+                query = "SELECT * FROM %s ORDER BY 1" % table
+                self.assertEqual(source.execute(query).fetchall(),
+                                 con.execute(query).fetchall())
+        finally:
+            source.close()
+            con.close()
+
+        # The copied counters are kept up to date
+        dao = EngineDAO(path)
+        try:
+            self.assertTrue(dao.check_counters())
+        finally:
+            self._clean_dao(dao)
+
+    def test_snapshot_concurrent_write(self):
+        path = os.path.join(self.tmpdir, 'snapshot.db')
+        dao_lock = self._dao._lock
+        db = self._dao._db
+
+        class WritingLock(object):
+            """ Commit a write once the first slice has been copied. """
+
+            written = False
+
+            def acquire(self):
+                dao_lock.acquire()
+
+            def release(self):
+                dao_lock.release()
+                if not self.written:
+                    self.written = True
+                    con = sqlite3.connect(db)
+                    try:
+                        con.execute(
+                            "UPDATE Configuration SET value='changed'"
+                            " WHERE rowid=(SELECT MIN(rowid)"
+                            " FROM Configuration)")
+                        con.commit()
+                    finally:
+                        con.close()
+
+            __enter__ = acquire
+
+            def __exit__(self, *args):
+                self.release()
+
+        lock = self._dao._lock = WritingLock()
+        try:
+            self._dao.snapshot(path, rows=7)
+        finally:
+            self._dao._lock = dao_lock
+        self.assertTrue(lock.written)
+
+        # The copy was restarted, the snapshot has the change
+        con = sqlite3.connect(path)
+        source = sqlite3.connect(db)
+        try:
+            for table in ('States', 'Configuration', 'Filters'):
+                query = "SELECT * FROM %s ORDER BY 1" % table
+                self.assertEqual(source.execute(query).fetchall(),
+                                 con.execute(query).fetchall())
+        finally:
+            source.close()
+            con.close()
+
     def test_remote_scans(self):
         self.assertFalse(self._dao.is_path_scanned("/"))
         self._dao.add_path_scanned("/Test")
@@ -132,6 +624,33 @@ class EngineDAOTest(unittest.TestCase):
         self._dao.clean_scanned()
         self.assertFalse(self._dao.is_path_scanned("/Test"))
 
+    def test_remote_scans_checkpoint(self):
+        def count():
+            c = self._dao._get_read_connection().cursor()
+            return c.execute("SELECT COUNT(*) FROM RemoteScan").fetchone()[0]
+
+        # Scanned paths are kept in memory until the checkpoint
+        scanned = count()
+        with patch.object(EngineDAO, 'SCANNED_CHECKPOINT_SIZE', 3):
+            self._dao.add_path_scanned("/Test1")
+            self._dao.add_path_scanned("/Test2")
+            self._dao.add_path_scanned("/Test2")
+            self.assertEqual(count(), scanned)
+            self._dao.add_path_scanned("/Test3")
+            self.assertEqual(count(), scanned + 3)
+            self._dao.add_path_scanned("/Test4")
+            self.assertEqual(count(), scanned + 3)
+
+        # And written on dispose, to be resumed
+        self._dao.dispose()
+        self._dao = EngineDAO(self.tmp_db.name,
+                              state_factory=self.state_factory)
+        self.addCleanup(self._clean_dao, self._dao)
+        self.assertEqual(count(), scanned + 4)
+        self.assertTrue(self._dao.is_path_scanned("/Test4"))
+        self._dao.clean_scanned()
+        self.assertEqual(count(), 0)
+
     def test_last_sync(self):
         # Based only on file so not showing 2
         ids = [58, 8, 62, 61, 60]
@@ -200,10 +719,37 @@ class EngineDAOTest(unittest.TestCase):
 
         # Check the auto-release
         self.assertTrue(self._dao.acquire_processor(666, 2))
+        self.assertEqual(self._dao.get_processor(2), 666)
         row = self._dao.get_state_from_id(2)
         self._dao.synchronize_state(row)
+        self.assertEqual(self._dao.get_processor(2), 0)
         self.assertFalse(self._dao.release_processor(666))
 
+        # Claims are not written to the database
+        self.assertEqual(self._dao.acquire_state(666, 2).processor, 0)
+        self.assertRaises(sqlite3.OperationalError,
+                          self._dao.acquire_state, 777, 2)
+        self._dao.reinit_processors()
+        self.assertEqual(self._dao.get_processor(2), 0)
+
+        # Missing rows are not kept claimed
+        self.assertIsNone(self._dao.acquire_state(666, 9999))
+        self.assertEqual(self._dao.get_processor(9999), 0)
+
+    def test_tracing(self):
+        tracer.enable()
+        self.addCleanup(tracer.clear)
+        self.addCleanup(tracer.disable)
+        with tracer.trace('locally_modified', pair=2):
+            row = self._dao.acquire_state(666, 2)
+            self._dao.synchronize_state(row)
+            self._dao.release_state(666)
+        trace = tracer.get_traces()[-1]
+        self.assertEqual([span['name'] for span in trace['spans']],
+                         ['acquire_state', 'get_state_from_id',
+                          'synchronize_state', 'release_state'])
+        self.assertEqual(set(trace['phases']), {'db', 'other'})
+
     def test_configuration(self):
         result = self._dao.get_config("empty", "DefaultValue")
         self.assertEqual(result, "DefaultValue")
@@ -231,3 +777,99 @@ class EngineDAOTest(unittest.TestCase):
         self.assertEqual(len(self._dao.get_filters()), 1)
         self._dao.add_filter(u"/otherFilter")
         self.assertEqual(len(self._dao.get_filters()), 2)
+        self.assertTrue(self._dao.is_filter(u"/fakeFilter"))
+        self.assertTrue(self._dao.is_filter(u"/fakeFilter/Retest/child"))
+        self.assertFalse(self._dao.is_filter(u"/fakeFilter2"))
+        self.assertFalse(self._dao.is_filter(u"/"))
+        self.assertEqual(sorted(self._dao.filtered_subtree(u"/")),
+                         [u"/fakeFilter/", u"/otherFilter/"])
+
+    def test_valid_duplicate_files(self):
+        digest = u'd41d8cd98f00b204e9800998ecf8427e'
+        rows = self._dao.get_valid_duplicate_files(digest)
+        self.assertEqual(len(rows), 2)
+        for row in rows:
+            self.assertEqual(row.pair_state, 'synchronized')
+            self.assertEqual(row.local_digest, digest)
+        dates = [row.last_sync_date for row in rows]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+        self.assertEqual(self._dao.get_valid_duplicate_files(u'unknown'), [])
+
+    def test_queries_use_index(self):
+        queries = []
+        execute = AutoRetryCursor.execute
+
+        def record(cursor, query, *args, **kwargs):
+            queries.append((query, args[0] if args else ()))
+            return execute(cursor, query, *args, **kwargs)
+
+        row = self._dao.get_state_from_id(58)
+        with patch.object(AutoRetryCursor, 'execute', record):
+            self._dao.get_local_children(row.local_parent_path)
+            self._dao.get_local_changes_count(row.local_parent_path)
+            self._dao.get_remote_children(row.remote_parent_ref)
+            self._dao.get_new_remote_children(row.remote_parent_ref)
+            self._dao.get_state_from_local(row.local_path)
+            self._dao.get_states_from_remote(row.remote_ref)
+            self._dao.get_state_from_remote_with_path(
+                row.remote_ref, row.remote_parent_path)
+            self._dao.get_dedupe_pair(
+                row.local_name, row.remote_parent_ref, row.id)
+            self._dao.get_valid_duplicate_file(row.remote_digest)
+            self._dao.get_valid_duplicate_files(row.remote_digest)
+            self._dao.get_conflicts()
+            self._dao.get_unsynchronizeds()
+            self._dao.get_errors()
+            self._dao.get_last_files(5)
+            self._dao.get_last_files(5, 'remote')
+            self._dao.get_next_sync_file(row.remote_ref)
+            self._dao.get_previous_sync_file(row.remote_ref)
+            self._dao.get_next_folder_file(row.remote_ref)
+            self._dao.get_previous_folder_file(row.remote_ref)
+            self._dao.get_states_from_partial_local(row.local_parent_path)
+            self._dao.get_remote_descendants(row.remote_parent_path)
+            self._dao.get_remote_descendants_from_ref(row.remote_parent_ref)
+            parent = self._dao.get_state_from_local(row.local_parent_path)
+            self._dao.mark_descendants_remotely_created(parent)
+            self._dao.update_remote_parent_path(parent,
+                                                parent.remote_parent_path)
+            self._dao._queue_manager = Mock()
+            self._dao._queue_seek = 0
+            self._dao.queue_next_page()
+
+        c = self._dao._get_read_connection().cursor()
+        self.assertTrue(queries)
+        for query, params in queries:
+            plan = c.execute('EXPLAIN QUERY PLAN ' + query, params).fetchall()
+            details = [step[3] for step in plan if 'States' in step[3]]
+            self.assertTrue(details, query)
+            for detail in details:
+                self.assertIn('USING', detail,
+                              'Full scan for %r: %s' % (query, detail))
+
+
+class SlottedStateRowEngineDAOTest(EngineDAOTest):
+
+    state_factory = SlottedStateRow
+
+    def test_state_row(self):
+        row = self._dao.get_state_from_id(3)
+        self.assertIsInstance(row, SlottedStateRow)
+        self.assertEqual(row['local_path'], row.local_path)
+        self.assertEqual(row[5], row.local_path)
+        self.assertEqual(len(tuple(row)), len(row.keys()))
+        self.assertFalse(row.is_readonly())
+        self.assertIn('local_path=%r' % row.local_path, repr(row))
+        with self.assertRaises(AttributeError):
+            row.unknown_column = 'value'
+
+        row.update_state(local_state='modified')
+        copy = deepcopy(row)
+        self.assertEqual(copy.local_state, 'modified')
+        self.assertEqual(tuple(copy), tuple(row))
+
+        # Rows of other queries keep the sqlite3.Row behavior
+        c = self._dao._get_read_connection().cursor()
+        self.assertIsInstance(
+            c.execute('SELECT COUNT(*) as count FROM States').fetchone(),
+            StateRow)
@@ -0,0 +1,52 @@
+# coding: utf-8
+import unittest
+from collections import namedtuple
+
+from nxdrive.engine.prefetch import RemoteInfoCache
+
+Info = namedtuple('Info', 'uid name')
+
+
+class RemoteInfoCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = RemoteInfoCache(ttl=10, max_size=3,
+                                     clock=lambda: self.now)
+
+    def test_pop(self):
+        self.cache.put([Info('ref#1', 'a'), Info('ref#2', 'b')])
+        self.assertEqual(self.cache.pop('ref#1').name, 'a')
+        # Given once only
+        self.assertIsNone(self.cache.pop('ref#1'))
+
+        # Too old
+        self.now = 11
+        self.assertIsNone(self.cache.pop('ref#2'))
+        # Updated
+        self.cache.put([Info('ref#3', 'c')])
+        self.cache.put([Info('ref#3', 'd')])
+        self.assertEqual(self.cache.pop('ref#3').name, 'd')
+        self.cache.put([Info('ref#4', 'e')])
+        self.cache.discard('ref#4')
+        self.assertIsNone(self.cache.pop('ref#4'))
+
+        metrics = self.cache.get_metrics()
+        self.assertEqual((metrics['hits'], metrics['misses'],
+                          metrics['size']), (2, 3, 0))
+
+    def test_max_size(self):
+        self.cache.put([Info('ref#%d' % i, str(i)) for i in range(5)])
+        self.assertEqual(self.cache.get_metrics()['size'], 3)
+        # The oldest are dropped first
+        self.assertIsNone(self.cache.pop('ref#1'))
+        self.assertEqual(self.cache.pop('ref#2').name, '2')
+
+    def test_start_prefetch(self):
+        self.assertTrue(self.cache.start_prefetch('folder#1'))
+        # Already fetched by another processor
+        self.assertFalse(self.cache.start_prefetch('folder#1'))
+        self.assertTrue(self.cache.start_prefetch('folder#2'))
+        self.now = 11
+        self.assertTrue(self.cache.start_prefetch('folder#1'))
+        self.assertEqual(self.cache.get_metrics()['prefetches'], 3)
@@ -0,0 +1,45 @@
+# coding: utf-8
+import unittest
+
+from mock import Mock, patch
+
+from nxdrive.engine.queue_manager import QueueManager
+from nxdrive.engine.scheduler import QueueItem
+
+
+class QueueManagerTest(unittest.TestCase):
+
+    def create_manager(self, processors):
+        dao = Mock()
+        dao.is_queue_loaded.return_value = True
+        manager = QueueManager(Mock(), dao,
+                               max_file_processors=processors + 2)
+        # Processors are simulated by calling _get_file()
+        manager._create_thread = Mock()
+        return manager
+
+    def test_shrink_pool(self):
+        manager = self.create_manager(4)
+        for row_id in range(10):
+            manager.push(QueueItem(row_id, False, 'locally_created',
+                                   path='/file%d' % row_id))
+        manager.launch_processors()
+        self.assertEqual(len(manager._processors_pool), 4)
+
+        # Lower the target by one
+        manager._pool_sizer = Mock()
+        manager._pool_sizer.adjust.return_value = 3
+        manager._adjust_processors()
+
+        # Only one of the running processors is stopped, even before the
+        # threads of the pool are finished
+        items = [manager._get_file() for _ in range(4)]
+        self.assertEqual(items.count(None), 1)
+        items = [manager._get_file() for _ in range(3)]
+        self.assertNotIn(None, items)
+
+        # The queue is drained, each remaining processor stops once
+        with patch.object(manager, '_refill'):
+            while manager._get_file() is not None:
+                pass
+            self.assertEqual(manager._running_processors, 2)
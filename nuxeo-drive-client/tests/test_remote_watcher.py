@@ -0,0 +1,69 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from mock import Mock
+
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.watcher.remote_watcher import RemoteWatcher
+
+
+class RemoteWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+        path = os.path.join(self.tmpdir, 'test_engine.db')
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'resources',
+                                 'test_engine.db'), path)
+        self.dao = EngineDAO(path)
+        self.addCleanup(self.dao.dispose)
+        self.dao._queue_manager = Mock()
+
+        local_client = Mock()
+        local_client.exists.return_value = False
+        local_client.is_ignored.return_value = False
+        engine = Mock()
+        engine.get_local_client.return_value = local_client
+        self.watcher = RemoteWatcher(engine, self.dao, 30)
+        # Scanned from the test thread, as if the worker was running
+        self.watcher._continue = True
+
+    def test_scroll_new_tree(self):
+        root = self.dao.get_state_from_local('/')
+        now = datetime.utcnow()
+        root_info = RemoteFileInfo(
+            u'Root', root.remote_ref, None, '/', True, now, 'Administrator',
+            None, None, None, True, True, True, True, None, None, True)
+        folder = root_info._replace(name=u'Folder', uid='scroll#folder',
+                                    parent_uid=root.remote_ref,
+                                    path='/Folder')
+        sub = folder._replace(name=u'Sub', uid='scroll#sub',
+                              parent_uid=folder.uid, path='/Folder/Sub')
+        child = sub._replace(name=u'File', uid='scroll#file',
+                             parent_uid=sub.uid, path='/Folder/Sub/File',
+                             folderish=False, digest='digest')
+        client = self.watcher._client = Mock()
+        client.scroll_descendants.side_effect = [
+            {'descendants': [child, sub, folder], 'scroll_id': 'id'},
+            {'descendants': [], 'scroll_id': 'id'},
+        ]
+        self.dao.get_normal_state_from_remote = Mock(
+            wraps=self.dao.get_normal_state_from_remote)
+        self.dao.insert_remote_states = Mock(
+            wraps=self.dao.insert_remote_states)
+
+        self.watcher._scan_remote_scroll(root, root_info)
+
+        # The new tree is inserted at once, its parents are not read back
+        self.assertEqual(self.dao.insert_remote_states.call_count, 1)
+        self.dao.get_normal_state_from_remote.assert_called_once_with(
+            root.remote_ref)
+        pair = self.dao.get_normal_state_from_remote(child.uid)
+        self.assertEqual(pair.local_path, u'/Folder/Sub/File')
+        self.assertEqual(pair.remote_parent_path, '/'.join(
+            (root.remote_parent_path, root.remote_ref, folder.uid, sub.uid)))
@@ -0,0 +1,322 @@
+# coding: utf-8
+import unittest
+from Queue import Empty
+from threading import Lock, Thread, current_thread
+from time import sleep
+
+from nxdrive.engine.scheduler import FolderClaims, IndexedHeap, PairQueue, \
+    PoolSizer, QUEUE_POLICIES, QueueItem
+from nxdrive.utils import PathTrie
+
+
+class IndexedHeapTest(unittest.TestCase):
+
+    def test_heap(self):
+        heap = IndexedHeap()
+        self.assertIsNone(heap.peek())
+        self.assertRaises(IndexError, heap.pop)
+        for sequence, (item_id, key) in enumerate(
+                (('a', 3), ('b', 1), ('c', 2), ('d', 1))):
+            heap.push(item_id, key, sequence, item_id.upper())
+        self.assertEqual(len(heap), 4)
+        self.assertEqual(heap.peek()[:3], [1, 1, 'B'])
+
+        # Replaced and removed items are skipped
+        heap.push('b', 4, 1, 'B2')
+        self.assertTrue(heap.discard('c'))
+        self.assertFalse(heap.discard('c'))
+        self.assertNotIn('c', heap)
+        self.assertEqual(heap.get_entry('b')[:3], [4, 1, 'B2'])
+        self.assertEqual([heap.pop() for _ in range(len(heap))],
+                         ['D', 'A', 'B2'])
+        self.assertEqual(len(heap), 0)
+
+    def test_rekey(self):
+        heap = IndexedHeap()
+        for sequence, item_id in enumerate('abc'):
+            heap.push(item_id, sequence, sequence, item_id)
+        heap.rekey(lambda item: -ord(item))
+        self.assertEqual(sorted(entry[2] for entry in heap.entries()),
+                         ['a', 'b', 'c'])
+        self.assertEqual([heap.pop() for _ in range(3)], ['c', 'b', 'a'])
+
+    def test_compact(self):
+        heap = IndexedHeap()
+        for i in range(1000):
+            heap.push(i % 10, i, i, i)
+        self.assertEqual(len(heap), 10)
+        # The removed entries do not pile up
+        self.assertLessEqual(len(heap._heap), 2 * 10 + 64 + 1)
+        self.assertEqual([heap.pop() for _ in range(10)], range(990, 1000))
+
+
+class PairQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prioritized = PathTrie()
+
+    def create_queue(self, policy):
+        policy = QUEUE_POLICIES[policy]
+        return PairQueue(lambda item: policy(item, self.prioritized))
+
+    @staticmethod
+    def drain(queue):
+        ids = []
+        while not queue.empty():
+            ids.append(queue.get().id)
+        return ids
+
+    def test_fifo(self):
+        queue = self.create_queue('fifo')
+        self.assertRaises(Empty, queue.get)
+        self.assertIsNone(queue.peek_key())
+        for row_id, size in enumerate((10, 10 ** 9, 1)):
+            queue.put(QueueItem(row_id, False, 'remotely_created',
+                                path='/file%d' % row_id, size=size))
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual([item.id for item in queue.get_items()], [0, 1, 2])
+        self.assertEqual(self.drain(queue), [0, 1, 2])
+
+    def test_priority_files(self):
+        queue = self.create_queue('priority')
+        queue.put(QueueItem(1, False, 'locally_created', '/a/video', 2 ** 30))
+        queue.put(QueueItem(2, False, 'locally_created', '/a/doc', 2 ** 10))
+        queue.put(QueueItem(3, False, 'locally_modified', '/a/retry', 1,
+                            error_count=2))
+        queue.put(QueueItem(4, False, 'locally_deleted', '/b/old', 2 ** 30))
+        queue.put(QueueItem(5, False, 'locally_created', '/a/doc2', 2 ** 10))
+        self.assertEqual(self.drain(queue), [4, 2, 5, 1, 3])
+
+    def test_prioritize(self):
+        queue = self.create_queue('priority')
+        queue.put(QueueItem(1, False, 'locally_created', '/a/doc', 1))
+        queue.put(QueueItem(2, False, 'locally_created', '/b/video', 2 ** 30))
+        self.prioritized.add('/b')
+        queue.reprioritize()
+        self.assertEqual(self.drain(queue), [2, 1])
+
+    def test_direction(self):
+        for policy, expected in (('download_first', [2, 1]),
+                                 ('upload_first', [1, 2])):
+            queue = self.create_queue(policy)
+            queue.put(QueueItem(1, False, 'locally_created', '/up', 2 ** 20))
+            queue.put(QueueItem(2, False, 'remotely_created', '/down', 2))
+            self.assertEqual(self.drain(queue), expected)
+
+    def test_parent_before_child(self):
+        for policy in QUEUE_POLICIES:
+            queue = self.create_queue(policy)
+            queue.put(QueueItem(1, True, 'remotely_created', '/a/b/c'))
+            queue.put(QueueItem(2, True, 'remotely_created', '/a'))
+            queue.put(QueueItem(3, True, 'remotely_created', '/a/b'))
+            self.prioritized.add('/a/b/c')
+            queue.reprioritize()
+            self.assertEqual(self.drain(queue), [2, 3, 1])
+            self.prioritized = PathTrie()
+
+    def test_shared_sequence(self):
+        # Queues sharing a sequence can be compared by their head
+        local = self.create_queue('fifo')
+        remote = PairQueue(local._key, local._sequence)
+        remote.put(QueueItem(1, False, 'remotely_created', '/a'))
+        local.put(QueueItem(2, False, 'locally_created', '/b'))
+        self.assertLess(remote.peek_key(), local.peek_key())
+
+    def test_coalesce(self):
+        queue = self.create_queue('priority')
+        self.assertTrue(queue.put(
+            QueueItem(1, False, 'locally_created', '/a', 10)))
+        self.assertTrue(queue.put(
+            QueueItem(2, False, 'locally_created', '/b', 10)))
+        # Same priority, the item is updated in place
+        self.assertFalse(queue.put(
+            QueueItem(1, False, 'locally_modified', '/a', 20)))
+        self.assertEqual(queue.qsize(), 2)
+        # The priority changed, the row keeps its place among its peers
+        self.assertFalse(queue.put(
+            QueueItem(2, False, 'locally_deleted', '/b', 10)))
+        self.assertFalse(queue.put(
+            QueueItem(1, False, 'locally_modified', '/a', 2 ** 20)))
+        self.assertTrue(queue.put(
+            QueueItem(3, False, 'locally_created', '/c', 2 ** 20)))
+        self.assertEqual(queue.qsize(), 3)
+        items = [queue.get() for _ in range(3)]
+        self.assertEqual([(item.id, item.pair_state) for item in items],
+                         [(2, 'locally_deleted'), (1, 'locally_modified'),
+                          (3, 'locally_created')])
+        self.assertTrue(queue.empty())
+        self.assertIsNone(queue.peek_key())
+
+        # Removed items are skipped
+        queue.put(QueueItem(4, False, 'locally_created', '/d', 10))
+        self.assertTrue(queue.discard(4))
+        self.assertFalse(queue.discard(4))
+        self.assertRaises(Empty, queue.get)
+        # Once taken, a row can be queued again
+        queue.put(QueueItem(5, False, 'locally_created', '/e', 10))
+        queue.get()
+        self.assertTrue(queue.put(
+            QueueItem(5, False, 'locally_created', '/e', 10)))
+
+
+class FolderClaimsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.claims = FolderClaims()
+        policy = QUEUE_POLICIES['priority']
+        self.queue = PairQueue(lambda item: policy(item, PathTrie()))
+        self.row_id = 0
+
+    def push(self, path):
+        self.row_id += 1
+        self.queue.put(QueueItem(self.row_id, True, 'locally_created', path))
+
+    def get_path(self, thread_id):
+        item = self.claims.get(self.queue, thread_id)
+        return item.path if item else None
+
+    def test_deferred(self):
+        for path in ('/a', '/a/b', '/ab', '/a/b/c', '/d'):
+            self.push(path)
+        self.assertEqual(self.get_path(1), '/a')
+        # Siblings and disjoint subtrees are not blocked
+        self.assertEqual(self.get_path(2), '/ab')
+        self.assertEqual(self.get_path(3), '/d')
+        # The children wait for their parent
+        self.assertIsNone(self.get_path(4))
+        self.assertEqual(self.claims.get_metrics(),
+                         {'claimed': 3, 'deferred': 2})
+
+        self.assertEqual(self.claims.release(1), 2)
+        self.assertEqual(self.get_path(4), '/a/b')
+        self.assertIsNone(self.get_path(1))
+        self.assertEqual(self.claims.release(4), 1)
+        self.assertEqual(self.get_path(4), '/a/b/c')
+
+        # A parent waits for its children too
+        self.push('/a')
+        self.assertIsNone(self.get_path(1))
+        self.claims.release(4)
+        self.assertEqual(self.get_path(1), '/a')
+        self.claims.release(1)
+
+        # An unknown path waits for all the others
+        self.queue.put(QueueItem(42, True, 'locally_created'))
+        self.assertIsNone(self.get_path(1))
+        for thread_id in (2, 3):
+            self.claims.release(thread_id)
+        self.assertEqual(self.claims.get(self.queue, 1).id, 42)
+
+        # Folders in error are dropped
+        self.claims.release(1)
+        self.push('/e')
+        self.assertIsNone(self.claims.get(self.queue, 1,
+                                          skip=lambda item: True))
+        self.assertEqual(self.claims.get_metrics(),
+                         {'claimed': 0, 'deferred': 0})
+
+    def test_tree(self):
+        for i in range(5):
+            self.push('/%d' % i)
+            for j in range(5):
+                self.push('/%d/%d' % (i, j))
+                for k in range(5):
+                    self.push('/%d/%d/%d' % (i, j, k))
+        done = set()
+        lock = Lock()
+        errors = []
+        running = [0, 0]
+
+        def processor():
+            thread_id = current_thread().ident
+            while True:
+                if self.claims.release(thread_id):
+                    continue
+                item = self.claims.get(self.queue, thread_id)
+                if item is None:
+                    # Another processor may still release folders
+                    if not self.claims.get_metrics()['claimed']:
+                        break
+                    sleep(0.001)
+                    continue
+                with lock:
+                    parent = item.path.rpartition('/')[0]
+                    if parent and parent not in done:
+                        errors.append(item.path)
+                    running[0] += 1
+                    running[1] = max(running)
+                sleep(0.001)
+                with lock:
+                    running[0] -= 1
+                    done.add(item.path)
+
+        threads = [Thread(target=processor) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(done), 155)
+        self.assertEqual(errors, [])
+        self.assertGreater(running[1], 1)
+
+
+class PoolSizerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+
+    def create_sizer(self, size=3, minimum=1, maximum=6):
+        return PoolSizer(size, minimum, maximum, interval=10,
+                         clock=lambda: self.now)
+
+    def window(self, sizer, items, size=1024, errors=0, backlog=1000):
+        """ Simulate a window where items were processed. """
+        for _ in range(items):
+            sizer.record(0.1, size)
+        for _ in range(errors):
+            sizer.record(0, error=True)
+        self.now += 10
+        return sizer.adjust(backlog)
+
+    def test_latency_bound(self):
+        sizer = self.create_sizer()
+        # Not before the end of the window
+        sizer.record(0.1, 1024)
+        self.assertEqual(sizer.adjust(1000), 3)
+
+        # More processors for small files, while it helps
+        self.assertEqual(self.window(sizer, 30), 4)
+        self.assertEqual(sizer.decision, 'latency bound')
+        self.assertEqual(self.window(sizer, 40), 5)
+        self.assertEqual(sizer.decision, 'throughput improved')
+        self.assertEqual(self.window(sizer, 30), 4)
+        self.assertEqual(sizer.decision, 'throughput dropped')
+        self.assertEqual(self.window(sizer, 40), 4)
+        self.assertEqual(sizer.decision, 'stable')
+        self.assertEqual(sizer.metrics['items_rate'], 4)
+
+        # Never above the maximum
+        sizer = self.create_sizer(size=6)
+        self.assertEqual(self.window(sizer, 30), 6)
+
+    def test_bandwidth_bound(self):
+        sizer = self.create_sizer()
+        big = 100 * 1024 * 1024
+        # Less processors for big files, while the bandwidth holds
+        self.assertEqual(self.window(sizer, 10, size=big), 2)
+        self.assertEqual(sizer.decision, 'bandwidth bound')
+        self.assertEqual(self.window(sizer, 10, size=big), 1)
+        self.assertEqual(sizer.decision, 'throughput held')
+        # Never below the minimum
+        self.assertEqual(self.window(sizer, 10, size=big), 1)
+
+    def test_errors_and_backlog(self):
+        sizer = self.create_sizer()
+        self.assertEqual(self.window(sizer, 10, errors=5), 2)
+        self.assertEqual(sizer.decision, 'errors')
+        self.assertEqual(sizer.metrics['error_rate'], 5 / 15.0)
+
+        # No need for more processors than files to process
+        sizer = self.create_sizer()
+        self.assertEqual(self.window(sizer, 10, backlog=3), 3)
+        self.assertEqual(sizer.decision, 'no backlog')
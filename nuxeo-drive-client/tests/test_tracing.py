@@ -0,0 +1,133 @@
+# coding: utf-8
+import json
+import unittest
+from threading import Thread
+
+from nxdrive.engine.tracing import Tracer, traced, tracer as default_tracer
+
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.tracer = Tracer(size=3, clock=lambda: self.now)
+        self.tracer.enable()
+
+    def tick(self, seconds):
+        self.now += seconds
+
+    def test_disabled(self):
+        self.tracer.disable()
+        with self.tracer.trace('remotely_created', pair=1):
+            self.assertIsNone(self.tracer.get_current_trace())
+            with self.tracer.span('download', 'transfer'):
+                self.tracer.annotate(size=1)
+        self.assertEqual(self.tracer.get_traces(), [])
+
+        # No trace outside of a trace
+        self.tracer.enable()
+        with self.tracer.span('download', 'transfer'):
+            pass
+        self.assertEqual(self.tracer.get_traces(), [])
+
+    def test_phases(self):
+        with self.tracer.trace('locally_modified', queued_time=95.0, pair=1):
+            self.tick(1)
+            with self.tracer.span('_synchronize_locally_modified',
+                                  'handler'):
+                self.tick(0.5)
+                with self.tracer.span('get_digest', 'digest'):
+                    self.tick(2)
+                with self.tracer.span('upload', 'transfer'):
+                    self.tracer.annotate(size=42)
+                    self.tick(4)
+            self.tick(0.5)
+        trace, = self.tracer.get_traces()
+
+        self.assertEqual(trace['name'], 'locally_modified')
+        self.assertEqual(trace['args'], {'pair': 1})
+        self.assertEqual(trace['duration'], 8)
+        self.assertEqual(trace['queue_wait'], 5)
+        self.assertEqual(trace['phases'], {
+            'queue': 5,
+            'handler': 0.5,
+            'digest': 2,
+            'transfer': 4,
+            'other': 1.5,
+        })
+        self.assertEqual([span['name'] for span in trace['spans']],
+                         ['_synchronize_locally_modified', 'get_digest',
+                          'upload'])
+        self.assertEqual(trace['spans'][2]['args'], {'size': 42})
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with self.tracer.trace('remotely_created', pair=1):
+                with self.tracer.span('do_get', 'transfer'):
+                    raise ValueError()
+        trace, = self.tracer.get_traces()
+        self.assertEqual(trace['args']['error'], 'ValueError')
+        self.assertEqual(trace['spans'][0]['args']['error'], 'ValueError')
+        self.assertIsNone(self.tracer.get_current_trace())
+
+    def test_ring_buffer(self):
+        for pair in range(5):
+            with self.tracer.trace('remotely_created', pair=pair):
+                pass
+        self.assertEqual([trace['args']['pair']
+                          for trace in self.tracer.get_traces()], [2, 3, 4])
+        self.tracer.enable(size=2)
+        self.assertEqual([trace['args']['pair']
+                          for trace in self.tracer.get_traces()], [3, 4])
+        self.tracer.clear()
+        self.assertEqual(self.tracer.get_metrics(),
+                         {'enabled': True, 'traces': 0, 'size': 2})
+
+    def test_threads(self):
+        # Spans are recorded to the trace of their own thread
+        def other():
+            with self.tracer.span('get_info', 'remote'):
+                pass
+
+        with self.tracer.trace('locally_created', pair=1):
+            thread = Thread(target=other)
+            thread.start()
+            thread.join()
+        trace, = self.tracer.get_traces()
+        self.assertEqual(trace['spans'], [])
+
+    def test_chrome_export(self):
+        with self.tracer.trace('locally_created', queued_time=99.0, pair=1):
+            self.tick(1)
+            with self.tracer.span('execute', 'remote', command='GetInfo'):
+                self.tick(0.25)
+        chrome = json.loads(json.dumps(self.tracer.export_chrome()))
+        events = chrome['traceEvents']
+        self.assertEqual(sorted(event['ph'] for event in events),
+                         ['M', 'X', 'X', 'b', 'e'])
+        pair, span = [event for event in events if event['ph'] == 'X']
+        self.assertEqual((pair['ts'], pair['dur']), (100000000, 1250000))
+        self.assertEqual((span['ts'], span['dur']), (101000000, 250000))
+        self.assertEqual(span['cat'], 'remote')
+        self.assertEqual(span['args'], {'command': 'GetInfo'})
+        self.assertEqual(pair['tid'], span['tid'])
+        begin, = [event for event in events if event['ph'] == 'b']
+        self.assertEqual(begin['ts'], 99000000)
+
+    def test_traced(self):
+        @traced('local')
+        def make_folder(name):
+            return name
+
+        default_tracer.enable()
+        try:
+            self.assertEqual(make_folder('a'), 'a')
+            with default_tracer.trace('remotely_created', pair=1):
+                self.assertEqual(make_folder('b'), 'b')
+            trace = default_tracer.get_traces()[-1]
+        finally:
+            default_tracer.disable()
+            default_tracer.clear()
+        self.assertEqual([(span['name'], span['category'])
+                          for span in trace['spans']],
+                         [('make_folder', 'local')])
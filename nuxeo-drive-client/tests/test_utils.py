@@ -1,11 +1,15 @@
 # coding: utf-8
 import hashlib
+import os
+import shutil
+import stat
 import sys
+import tempfile
 import unittest
 
 from nxdrive.manager import ProxySettings
-from nxdrive.utils import guess_digest_algorithm, guess_mime_type, \
-    guess_server_url, is_generated_tmp_file
+from nxdrive.utils import PathTrie, copy_file, guess_digest_algorithm, \
+    guess_mime_type, guess_server_url, is_generated_tmp_file
 
 
 class TestUtils(unittest.TestCase):
@@ -80,6 +84,52 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(is_generated_tmp_file('A2D9FDCA1'), (False, None))
         self.assertEqual(is_generated_tmp_file('~A2D9FDCA1.tm'), (False, None))
 
+    def test_path_trie(self):
+        trie = PathTrie(['/a/b/', '/a/c/d/', '/e/'])
+        self.assertTrue(trie.is_filtered('/a/b'))
+        self.assertTrue(trie.is_filtered('/a/b/f/g'))
+        self.assertTrue(trie.is_filtered('/e/'))
+        self.assertFalse(trie.is_filtered('/a'))
+        self.assertFalse(trie.is_filtered('/a/c'))
+        # Segments are compared, not strings
+        self.assertFalse(trie.is_filtered('/a/bb'))
+        self.assertFalse(trie.is_filtered('/ee'))
+
+        self.assertEqual(sorted(trie.filtered_subtree('/a')),
+                         ['/a/b/', '/a/c/d/'])
+        self.assertEqual(trie.filtered_subtree('/a/c/d/x'), [])
+        self.assertEqual(trie.filtered_subtree('/e'), ['/e/'])
+        self.assertEqual(len(trie.filtered_subtree('/')), 3)
+
+        # A filter on the root filters everything
+        trie.add('/')
+        self.assertTrue(trie.is_filtered('/z'))
+
+    def test_copy_file(self):
+        folder = tempfile.mkdtemp()
+        try:
+            src = os.path.join(folder, 'src')
+            dst = os.path.join(folder, 'dst')
+            content = os.urandom(1024 * 1024 + 7)
+            with open(src, 'wb') as f:
+                f.write(content)
+            os.chmod(src, stat.S_IRUSR)
+
+            method = copy_file(src, dst)
+            self.assertIn(method, ('reflink', 'copy_file_range', 'sendfile',
+                                   'buffered'))
+            with open(dst, 'rb') as f:
+                self.assertEqual(f.read(), content)
+            self.assertEqual(stat.S_IMODE(os.stat(dst).st_mode),
+                             stat.S_IRUSR)
+
+            # Empty files too
+            open(src + '.empty', 'wb').close()
+            copy_file(src + '.empty', dst + '.empty')
+            self.assertEqual(os.path.getsize(dst + '.empty'), 0)
+        finally:
+            shutil.rmtree(folder)
+
     def test_guess_mime_type(self):
         # Text
         self.assertEqual(guess_mime_type('text.txt'), 'text/plain')
@@ -0,0 +1,87 @@
+# coding: utf-8
+import unittest
+from time import sleep, time
+
+from nxdrive.engine.workers import DummyWorker, PollWorker
+
+
+class CountingPollWorker(PollWorker):
+
+    def __init__(self, *args, **kwargs):
+        super(CountingPollWorker, self).__init__(*args, **kwargs)
+        self.polls = 0
+
+    def _poll(self):
+        self.polls += 1
+        return True
+
+
+class WorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def start_worker(self, worker):
+        if not isinstance(worker, PollWorker):
+            worker.get_thread().started.connect(worker.run)
+        self.workers.append(worker)
+        worker.start()
+        self.wait_for(worker.is_started)
+        return worker
+
+    @staticmethod
+    def wait_for(condition, timeout=5):
+        end = time() + timeout
+        while not condition() and time() < end:
+            sleep(0.01)
+        return condition()
+
+    @staticmethod
+    def get_wakeups(worker):
+        return worker.get_metrics()['wakeups']
+
+    def idle_wakeups_rate(self, worker, duration=1.5):
+        """ Return the number of wakeups per second of an idle worker. """
+        start = self.get_wakeups(worker)
+        sleep(duration)
+        return (self.get_wakeups(worker) - start) / duration
+
+    def test_idle_wakeups(self):
+        worker = self.start_worker(DummyWorker())
+        self.assertEqual(self.idle_wakeups_rate(worker), 0)
+
+        # Woken up once for each piece of work
+        worker.wake()
+        self.assertTrue(self.wait_for(lambda: self.get_wakeups(worker) == 1))
+
+    def test_poll_wakeups(self):
+        worker = self.start_worker(CountingPollWorker(1))
+        self.assertTrue(self.wait_for(lambda: worker.polls == 1))
+        # Only woken up for the next polls
+        self.assertLess(self.idle_wakeups_rate(worker, duration=3), 2)
+        # One poll per second, with a margin for a loaded machine
+        self.assertTrue(2 <= worker.polls <= 5, worker.polls)
+
+        polls = worker.polls
+        worker.force_poll()
+        self.assertTrue(self.wait_for(lambda: worker.polls > polls,
+                                      timeout=0.5))
+
+    def test_suspend_resume(self):
+        worker = self.start_worker(DummyWorker())
+        worker.suspend()
+        self.assertTrue(self.wait_for(lambda: self.get_wakeups(worker) == 1))
+        self.assertEqual(self.idle_wakeups_rate(worker), 0)
+        worker.resume()
+        self.assertTrue(self.wait_for(lambda: self.get_wakeups(worker) == 2))
+
+    def test_stop(self):
+        worker = self.start_worker(DummyWorker())
+        start = time()
+        worker.stop()
+        self.assertLess(time() - start, 1)
+        self.assertFalse(worker.get_thread().isRunning())
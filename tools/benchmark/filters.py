@@ -0,0 +1,76 @@
+# coding: utf-8
+"""
+Micro-benchmark of the sync filters lookups, linear scan against PathTrie.
+
+Usage, from the nuxeo-drive-client folder:
+    python ../tools/benchmark/filters.py [filters]
+"""
+import random
+import sys
+from timeit import default_timer
+
+from nxdrive.utils import PathTrie
+
+LOOKUPS = 10000
+
+
+def create_filters(count):
+    # Unchecked folders spread on 3 levels below 10 sync roots
+    filters = set()
+    while len(filters) < count:
+        filters.add('/root#%d/folder %d/sub %d/' % (
+            random.randrange(10), random.randrange(count),
+            random.randrange(10)))
+    return sorted(filters)
+
+
+def create_paths(filters, count):
+    paths = []
+    for i in xrange(count):
+        if i % 10:
+            # Most of the items are not filtered
+            paths.append('/root#%d/other %d/file %d/' % (i % 10, i, i))
+        else:
+            paths.append(random.choice(filters) + 'file %d/' % i)
+    return paths
+
+
+def best_of(func, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = default_timer()
+        func()
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    filters = create_filters(count)
+    paths = create_paths(filters, LOOKUPS)
+
+    def scan():
+        for path in paths:
+            any([path.startswith(filter_path) for filter_path in filters])
+
+    trie = PathTrie(filters)
+
+    def lookup():
+        for path in paths:
+            trie.is_filtered(path)
+
+    def subtree():
+        for path in paths:
+            trie.filtered_subtree(path)
+
+    build = best_of(lambda: PathTrie(filters))
+    print '%d filters, %d lookups' % (count, LOOKUPS)
+    for name, timing in (('linear scan', best_of(scan, repeat=1)),
+                         ('trie build', build),
+                         ('trie lookup', best_of(lookup)),
+                         ('trie subtree', best_of(subtree))):
+        print '%-14s %9.1fms' % (name, timing * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# coding: utf-8
+"""
+Simulation of the QueueManager file processors with each queue policy,
+to compare how long it takes to get the first files synchronized.
+
+The transfers are not real: a file takes a fixed latency plus its size
+divided by the bandwidth, and the processors share the bandwidth.
+
+Usage, from the nuxeo-drive-client folder:
+    python ../tools/benchmark/scheduler.py [files] [processors]
+"""
+import heapq
+import random
+import sys
+
+from nxdrive.engine.scheduler import PairQueue, QUEUE_POLICIES, QueueItem
+from nxdrive.utils import PathTrie
+
+LATENCY = 0.05  # Seconds spent per file, whatever its size
+BANDWIDTH = 50 * 1024 * 1024  # Bytes per second, shared by the processors
+MILESTONES = (10, 100, 0.5, 0.9, 1.0)
+
+
+def create_items(count):
+    """ Mostly office documents, with some videos, 3 levels deep. """
+    random.seed(42)
+    items = []
+    for row_id in xrange(count):
+        path = '/folder %d/sub %d/file %d' % (
+            random.randrange(20), random.randrange(10), row_id)
+        if random.random() < 0.03:
+            size = random.randint(200, 2000) * 1024 * 1024
+        else:
+            size = random.randint(10, 2000) * 1024
+        if random.random() < 0.1:
+            pair_state = 'locally_deleted'
+        elif random.random() < 0.5:
+            pair_state = 'remotely_created'
+        else:
+            pair_state = 'locally_created'
+        items.append(QueueItem(row_id, False, pair_state, path, size))
+    return items
+
+
+def duration(item, processors):
+    if item.pair_state.endswith('deleted'):
+        return LATENCY
+    return LATENCY + item.size * processors / float(BANDWIDTH)
+
+
+def simulate(items, policy, processors):
+    """ Return the sorted times when the files were done. """
+    prioritized = PathTrie()
+    queue = PairQueue(lambda item: QUEUE_POLICIES[policy](item, prioritized))
+    for item in items:
+        queue.put(item)
+    done = []
+    # Time when each processor is free again
+    workers = [0.0] * processors
+    while not queue.empty():
+        now = heapq.heappop(workers)
+        end = now + duration(queue.get(), processors)
+        done.append(end)
+        heapq.heappush(workers, end)
+    return sorted(done)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    processors = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    items = create_items(count)
+    milestones = [m if isinstance(m, int) else int(m * count)
+                  for m in MILESTONES]
+    print '%d files, %d processors, time to get the first N files synced' % (
+        count, processors)
+    print '%-16s' % 'policy' + ''.join('%10d' % m for m in milestones)
+    for policy in sorted(QUEUE_POLICIES):
+        done = simulate(items, policy, processors)
+        print '%-16s' % policy + ''.join('%9.1fs' % done[m - 1]
+                                         for m in milestones)
+
+
+if __name__ == '__main__':
+    main()
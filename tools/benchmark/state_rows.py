@@ -0,0 +1,88 @@
+# coding: utf-8
+"""
+Micro-benchmark of the EngineDAO state row factories.
+
+Usage, from the nuxeo-drive-client folder:
+    python ../tools/benchmark/state_rows.py [rows]
+"""
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+from nxdrive.engine.dao.sqlite import EngineDAO, SlottedStateRow, StateRow
+
+ATTRIBUTES = ('id', 'local_path', 'remote_ref', 'folderish', 'pair_state',
+              'local_state', 'remote_state', 'local_digest', 'remote_digest',
+              'processor')
+
+
+def create_db(path, rows):
+    dao = EngineDAO(path)
+    con = dao._get_write_connection()
+    con.executemany(
+        "INSERT INTO States(local_path, local_parent_path, local_name,"
+        " remote_ref, folderish, local_digest, remote_digest, local_state,"
+        " remote_state, pair_state) VALUES(?,?,?,?,?,?,?,?,?,?)",
+        (('/folder/file %d' % i, '/folder', 'file %d' % i, 'ref#%d' % i,
+          0, 'digest', 'digest', 'synchronized', 'synchronized',
+          'synchronized') for i in xrange(rows)))
+    con.commit()
+    dao.dispose()
+
+
+def best_of(func, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = default_timer()
+        func()
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def run(path, factory):
+    dao = EngineDAO(path, state_factory=factory)
+    con = dao._get_read_connection()
+    query = 'SELECT * FROM States'
+    rows = con.execute(query).fetchall()
+
+    def fetch():
+        con.execute(query).fetchall()
+
+    def access():
+        for row in rows:
+            for name in ATTRIBUTES:
+                getattr(row, name)
+
+    def scan():
+        for row in con.execute(query):
+            if row.pair_state != 'synchronized' or row.folderish:
+                continue
+            row.local_path, row.remote_ref, row.local_digest
+
+    try:
+        return best_of(fetch), best_of(access), best_of(scan)
+    finally:
+        dao.dispose()
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'benchmark.db')
+        create_db(path, rows)
+        print '%d rows, %d attributes read per row' % (rows, len(ATTRIBUTES))
+        print '%-16s %10s %10s %10s' % ('factory', 'fetch', 'access',
+                                        'scan')
+        for factory in (StateRow, SlottedStateRow):
+            timings = run(path, factory)
+            print '%-16s %9.1fms %9.1fms %9.1fms' % (
+                (factory.__name__,) + tuple(t * 1000 for t in timings))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()